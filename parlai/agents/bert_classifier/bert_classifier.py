@@ -18,7 +18,6 @@ from parlai.core.torch_classifier_agent import TorchClassifierAgent
 from parlai.utils.misc import warn_once
 from parlai.zoo.bert.build import download
 
-from collections import deque
 import os
 import torch
 
@@ -45,14 +44,16 @@ class BertClassifierHistory(History):
         if not self.sep_last_utt or len(self.history_vecs) <= 1:
             return super().get_history_vec()
 
-        history = deque(maxlen=self.max_len)
+        history = []
         for vec in self.history_vecs[:-1]:
             history.extend(vec)
             history.extend(self.delimiter_tok)
         history.extend([self.dict.end_idx])  # add [SEP] token
         history.extend(self.history_vecs[-1])
+        if self.max_len is not None:
+            history = history[max(0, len(history) - self.max_len) :]
 
-        return history
+        return torch.LongTensor(history)
 
 
 class BertClassifierAgent(TorchClassifierAgent):
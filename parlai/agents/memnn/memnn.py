@@ -181,7 +181,7 @@ class MemnnAgent(TorchRankerAgent):
         # check truncation
         if 'text_vec' in obs:
             truncated_vec = self._check_truncate(obs['text_vec'], truncate, True)
-            obs.force_set('text_vec', torch.LongTensor(truncated_vec))
+            obs.force_set('text_vec', torch.as_tensor(truncated_vec, dtype=torch.long))
 
         if 'memory_vecs' in obs:
             obs.force_set(
@@ -180,6 +180,19 @@ class Seq2seq(TorchGeneratorModel):
 
         return enc_out, hidden, attn_mask
 
+    def extend_encoder_states(self, encoder_states, xs):
+        """Continue encoding from the final hidden state of a previous input."""
+        if self.encoder.dirs > 1:
+            # backwards direction outputs of the prefix depend on the new tokens
+            return None
+        enc_out, hidden, attn_mask = encoder_states
+        new_out, hidden, new_mask = self.encoder(xs, hidden)
+        return (
+            torch.cat([enc_out, new_out], dim=1),
+            hidden,
+            torch.cat([attn_mask, new_mask], dim=1),
+        )
+
     def reorder_decoder_incremental_state(self, incremental_state, inds):
         if torch.is_tensor(incremental_state):
             # gru or vanilla rnn
@@ -269,10 +282,12 @@ class RNNEncoder(nn.Module):
         else:
             self.rnn = shared_rnn
 
-    def forward(self, xs):
+    def forward(self, xs, hidden=None):
         """Encode sequence.
 
         :param xs: (bsz x seqlen) LongTensor of input token indices
+        :param hidden: optional initial hidden state, e.g. the final hidden
+            state of a previous call when continuing an encoding
 
         :returns: encoder outputs, hidden state, attention mask
             encoder outputs are the output state at each step of the encoding.
@@ -293,7 +308,14 @@ class RNNEncoder(nn.Module):
             # packing failed, don't pack then
             packed = False
 
-        encoder_output, hidden = self.rnn(xes)
+        if hidden is not None:
+            hidden = _transpose_hidden_state(hidden)
+            if isinstance(hidden, tuple):
+                hidden = tuple(h.contiguous() for h in hidden)
+            else:
+                hidden = hidden.contiguous()
+
+        encoder_output, hidden = self.rnn(xes, hidden)
         if packed:
             # total_length to make sure we give the proper length in the case
             # of multigpu settings.
@@ -14,6 +14,7 @@ import scipy.sparse as sp
 import argparse
 import os
 import math
+import tempfile
 
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
@@ -54,6 +55,7 @@ def tokenize(text):
 
 
 MAX_SZ = int(math.pow(2, 30) * 1.8)
+MAX_INT32 = np.iinfo(np.int32).max
 
 # ------------------------------------------------------------------------------
 # Build article --> word count sparse matrix.
@@ -188,14 +190,22 @@ def get_count_matrix_t(args, db_opts):
     return count_matrix
 
 
-def get_count_matrix(args, db_opts):
-    """Form a sparse word to document count matrix (inverted index).
+def get_count_shards(args, db_opts, shard_dir):
+    """Count the words of every document, writing the counts to disk in shards.
 
-    M[i, j] = # times word i appears in document j.
+    Documents are counted by a pool of workers, and their counts are written
+    out as a sparse word to document count matrix every ``args.shard_size``
+    entries, so that memory use stays bounded however large the corpus is.
+
+    :param args: build arguments.
+    :param db_opts: options for the ``DocDB`` holding the documents.
+    :param str shard_dir: directory the shards are written to.
+
+    :return: (list of shard filenames, number of columns of the count matrix)
     """
-    global MAX_SZ
     with DocDB(**db_opts) as doc_db:
         doc_ids = doc_db.get_doc_ids()
+    num_cols = len(doc_ids) + 1
 
     # Setup worker pool
     tok_class = tokenizers.get_class(args.tokenizer)
@@ -203,33 +213,45 @@ def get_count_matrix(args, db_opts):
         args.num_workers, initializer=init, initargs=(tok_class, db_opts)
     )
 
-    # Compute the count matrix in steps (to keep in memory)
     logger.info('Mapping...')
+    shards = []
     row, col, data = [], [], []
-    step = max(int(len(doc_ids) / 10), 1)
-    batches = [doc_ids[i : i + step] for i in range(0, len(doc_ids), step)]
+
+    def write_shard():
+        filename = os.path.join(shard_dir, 'counts_%d' % len(shards))
+        count_matrix = sp.csr_matrix(
+            (data, (row, col)), shape=(args.hash_size, num_cols)
+        )
+        count_matrix.sum_duplicates()
+        utils.save_sparse_csr(filename, count_matrix)
+        shards.append(filename)
+        logger.info('Wrote shard %d (%d entries)' % (len(shards), len(data)))
+        del row[:], col[:], data[:]
+
     _count = partial(count, args.ngram, args.hash_size)
-    for i, batch in enumerate(batches):
-        logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25)
-        for b_row, b_col, b_data in workers.imap_unordered(_count, batch):
-            row.extend(b_row)
-            col.extend(b_col)
-            data.extend(b_data)
-            if len(data) > MAX_SZ:
-                break
-        if len(data) > MAX_SZ:
-            logger.info('Reached max indexable size, breaking.')
-            break
+    for b_row, b_col, b_data in workers.imap_unordered(_count, doc_ids, chunksize=100):
+        row.extend(b_row)
+        col.extend(b_col)
+        data.extend(b_data)
+        if len(data) >= args.shard_size:
+            write_shard()
+    if data or not shards:
+        write_shard()
     workers.close()
     workers.join()
+    return shards, num_cols
 
-    logger.info('Creating sparse matrix...')
-    data, row, col = truncate(data, row, col)
 
-    count_matrix = sp.csr_matrix(
-        (data, (row, col)), shape=(args.hash_size, len(doc_ids) + 1)
-    )
-    count_matrix.sum_duplicates()
+def get_count_matrix(args, db_opts):
+    """Form a sparse word to document count matrix (inverted index).
+
+    M[i, j] = # times word i appears in document j.
+    """
+    with tempfile.TemporaryDirectory() as shard_dir:
+        shards, _ = get_count_shards(args, db_opts, shard_dir)
+        count_matrix, _ = utils.load_sparse_csr(shards[0])
+        for shard in shards[1:]:
+            count_matrix += utils.load_sparse_csr(shard)[0]
     return count_matrix
 
 
@@ -289,6 +311,71 @@ def get_doc_freqs(cnts):
     return freqs
 
 
+def merge_tfidf_shards(shards, tmp_dir):
+    """Merge count shards into a single tfidf matrix, without loading them all.
+
+    Shards count disjoint sets of documents, so a word's document frequency is
+    the sum of its number of entries in each shard. A first pass over the
+    shards computes these, and with them the idfs and the layout of the merged
+    matrix. A second pass then writes the tfidf of each shard's entries into
+    its place in memory-mapped files under ``tmp_dir``, one shard at a time.
+    The result matches ``get_tfidf_matrix`` on the full count matrix.
+
+    :param shards: filenames of the count shards, as from ``get_count_shards``.
+    :param str tmp_dir: directory for the memory-mapped arrays.
+
+    :return: (tfidf matrix, doc freqs)
+    """
+    # first pass: document frequencies, and so idfs
+    freqs = None
+    for shard in shards:
+        cnts, _ = utils.load_sparse_csr(shard)
+        shard_freqs = np.diff(cnts.indptr).astype(np.int64)
+        freqs = shard_freqs if freqs is None else freqs + shard_freqs
+    num_rows, num_cols = cnts.shape
+    idfs = np.log((num_cols - freqs + 0.5) / (freqs + 0.5))
+    idfs[idfs < 0] = 0
+    # terms with no idf weight have no entries in the tfidf matrix
+    row_sizes = np.where(idfs > 0, freqs, 0)
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(row_sizes, out=indptr[1:])
+    nnz = int(indptr[-1])
+
+    def _memmap(name, dtype):
+        return np.lib.format.open_memmap(
+            os.path.join(tmp_dir, name + '.npy'),
+            mode='w+',
+            dtype=dtype,
+            shape=(max(nnz, 1),),
+        )[:nnz]
+
+    data = _memmap('data', np.float64)
+    # scipy wants 64 bit indices once there are too many entries for 32 bits
+    indices = _memmap('indices', np.int64 if nnz > MAX_INT32 else np.int32)
+
+    # second pass: write each shard's entries after those of previous shards
+    offsets = indptr[:-1].copy()
+    for i, shard in enumerate(shards):
+        logger.info('Merging shard %d/%d' % (i + 1, len(shards)))
+        cnts, _ = utils.load_sparse_csr(shard)
+        rows = np.repeat(np.arange(num_rows), np.diff(cnts.indptr))
+        keep = idfs[rows] > 0
+        rows = rows[keep]
+        shard_sizes = np.bincount(rows, minlength=num_rows)
+        # position of each entry within its row of this shard
+        starts = np.zeros(num_rows, dtype=np.int64)
+        np.cumsum(shard_sizes[:-1], out=starts[1:])
+        dest = offsets[rows] + np.arange(len(rows)) - starts[rows]
+        data[dest] = np.log1p(cnts.data[keep]) * idfs[rows]
+        indices[dest] = cnts.indices[keep]
+        offsets += shard_sizes
+    data.flush()
+    indices.flush()
+
+    tfidfs = sp.csr_matrix((data, indices, indptr), shape=(num_rows, num_cols))
+    return tfidfs, freqs
+
+
 # ------------------------------------------------------------------------------
 # Main.
 # ------------------------------------------------------------------------------
@@ -296,26 +383,26 @@ def get_doc_freqs(cnts):
 
 def run(args):
     # ParlAI version of run method, modified slightly
-    logger.info('Counting words...')
-    count_matrix = get_count_matrix(args, {'db_path': args.db_path})
-
-    logger.info('Making tfidf vectors...')
-    tfidf = get_tfidf_matrix(count_matrix)
-
-    logger.info('Getting word-doc frequencies...')
-    freqs = get_doc_freqs(count_matrix)
-
     filename = args.out_dir
+    # shards go next to the output, where there is room for the index
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(filename)), prefix='tfidf_shards_'
+    ) as tmp_dir:
+        logger.info('Counting words...')
+        shards, _ = get_count_shards(args, {'db_path': args.db_path}, tmp_dir)
 
-    logger.info('Saving to %s' % filename)
-    metadata = {
-        'doc_freqs': freqs,
-        'tokenizer': args.tokenizer,
-        'hash_size': args.hash_size,
-        'ngram': args.ngram,
-    }
+        logger.info('Making tfidf vectors...')
+        tfidf, freqs = merge_tfidf_shards(shards, tmp_dir)
 
-    utils.save_sparse_csr(filename, tfidf, metadata)
+        logger.info('Saving to %s' % filename)
+        metadata = {
+            'doc_freqs': freqs,
+            'tokenizer': args.tokenizer,
+            'hash_size': args.hash_size,
+            'ngram': args.ngram,
+        }
+
+        utils.save_sparse_csr(filename, tfidf, metadata)
 
 
 if __name__ == '__main__':
@@ -354,6 +441,12 @@ if __name__ == '__main__':
         default=None,
         help='Number of CPU processes (for tokenizing, etc)',
     )
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=int(math.pow(2, 25)),
+        help='Number of counts to hold in memory before writing them to disk',
+    )
     args = parser.parse_args()
 
     logger.info('Counting words...')
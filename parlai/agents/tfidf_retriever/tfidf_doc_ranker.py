@@ -11,9 +11,6 @@ Adapted from Adam Fisch's work at github.com/facebookresearch/DrQA/
 import numpy as np
 import scipy.sparse as sp
 
-from multiprocessing.pool import ThreadPool
-from functools import partial
-
 from . import utils
 from . import tokenizers
 from parlai.utils.logging import logger
@@ -56,26 +53,30 @@ class TfidfDocRanker(object):
 
         matrix arg can be provided to be used instead of internal doc matrix.
         """
-        spvec = self.text2spvec(query)
-        res = spvec * matrix if matrix is not None else spvec * self.doc_mat
-
-        if len(res.data) <= k:
-            o_sort = np.argsort(-res.data)
-        else:
-            o = np.argpartition(-res.data, k)[0:k]
-            o_sort = o[np.argsort(-res.data[o])]
-
-        doc_scores = res.data[o_sort]
-        doc_ids = res.indices[o_sort]
-        return doc_ids, doc_scores
-
-    def batch_closest_docs(self, queries, k=1, num_workers=None):
-        """Process a batch of closest_docs requests multithreaded.
-        Note: we can use plain threads here as scipy is outside of the GIL.
+        return self.batch_closest_docs([query], k=k, matrix=matrix)[0]
+
+    def batch_closest_docs(self, queries, k=1, num_workers=None, matrix=None):
+        """Closest docs for a batch of queries.
+
+        All queries are scored with a single sparse matrix product, and the
+        top k docs are then selected from each row of the result.
+
+        num_workers is unused, and kept for backwards compatibility.
         """
-        with ThreadPool(num_workers) as threads:
-            closest_docs = partial(self.closest_docs, k=k)
-            results = threads.map(closest_docs, queries)
+        spmat = self.texts2spmat(queries)
+        res = spmat * matrix if matrix is not None else spmat * self.doc_mat
+        res = res.tocsr()
+
+        results = []
+        for i in range(len(queries)):
+            start, end = res.indptr[i], res.indptr[i + 1]
+            data, indices = res.data[start:end], res.indices[start:end]
+            if len(data) <= k:
+                o_sort = np.argsort(-data)
+            else:
+                o = np.argpartition(-data, k)[0:k]
+                o_sort = o[np.argsort(-data[o])]
+            results.append((indices[o_sort], data[o_sort]))
         return results
 
     def parse(self, query):
@@ -88,20 +89,40 @@ class TfidfDocRanker(object):
 
         tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5))
         """
-        # Get hashed ngrams
-        words = self.parse(utils.normalize(query))
-        wids = [utils.hash(w, self.hash_size) for w in words]
+        return self.texts2spmat([query])
 
-        if len(wids) == 0:
-            if self.strict:
-                raise RuntimeError('No valid word in: %s' % query)
-            else:
-                logger.warning('No valid word in: %s' % query)
-                return sp.csr_matrix((1, self.hash_size))
+    def texts2spmat(self, queries):
+        """Create a sparse tfidf-weighted word matrix, one row per query.
 
-        # Count TF
-        wids_unique, wids_counts = np.unique(wids, return_counts=True)
-        tfs = np.log1p(wids_counts)
+        Each distinct ngram in the batch is only hashed once, and the tfidf
+        weights of all queries are computed together.
+        """
+        # Get ngrams, and hash each distinct one
+        query_words = [self.parse(utils.normalize(query)) for query in queries]
+        hashes = {}
+        rows = []
+        wids = []
+        for i, (query, words) in enumerate(zip(queries, query_words)):
+            if len(words) == 0:
+                if self.strict:
+                    raise RuntimeError('No valid word in: %s' % query)
+                else:
+                    logger.warning('No valid word in: %s' % query)
+                    continue
+            for w in words:
+                if w not in hashes:
+                    hashes[w] = utils.hash(w, self.hash_size)
+                wids.append(hashes[w])
+            rows.extend([i] * len(words))
+
+        # Count TF of each (query, word) pair
+        keys = np.array(rows, dtype=np.int64) * self.hash_size + np.array(
+            wids, dtype=np.int64
+        )
+        keys_unique, keys_counts = np.unique(keys, return_counts=True)
+        rows_unique = keys_unique // self.hash_size
+        wids_unique = keys_unique % self.hash_size
+        tfs = np.log1p(keys_counts)
 
         # Count IDF
         Ns = self.doc_freqs[wids_unique]
@@ -111,8 +132,7 @@ class TfidfDocRanker(object):
         # TF-IDF
         data = np.multiply(tfs, idfs)
 
-        # One row, sparse csr matrix
-        indptr = np.array([0, len(wids_unique)])
-        spvec = sp.csr_matrix((data, wids_unique, indptr), shape=(1, self.hash_size))
-
-        return spvec
+        # One row per query, sparse csr matrix
+        return sp.csr_matrix(
+            (data, (rows_unique, wids_unique)), shape=(len(queries), self.hash_size)
+        )
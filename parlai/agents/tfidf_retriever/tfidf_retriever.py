@@ -71,6 +71,13 @@ class TfidfRetrieverAgent(Agent):
             default=int(math.pow(2, 24)),
             help='Number of buckets to use for hashing ngrams',
         )
+        parser.add_argument(
+            '--retriever-shard-size',
+            type=int,
+            default=int(math.pow(2, 25)),
+            help='Number of word counts to hold in memory while building the '
+            'index, before writing them to disk',
+        )
         parser.add_argument(
             '--retriever-tokenizer',
             type=str,
@@ -149,6 +156,7 @@ class TfidfRetrieverAgent(Agent):
                 'hash_size': opt['retriever_hashsize'],
                 'tokenizer': opt['retriever_tokenizer'],
                 'num_workers': opt['retriever_numworkers'],
+                'shard_size': opt.get('retriever_shard_size', int(math.pow(2, 25))),
             }
         )
 
@@ -222,7 +230,7 @@ class TfidfRetrieverAgent(Agent):
         with open(self.opt['model_file'], 'w') as f:
             f.write('\n')
 
-    def train_act(self):
+    def train_act(self, obs=None):
         if (
             'ordered' not in self.opt.get('datatype', 'train:ordered')
             or self.opt.get('batchsize', 1) != 1
@@ -233,7 +241,8 @@ class TfidfRetrieverAgent(Agent):
                 'Need to set --batchsize 1, --numthreads 1, \
             --datatype train:ordered, --num_epochs 1'
             )
-        obs = self.observation
+        if obs is None:
+            obs = self.observation
         self.current.append(obs)
         self.episode_done = obs.get('episode_done', False)
 
@@ -273,60 +282,88 @@ class TfidfRetrieverAgent(Agent):
             doc_ids, doc_scores = self.ranker.closest_docs(
                 obs['text'], self.opt.get('retriever_num_retrieved', 5)
             )
+            self._build_reply(reply, obs, doc_ids, doc_scores)
 
-            if False and obs.get('label_candidates'):  # TODO: Alex (doesn't work)
-                # these are better selection than stored facts
-                # rank these options instead
-                cands = obs['label_candidates']
-                cands_id = id(cands)
-                if cands_id not in self.cands_hash:
-                    # cache candidate set
-                    # will not update if cand set changes contents
-                    c_list = list(cands)
-                    self.cands_hash[cands_id] = (
-                        get_tfidf_matrix(live_count_matrix(self.tfidf_args, c_list)),
-                        c_list,
-                    )
-                c_ids, c_scores = self.ranker.closest_docs(
-                    obs['text'],
-                    self.opt.get('retriever_num_retrieved', 5),
-                    matrix=self.cands_hash[cands_id][0],
+        return reply
+
+    def batch_act(self, observations):
+        """Retrieve docs for a batch of observations.
+
+        The docs of all observations with text are ranked together, with a
+        single sparse matrix product.
+        """
+        batch_reply = [{'id': self.getID()} for _ in observations]
+        queries = []
+        for i, obs in enumerate(observations):
+            if 'labels' in obs:
+                batch_reply[i] = self.train_act(obs)
+            elif 'text' in obs:
+                queries.append(i)
+        if len(queries) > 0:
+            self.rebuild()  # no-op if nothing has been queued to store
+            results = self.ranker.batch_closest_docs(
+                [observations[i]['text'] for i in queries],
+                self.opt.get('retriever_num_retrieved', 5),
+            )
+            for i, (doc_ids, doc_scores) in zip(queries, results):
+                self._build_reply(batch_reply[i], observations[i], doc_ids, doc_scores)
+        return batch_reply
+
+    def _build_reply(self, reply, obs, doc_ids, doc_scores):
+        """Fill in the reply to an observation from its closest docs."""
+        if False and obs.get('label_candidates'):  # TODO: Alex (doesn't work)
+            # these are better selection than stored facts
+            # rank these options instead
+            cands = obs['label_candidates']
+            cands_id = id(cands)
+            if cands_id not in self.cands_hash:
+                # cache candidate set
+                # will not update if cand set changes contents
+                c_list = list(cands)
+                self.cands_hash[cands_id] = (
+                    get_tfidf_matrix(live_count_matrix(self.tfidf_args, c_list)),
+                    c_list,
                 )
-                reply['text_candidates'] = [
-                    self.cands_hash[cands_id][1][cid] for cid in c_ids
-                ]
-                reply['candidate_scores'] = c_scores
-                if len(reply['text_candidates']) > 0:
-                    reply['text'] = reply['text_candidates'][0]
-                else:
-                    reply['text'] = ''
-            elif len(doc_ids) > 0:
-                # return stored fact
-                # total = sum(doc_scores)
-                # doc_probs = [d / total for d in doc_scores]
-
-                # returned
-                picks = [self.doc2txt(int(did)) for did in doc_ids]
-                pick = self.doc2txt(int(doc_ids[0]))  # select best response
-
-                if self.opt.get('remove_title', False):
-                    picks = ['\n'.join(p.split('\n')[1:]) for p in picks]
-                    pick = '\n'.join(pick.split('\n')[1:])
-                reply['text_candidates'] = picks
-                reply['candidate_scores'] = doc_scores
-
-                # could pick single choice based on probability scores?
-                # pick = int(choice(doc_ids, p=doc_probs))
-                reply['text'] = pick
+            c_ids, c_scores = self.ranker.closest_docs(
+                obs['text'],
+                self.opt.get('retriever_num_retrieved', 5),
+                matrix=self.cands_hash[cands_id][0],
+            )
+            reply['text_candidates'] = [
+                self.cands_hash[cands_id][1][cid] for cid in c_ids
+            ]
+            reply['candidate_scores'] = c_scores
+            if len(reply['text_candidates']) > 0:
+                reply['text'] = reply['text_candidates'][0]
             else:
-                # no cands and nothing found, return generic response
-                reply['text'] = choice(
-                    [
-                        'Can you say something more interesting?',
-                        'Why are you being so short with me?',
-                        'What are you really thinking?',
-                        'Can you expand on that?',
-                    ]
-                )
+                reply['text'] = ''
+        elif len(doc_ids) > 0:
+            # return stored fact
+            # total = sum(doc_scores)
+            # doc_probs = [d / total for d in doc_scores]
+
+            # returned
+            picks = [self.doc2txt(int(did)) for did in doc_ids]
+            pick = self.doc2txt(int(doc_ids[0]))  # select best response
+
+            if self.opt.get('remove_title', False):
+                picks = ['\n'.join(p.split('\n')[1:]) for p in picks]
+                pick = '\n'.join(pick.split('\n')[1:])
+            reply['text_candidates'] = picks
+            reply['candidate_scores'] = doc_scores
+
+            # could pick single choice based on probability scores?
+            # pick = int(choice(doc_ids, p=doc_probs))
+            reply['text'] = pick
+        else:
+            # no cands and nothing found, return generic response
+            reply['text'] = choice(
+                [
+                    'Can you say something more interesting?',
+                    'Why are you being so short with me?',
+                    'What are you really thinking?',
+                    'Can you expand on that?',
+                ]
+            )
 
         return reply
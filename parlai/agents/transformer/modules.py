@@ -668,32 +668,46 @@ class TransformerDecoder(nn.Module):
         :param encoder_state:
             Output from the encoder module forward pass.
         :param incr_state:
-            Ignored. Should always be ``None`` in this version.
+            The incremental state returned by the previous call, holding the
+            attention keys and values of the positions already decoded, or
+            ``None``. Only the positions of input after those are computed.
+
+        :return:
+            (output, incr_state): the outputs of the new positions, and the
+            incremental state for the next step.
         """
         encoder_output, encoder_mask = encoder_state
 
         seq_len = input.size(1)
-        positions = input.new(seq_len).long()
-        positions = torch.arange(seq_len, out=positions).unsqueeze(0)
+        # positions of input which were decoded in previous steps
+        start = incr_state[0]['self_attn']['prev_key'].size(2) if incr_state else 0
+        input = input[:, start:]
+        positions = torch.arange(start, seq_len, device=input.device).unsqueeze(0)
         tensor = self.embeddings(input)
         if self.embeddings_scale:
             tensor = tensor * np.sqrt(self.dim)
         if self.variant == 'xlm':
             tensor = _normalize(tensor, self.norm_embeddings)
-        if positions.max().item() > self.n_positions:
+        if seq_len - 1 > self.n_positions:
             warn_once(
                 'You are inputting a sequence of {x} length, but only have '
                 '--n-positions {y}. Set --truncate or increase --n-positions'.format(
-                    x=positions.max().item(), y=self.n_positions
+                    x=seq_len - 1, y=self.n_positions
                 )
             )
         tensor = tensor + self.position_embeddings(positions).expand_as(tensor)
         tensor = self.dropout(tensor)  # --dropout
 
-        for layer in self.layers:
-            tensor = layer(tensor, encoder_output, encoder_mask)
+        new_incr_state = {}
+        for idx, layer in enumerate(self.layers):
+            tensor, new_incr_state[idx] = layer(
+                tensor,
+                encoder_output,
+                encoder_mask,
+                incr_state=incr_state[idx] if incr_state else None,
+            )
 
-        return tensor, None
+        return tensor, new_incr_state
 
 
 class TransformerDecoderLayer(nn.Module):
@@ -739,20 +753,39 @@ class TransformerDecoderLayer(nn.Module):
         )
         self.norm3 = LayerNorm(embedding_size, eps=LAYER_NORM_EPS)
 
-    def forward(self, x, encoder_output, encoder_mask):
-        """Forward pass."""
-        decoder_mask = self._create_selfattn_mask(x)
+    def forward(self, x, encoder_output, encoder_mask, incr_state=None):
+        """
+        Forward pass.
+
+        :param incr_state:
+            the keys and values of the self attention over previous positions,
+            and of the encoder attention, or None.
+
+        :return:
+            (output, incr_state) with the keys and values of this step added.
+        """
+        if incr_state is None:
+            incr_state = {'self_attn': {}, 'encoder_attn': {}}
+        self_attn_state = dict(incr_state['self_attn'])
+        encoder_attn_state = dict(incr_state['encoder_attn'])
+        cached = self_attn_state['prev_key'].size(2) if self_attn_state else 0
+        decoder_mask = self._create_selfattn_mask(x, cached)
         # first self attn
         residual = x
         # don't peak into the future!
-        x = self.self_attention(query=x, mask=decoder_mask)
+        x = self.self_attention(query=x, mask=decoder_mask, incr_state=self_attn_state)
         x = self.dropout(x)  # --dropout
         x = x + residual
         x = _normalize(x, self.norm1)
 
         residual = x
         x = self.encoder_attention(
-            query=x, key=encoder_output, value=encoder_output, mask=encoder_mask
+            query=x,
+            key=encoder_output,
+            value=encoder_output,
+            mask=encoder_mask,
+            incr_state=encoder_attn_state,
+            static_kv=True,
         )
         x = self.dropout(x)  # --dropout
         x = residual + x
@@ -765,14 +798,15 @@ class TransformerDecoderLayer(nn.Module):
         x = residual + x
         x = _normalize(x, self.norm3)
 
-        return x
+        return x, {'self_attn': self_attn_state, 'encoder_attn': encoder_attn_state}
 
-    def _create_selfattn_mask(self, x):
+    def _create_selfattn_mask(self, x, cached=0):
         # figure out how many timestamps we need
         bsz = x.size(0)
         time = x.size(1)
-        # make sure that we don't look into the future
-        mask = torch.tril(x.new(time, time).fill_(1))
+        # make sure that we don't look into the future. x holds the positions
+        # after the cached ones, which can all be attended to
+        mask = torch.tril(x.new(time, cached + time).fill_(1), diagonal=cached)
         # broadcast across batch
         mask = mask.unsqueeze(0).expand(bsz, -1, -1)
         return mask
@@ -838,10 +872,20 @@ class TransformerGeneratorModel(TorchGeneratorModel):
         """
         Reorder the decoder incremental state.
 
-        Not implemented in Transformers, since ``incremental_state`` is always None.
+        See ``TorchGeneratorModel.reorder_decoder_incremental_state`` for a
+        description. The state holds the attention keys and values of each
+        layer, which are all selected along the batch dimension.
         """
-        # no support for incremental decoding at this time
-        return None
+        return {
+            idx: {
+                attn_type: {
+                    key: torch.index_select(value, 0, inds)
+                    for key, value in attn_state.items()
+                }
+                for attn_type, attn_state in layer_state.items()
+            }
+            for idx, layer_state in incremental_state.items()
+        }
 
     def output(self, tensor):
         """Compute output logits."""
@@ -929,8 +973,21 @@ class MultiHeadAttention(nn.Module):
 
         nn.init.xavier_normal_(self.out_lin.weight)
 
-    def forward(self, query, key=None, value=None, mask=None):
-        """Forward pass."""
+    def forward(
+        self, query, key=None, value=None, mask=None, incr_state=None, static_kv=False
+    ):
+        """
+        Forward pass.
+
+        :param incr_state:
+            dict of the keys and values of previous calls, for incremental
+            decoding, or None. It is updated in place: the projected keys and
+            values of this call are added after the previous ones.
+        :param static_kv:
+            whether key and value are the same at every call, like the encoder
+            output in encoder attention. Then they are only projected at the
+            first call, and reused from incr_state afterwards.
+        """
         # TODO: there are a lot of parameters to document here.
 
         # Input is [B, query_len, dim]
@@ -964,11 +1021,30 @@ class MultiHeadAttention(nn.Module):
             # key and value are the same, but query differs
             # self attention
             value = key
-        _, key_len, dim = key.size()
 
         q = prepare_head(self.q_lin(query))
-        k = prepare_head(self.k_lin(key))
-        v = prepare_head(self.v_lin(value))
+        if static_kv and incr_state and 'prev_key' in incr_state:
+            # already projected
+            k = incr_state['prev_key'].view(batch_size * n_heads, -1, dim_per_head)
+            v = incr_state['prev_value'].view(batch_size * n_heads, -1, dim_per_head)
+        else:
+            k = prepare_head(self.k_lin(key))
+            v = prepare_head(self.v_lin(value))
+            if incr_state and 'prev_key' in incr_state:
+                # attend over the previous positions too
+                prev_key = incr_state['prev_key']
+                prev_value = incr_state['prev_value']
+                k = torch.cat(
+                    [prev_key.view(batch_size * n_heads, -1, dim_per_head), k], 1
+                )
+                v = torch.cat(
+                    [prev_value.view(batch_size * n_heads, -1, dim_per_head), v], 1
+                )
+        if incr_state is not None:
+            # kept as [B, n_heads, key_len, dim_per_head], to reorder along B
+            incr_state['prev_key'] = k.view(batch_size, n_heads, -1, dim_per_head)
+            incr_state['prev_value'] = v.view(batch_size, n_heads, -1, dim_per_head)
+        key_len = k.size(1)
 
         dot_prod = q.div_(scale).bmm(k.transpose(1, 2))
         # [B * n_heads, query_len, key_len]
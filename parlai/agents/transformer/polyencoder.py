@@ -129,14 +129,14 @@ class PolyencoderAgent(TorchRankerAgent):
         kwargs['add_end'] = True
         return super().vectorize_fixed_candidates(*args, **kwargs)
 
-    def _make_candidate_encs(self, vecs):
+    def _make_candidate_encs(self, vecs, path=None):
         """Make candidate encs.
 
         The polyencoder module expects
         cand vecs to be 3D while torch_ranker_agent expects it to be 2D.
         This requires a little adjustment (used in interactive mode only)
         """
-        rep = super()._make_candidate_encs(vecs)
+        rep = super()._make_candidate_encs(vecs, path=path)
         return rep.transpose(0, 1).contiguous()
 
     def encode_candidates(self, padded_cands):
@@ -238,19 +238,29 @@ class TransformerRankerAgent(TorchRankerAgent):
 
         return cands
 
-    def score_candidates(self, batch, cand_vecs, cand_encs=None):
-        """Score candidates."""
+    def _batch_memories(self, batch):
+        """Return the padded memories of the batch, or None if there are none."""
         # convoluted check that not all memories are empty
         if (
             self.opt['use_memories']
             and batch.memory_vecs is not None
             and sum(len(m) for m in batch.memory_vecs)
         ):
-            mems = padded_3d(
+            return padded_3d(
                 batch.memory_vecs, use_cuda=self.use_cuda, pad_idx=self.NULL_IDX
             )
-        else:
-            mems = None
+        return None
+
+    def encode_context(self, batch):
+        """Encode the contexts, which score candidates by dot product."""
+        context_h, _ = self.model(
+            xs=batch.text_vec, mems=self._batch_memories(batch), cands=None
+        )
+        return context_h
+
+    def score_candidates(self, batch, cand_vecs, cand_encs=None):
+        """Score candidates."""
+        mems = self._batch_memories(batch)
 
         if cand_encs is not None:
             # we pre-encoded the candidates, do not re-encode here
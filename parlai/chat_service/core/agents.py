@@ -4,9 +4,10 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import threading
 import time
 from abc import ABC, abstractmethod
-from queue import Queue
+from queue import Queue, Empty
 from parlai.core.agents import Agent
 
 
@@ -21,6 +22,9 @@ class ChatServiceAgent(ABC, Agent):
         self.acted_packets = {}
         self.data = {}
         self.msg_queue = Queue()
+        # set whenever a message is queued; the world runner may replace it
+        # with an event shared by all agents in a world
+        self.message_event = threading.Event()
         self.observed_packets = {}
         self.message_request_time = None
         self.stored_data = {}
@@ -71,6 +75,7 @@ class ChatServiceAgent(ABC, Agent):
         if act_id not in self.acted_packets:
             self.acted_packets[act_id] = act_data
             self.msg_queue.put(action)
+            self.message_event.set()
 
     def set_stored_data(self):
         """Gets agent state data from manager."""
@@ -78,11 +83,19 @@ class ChatServiceAgent(ABC, Agent):
         if agent_state is not None and hasattr(agent_state, 'stored_data'):
             self.stored_data = agent_state.stored_data
 
-    def get_new_act_message(self):
-        """Get a new act message if one exists, return None otherwise."""
-        if not self.msg_queue.empty():
-            return self.msg_queue.get()
-        return None
+    def get_new_act_message(self, wait=0):
+        """Get a new act message if one exists, return None otherwise.
+
+        :param wait:
+            seconds to wait for a message to arrive, or None to wait until one
+            does
+        """
+        try:
+            if wait == 0:
+                return self.msg_queue.get_nowait()
+            return self.msg_queue.get(timeout=wait)
+        except Empty:
+            return None
 
     def act(self):
         """Pulls a message from the message queue. If none exist returns None."""
@@ -96,17 +109,22 @@ class ChatServiceAgent(ABC, Agent):
         return False
 
     def act_blocking(self, timeout=None):
-        """Repeatedly loop until we retrieve a message from the queue."""
-        while True:
-            if self.message_request_time is None:
-                self.message_request_time = time.time()
-            msg = self.act()
-            if msg is not None:
-                self.message_request_time = None
-                return msg
+        """Wait until we retrieve a message from the queue, or time out."""
+        if self.message_request_time is None:
+            self.message_request_time = time.time()
+        msg = self.act()
+        if msg is None:
             if self._check_timeout(timeout):
                 return None
-            time.sleep(0.2)
+            wait = None
+            if timeout:
+                elapsed = time.time() - self.message_request_time
+                wait = max(timeout - elapsed, 0)
+            msg = self.get_new_act_message(wait=wait)
+            if msg is None:
+                return None
+        self.message_request_time = None
+        return msg
 
     def episode_done(self):
         """Return whether or not this agent believes the conversation to
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Batch the bot's replies across conversations.
+
+Rather than every conversation world running its own copy of the bot one
+message at a time, a ``BotBatcher`` collects the pending messages of all active
+conversations and answers them with a single ``batch_act`` of the shared model.
+"""
+
+import threading
+import time
+from concurrent import futures
+from queue import Queue, Empty
+
+from parlai.core.agents import Agent, create_agent_from_shared
+from parlai.utils.misc import warn_once
+
+
+def create_bot(opt):
+    """
+    Create the bot for a new conversation.
+
+    Uses the manager's ``BotBatcher`` if batching is enabled, and an independent
+    copy of the shared bot otherwise.
+    """
+    if opt.get('bot_batcher') is not None:
+        return opt['bot_batcher'].create_bot()
+    return create_agent_from_shared(opt['shared_bot_params'])
+
+
+def setup_shared_bot(opt, model):
+    """
+    Share the bot with the conversation worlds, batching it if requested.
+
+    The worlds find the bot in ``opt``, and create theirs with ``create_bot``.
+
+    :param opt:
+        the manager's opt, passed on to the conversation worlds
+    :param model:
+        the agent used to reply in every conversation
+    """
+    opt['shared_bot_params'] = model.share()
+    if opt.get('bot_batch_size', 1) <= 1:
+        return
+    if not hasattr(model, 'batch_act'):
+        warn_once(
+            '{} does not implement batch_act, so --bot-batch-size is ignored.'.format(
+                model.getID()
+            )
+        )
+    else:
+        opt['bot_batcher'] = BotBatcher(
+            model, opt['bot_batch_size'], opt['bot_batch_timeout']
+        )
+
+
+def shutdown_shared_bot(opt):
+    """Stop batching the bot's replies, if we were."""
+    if opt.get('bot_batcher') is not None:
+        opt['bot_batcher'].shutdown()
+        opt['bot_batcher'] = None
+
+
+class BatchedBotAgent(Agent):
+    """
+    The bot of a single conversation, answered by a ``BotBatcher``.
+
+    Observations are processed by this conversation's own copy of the bot, so
+    it keeps its own history, while replies are computed in batches.
+    """
+
+    def __init__(self, batcher, bot):
+        self.id = bot.getID()
+        self.opt = bot.opt
+        super().__init__(bot.opt)
+        self.batcher = batcher
+        self.bot = bot
+
+    def observe(self, observation):
+        """Process the message with this conversation's copy of the bot."""
+        self.observation = self.bot.observe(observation)
+        return self.observation
+
+    def act(self):
+        """Wait for the reply to the last observation."""
+        reply = self.batcher.submit(self.observation).result()
+        if hasattr(self.bot, 'replies'):
+            # TorchAgents add their last reply to the history on the next
+            # observe, so hand this copy its reply from the batch
+            self.bot.replies['batch_reply'] = [reply]
+        return reply
+
+    def reset(self):
+        """Reset this conversation's copy of the bot."""
+        self.observation = None
+        self.bot.reset()
+
+    def shutdown(self):
+        """Shut down this conversation's copy of the bot."""
+        self.bot.shutdown()
+
+
+class BotBatcher(object):
+    """
+    Answer the messages of many conversations with one shared model.
+
+    A background thread waits for a message, then for up to ``timeout`` more
+    seconds for others to arrive, up to ``max_batch_size`` messages in all. It
+    then calls ``batch_act`` on the shared model, and hands each reply back to
+    the conversation that asked for it. With several workers, each thread
+    answers batches with its own copy of the model.
+
+    :param model: the shared bot. Must implement ``batch_act``.
+    :param int max_batch_size: maximum number of messages answered together.
+    :param float timeout: how long to wait for more messages, in seconds.
+    :param int num_workers: number of batches answered concurrently.
+    """
+
+    def __init__(self, model, max_batch_size, timeout, num_workers=1):
+        self.model = model
+        self.shared = model.share()
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.requests = Queue()
+        self.num_batches = 0
+        self.num_replies = 0
+        self._stats_lock = threading.Lock()
+        models = [model] + [
+            create_agent_from_shared(self.shared) for _ in range(num_workers - 1)
+        ]
+        self.threads = [
+            threading.Thread(target=self._run, args=(m,), daemon=True) for m in models
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def create_bot(self):
+        """Return the bot for a new conversation."""
+        return BatchedBotAgent(self, create_agent_from_shared(self.shared))
+
+    def submit(self, observation):
+        """
+        Request a reply to an observation.
+
+        :return: a Future, which resolves to the reply.
+        """
+        future = futures.Future()
+        self.requests.put((observation, future))
+        return future
+
+    def num_pending(self):
+        """Return the number of requests waiting for a worker."""
+        return self.requests.qsize()
+
+    def _next_batch(self):
+        """Wait for the next batch of requests, or None on shutdown."""
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.time() + self.timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except Empty:
+                break
+            if request is None:
+                # answer what we have, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self, model):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            observations = [observation for observation, _ in batch]
+            try:
+                replies = model.batch_act(observations)
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.num_batches += 1
+                self.num_replies += len(batch)
+            for (_, future), reply in zip(batch, replies):
+                future.set_result(reply)
+
+    def shutdown(self):
+        """Stop the batching threads, after answering pending requests."""
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -11,6 +11,7 @@ import threading
 import time
 import traceback
 from parlai.chat_service.core.agents import ChatServiceAgent
+from parlai.chat_service.core.batching import shutdown_shared_bot
 import parlai.chat_service.services.messenger.server_utils as server_utils
 import parlai.chat_service.services.messenger.shared_utils as shared_utils
 from parlai.chat_service.services.messenger.world_runner import MessengerWorldRunner
@@ -32,6 +33,7 @@ class AgentState:
         self.onboard_data = None
         self.stored_data = {}
         self.time_in_pool = {}
+        self.active_agent_change_condition = threading.Condition()
 
     def get_active_agent(self):
         """Return active messenger agent.
@@ -49,7 +51,25 @@ class AgentState:
             A MessengerAgent, the new active agent for this given agent state
 
         """
-        self.active_agent = active_agent
+        with self.active_agent_change_condition:
+            self.active_agent = active_agent
+            self.active_agent_change_condition.notify_all()
+
+    def wait_for_active_agent(self, predicate, timeout=None):
+        """Wait until the active agent satisfies the given predicate.
+
+        :param predicate:
+            function taking the active agent and returning a bool
+        :param timeout:
+            maximum number of seconds to wait, or None to wait indefinitely
+
+        :return:
+            whether the active agent satisfies the predicate
+        """
+        with self.active_agent_change_condition:
+            return self.active_agent_change_condition.wait_for(
+                lambda: predicate(self.active_agent), timeout
+            )
 
     def get_overworld_agent(self):
         """Return overworld messenger agent.
@@ -363,6 +383,7 @@ class ChatServiceManager(ABC):
             agent.time_in_pool.setdefault(world_type, time.time())
             # add agent to pool
             self.agent_pool.setdefault(world_type, []).append(agent)
+            self.agent_pool_change_condition.notify_all()
 
     def remove_agent_from_pool(self, agent, world_type='default', mark_removed=True):
         """Remove agent from the pool.
@@ -591,7 +612,9 @@ class ChatServiceManager(ABC):
                         future.add_done_callback(_done_callback)
                         self.active_worlds[task_id] = future
 
-            time.sleep(shared_utils.THREAD_MEDIUM_SLEEP)
+                # wait for agents to join a pool, still checking periodically
+                # for agents that have spent too long in one
+                self.agent_pool_change_condition.wait(shared_utils.THREAD_MEDIUM_SLEEP)
 
     def shutdown(self):
         """Handle any client shutdown cleanup."""
@@ -601,6 +624,7 @@ class ChatServiceManager(ABC):
             if not self.bypass_server_setup:
                 self.message_socket.keep_running = False
             self._expire_all_conversations()
+            shutdown_shared_bot(self.opt)
         except BaseException as e:
             shared_utils.print_and_log(logging.ERROR, f'world ended in error: {e}')
 
@@ -221,9 +221,15 @@ class ChatServiceWorldRunner:
         world = world_generator(self.opt, agents)
         task.world = world
 
+        # wake up as soon as any agent in the world sends a message, and check
+        # in periodically for worlds that do not wait on their agents
+        new_message = threading.Event()
+        for agent in agents:
+            agent.message_event = new_message
         while not world.episode_done() and not self.system_done:
+            new_message.clear()
             ret_val = world.parley()
-            time.sleep(0.3)
+            new_message.wait(0.3)
         world.shutdown()
         world_data = world.data if hasattr(world, "data") else {}
         return ret_val, world_data
@@ -288,9 +294,10 @@ class ChatServiceWorldRunner:
             )
             overworld = world_generator(self.opt, [overworld_agent])
             while not self.system_done:
+                overworld_agent.message_event.clear()
                 world_type = overworld.parley()
                 if world_type is None:
-                    time.sleep(0.5)
+                    overworld_agent.message_event.wait(0.5)
                     continue
 
                 # perform onboarding
@@ -304,11 +311,14 @@ class ChatServiceWorldRunner:
                     agent_state.onboard_data = onboard_data
                 self.manager.add_agent_to_pool(agent_state, world_type)
                 utils.print_and_log(logging.INFO, 'onboarding/overworld complete')
-                time.sleep(5)
 
-                # sleep until agent returns from task world
-                while agent_state.get_active_agent() != overworld_agent:
-                    time.sleep(2)
+                # wait for the agent to join a task world, then until it returns
+                agent_state.wait_for_active_agent(
+                    lambda agent: agent != overworld_agent, timeout=5
+                )
+                agent_state.wait_for_active_agent(
+                    lambda agent: agent == overworld_agent
+                )
                 overworld.return_overworld()
             return world_type
 
@@ -4,8 +4,9 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import threading
 import time
-from queue import Queue
+from queue import Queue, Empty
 
 from parlai.core.agents import Agent
 
@@ -25,6 +26,9 @@ class MessengerAgent(Agent):
         self.message_partners = []
         self.message_request_time = None
         self.msg_queue = Queue()
+        # set whenever a message is queued; the world runner may replace it
+        # with an event shared by all agents in a world
+        self.message_event = threading.Event()
         self.observed_packets = {}
         self.page_id = page_id
         self.task_id = task_id
@@ -95,6 +99,7 @@ class MessengerAgent(Agent):
                 action['image_url'] = message['message'].get('image_url')
                 action['attachment_url'] = message['message'].get('attachment_url')
             self.msg_queue.put(action)
+            self.message_event.set()
 
     def set_stored_data(self):
         """Gets agent state data from manager"""
@@ -102,11 +107,20 @@ class MessengerAgent(Agent):
         if agent_state is not None and hasattr(agent_state, 'stored_data'):
             self.stored_data = agent_state.stored_data
 
-    def get_new_act_message(self):
-        """Get a new act message if one exists, return None otherwise"""
+    def get_new_act_message(self, wait=0):
+        """Get a new act message if one exists, return None otherwise
+
+        :param wait:
+            seconds to wait for a message to arrive, or None to wait until one
+            does
+        """
         # Check if person has sent a message
-        if not self.msg_queue.empty():
-            return self.msg_queue.get()
+        try:
+            if wait == 0:
+                return self.msg_queue.get_nowait()
+            return self.msg_queue.get(timeout=wait)
+        except Empty:
+            pass
 
         # There are no messages to be sent
         if not self.active:
@@ -121,9 +135,15 @@ class MessengerAgent(Agent):
         # being inactive. Could be useful. Should return a message to be sent
         pass
 
-    def act(self, timeout=None):
+    def act(self, timeout=None, wait=0):
         """Pulls a message from the message queue. If none exist returns None
         unless the timeout has expired.
+
+        :param timeout:
+            seconds since the last message after which the agent is inactive
+        :param wait:
+            seconds to wait for a message to arrive, or None to wait until one
+            does or the timeout expires
         """
         # if this is the first act since last sent message start timing
         if self.message_request_time is None:
@@ -132,11 +152,15 @@ class MessengerAgent(Agent):
         # If checking timeouts
         if timeout:
             # If time is exceeded, timeout
-            if time.time() - self.message_request_time > timeout:
+            remaining = timeout - (time.time() - self.message_request_time)
+            if remaining < 0:
                 return self.mark_inactive()
+            # Don't wait past the timeout
+            if wait is None or wait > remaining:
+                wait = remaining
 
         # Get a new message, if it's not None reset the timeout
-        msg = self.get_new_act_message()
+        msg = self.get_new_act_message(wait=wait)
         if msg is not None:
             if msg.get('img_attempt') and not self.data.get('allow_images', False):
                 # Let agent know that they cannot send images if they
@@ -160,12 +184,13 @@ class MessengerAgent(Agent):
         return msg
 
     def act_blocking(self, timeout=None):
-        """Repeatedly loop until we retrieve a message from the queue"""
+        """Wait until we retrieve a message from the queue, or time out"""
         while True:
-            msg = self.act(timeout=timeout)
+            msg = self.act(timeout=timeout, wait=None)
             if msg is not None:
                 return msg
-            time.sleep(0.2)
+            if timeout and time.time() - self.message_request_time > timeout:
+                return None
 
     def episode_done(self):
         """Return whether or not this agent believes the conversation to
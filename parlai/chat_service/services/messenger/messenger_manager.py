@@ -18,6 +18,7 @@ import traceback
 import datetime
 
 from parlai.core.agents import create_agent
+from parlai.chat_service.core.batching import setup_shared_bot, shutdown_shared_bot
 from parlai.chat_service.services.messenger.agents import MessengerAgent
 from parlai.chat_service.services.messenger.message_socket import MessageSocket
 from parlai.chat_service.services.messenger.message_sender import MessageSender
@@ -43,6 +44,7 @@ class AgentState:
         self.onboard_data = None
         self.stored_data = {}
         self.time_in_pool = {}
+        self.active_agent_change_condition = threading.Condition()
 
     def get_active_agent(self):
         """Return active messenger agent.
@@ -60,7 +62,25 @@ class AgentState:
             A MessengerAgent, the new active agent for this given agent state
 
         """
-        self.active_agent = active_agent
+        with self.active_agent_change_condition:
+            self.active_agent = active_agent
+            self.active_agent_change_condition.notify_all()
+
+    def wait_for_active_agent(self, predicate, timeout=None):
+        """Wait until the active agent satisfies the given predicate.
+
+        :param predicate:
+            function taking the active agent and returning a bool
+        :param timeout:
+            maximum number of seconds to wait, or None to wait indefinitely
+
+        :return:
+            whether the active agent satisfies the predicate
+        """
+        with self.active_agent_change_condition:
+            return self.active_agent_change_condition.wait_for(
+                lambda: predicate(self.active_agent), timeout
+            )
 
     def get_overworld_agent(self):
         """Return overworld messenger agent.
@@ -196,7 +216,7 @@ class MessengerManager:
     def _load_model(self):
         """Load model if necessary."""
         if 'model_file' in self.opt or 'model' in self.opt:
-            self.opt['shared_bot_params'] = create_agent(self.opt).share()
+            setup_shared_bot(self.opt, create_agent(self.opt))
 
     def _init_logs(self):
         """Initialize logging settings from the opt."""
@@ -217,6 +237,7 @@ class MessengerManager:
             agent.time_in_pool.setdefault(world_type, time.time())
             # add agent to pool
             self.agent_pool.setdefault(world_type, []).append(agent)
+            self.agent_pool_change_condition.notify_all()
 
     def mark_removed(self, agent_id, pageid):
         """Mark the agent as removed from the pool.
@@ -730,7 +751,9 @@ class MessengerManager:
                         future.add_done_callback(_done_callback)
                         self.active_worlds[task_id] = future
 
-            time.sleep(shared_utils.THREAD_MEDIUM_SLEEP)
+                # wait for agents to join a pool, still checking periodically
+                # for agents that have spent too long in one
+                self.agent_pool_change_condition.wait(shared_utils.THREAD_MEDIUM_SLEEP)
 
     def shutdown(self):
         """Handle any client shutdown cleanup."""
@@ -741,6 +764,7 @@ class MessengerManager:
             if not self.bypass_server_setup:
                 self.message_socket.keep_running = False
             self._expire_all_conversations()
+            shutdown_shared_bot(self.opt)
         except BaseException as e:
             shared_utils.print_and_log(logging.ERROR, f'world ended in error: {e}')
 
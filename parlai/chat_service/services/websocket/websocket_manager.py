@@ -13,6 +13,7 @@ import logging
 import traceback
 import sys
 from parlai.core.agents import create_agent
+from parlai.chat_service.core.batching import setup_shared_bot, shutdown_shared_bot
 from parlai.chat_service.core.chat_service_manager import ChatServiceManager
 
 import parlai.chat_service.services.messenger.shared_utils as shared_utils
@@ -66,7 +67,7 @@ class WebsocketManager(ChatServiceManager):
     def _load_model(self):
         """Load model if necessary"""
         if 'model_file' in self.opt or 'model' in self.opt:
-            self.opt['shared_bot_params'] = create_agent(self.opt).share()
+            setup_shared_bot(self.opt, create_agent(self.opt))
 
     def _handle_message_read(self, event):
         """Send read receipt back to user who sent message
@@ -181,6 +182,7 @@ class WebsocketManager(ChatServiceManager):
         try:
             self.world_runner.shutdown()
             self._expire_all_conversations()
+            shutdown_shared_bot(self.opt)
         finally:
             pass
         tornado.ioloop.IOLoop.current().stop()
@@ -8,7 +8,7 @@
 
 from parlai.core.worlds import World
 from parlai.chat_service.services.messenger.worlds import OnboardWorld
-from parlai.core.agents import create_agent_from_shared
+from parlai.chat_service.core.batching import create_bot
 
 
 # ---------- Chatbot demo ---------- #
@@ -38,9 +38,7 @@ class MessengerBotChatTaskWorld(World):
     def generate_world(opt, agents):
         if opt['model'] is None and opt['model_file'] is None:
             raise RuntimeError("Model must be specified")
-        return MessengerBotChatTaskWorld(
-            opt, agents[0], create_agent_from_shared(opt['shared_bot_params'])
-        )
+        return MessengerBotChatTaskWorld(opt, agents[0], create_bot(opt))
 
     @staticmethod
     def assign_roles(agents):
@@ -8,12 +8,152 @@
 
 import parlai.core.build_data as build_data
 
+import atexit
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+import numpy as np
 from PIL import Image
 from zipfile import ZipFile
 
 _greyscale = '  .,:;crsA23hHG#98&@'
 _cache_size = 84000
+# how long to wait for concurrent requests to fill a batch for the CNN
+_batch_timeout = 0.01
+
+_zip_files = threading.local()
+_feature_stores = {}
+_feature_stores_lock = threading.Lock()
+
+
+def _open_zip(zipname):
+    """Return an open handle on the zip file, cached per thread."""
+    if not hasattr(_zip_files, 'handles'):
+        _zip_files.handles = {}
+    if zipname not in _zip_files.handles:
+        _zip_files.handles[zipname] = ZipFile(zipname, 'r')
+    return _zip_files.handles[zipname]
+
+
+def _open_image(path):
+    """Open the image at the given path, which may be inside a zip file."""
+    if '.zip' in path:
+        # assume format path/to/file.zip/image_name.jpg
+        sep = path.index('.zip') + 4
+        path = _open_zip(path[:sep]).open(path[sep + 1 :])
+    return Image.open(path).convert('RGB')
+
+
+def _transform_image(path, transform):
+    """Open and transform an image, in a decoding worker process."""
+    return transform(_open_image(path))
+
+
+def get_feature_store(path):
+    """Return the feature store at the given path, shared within the process."""
+    with _feature_stores_lock:
+        if path not in _feature_stores:
+            _feature_stores[path] = ImageFeatureStore(path)
+        return _feature_stores[path]
+
+
+def flush_feature_stores():
+    """Write the pending features of all open feature stores to disk."""
+    with _feature_stores_lock:
+        stores = list(_feature_stores.values())
+    for store in stores:
+        store.flush()
+
+
+atexit.register(flush_feature_stores)
+
+
+class ImageFeatureStore(object):
+    """
+    Store image features in a few large files, indexed by image id.
+
+    Features are collected in memory and written together as a numpy array in
+    ``chunk_<n>.npy`` once ``chunk_size`` of them are pending, and read back by
+    memory-mapping the chunk. ``index.txt`` maps each image id to its chunk and
+    row. A store should only be written to by a single process.
+
+    :param path: directory holding the store.
+    :param chunk_size: number of features written to each chunk.
+    """
+
+    def __init__(self, path, chunk_size=1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.index = {}
+        self.chunks = {}
+        self.pending = {}
+        build_data.make_dir(path)
+        index_path = os.path.join(path, 'index.txt')
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    image_id, chunk, row = line.rstrip('\n').split('\t')
+                    self.index[image_id] = (int(chunk), int(row))
+        # chunks written without an index entry are skipped
+        self.num_chunks = len(
+            [fn for fn in os.listdir(path) if fn.startswith('chunk_')]
+        )
+
+    def __contains__(self, image_id):
+        with self.lock:
+            return image_id in self.index or image_id in self.pending
+
+    def get(self, image_id):
+        """Return the feature of the given image, or None if not stored."""
+        with self.lock:
+            if image_id in self.pending:
+                return self.pending[image_id]
+            if image_id not in self.index:
+                return None
+            chunk, row = self.index[image_id]
+            if chunk not in self.chunks:
+                self.chunks[chunk] = np.load(self._chunk_path(chunk), mmap_mode='r')
+            features = self.chunks[chunk]
+        import torch
+
+        return torch.from_numpy(np.array(features[row]))
+
+    def add(self, image_id, feature):
+        """Add the feature of the given image to the store."""
+        with self.lock:
+            if image_id in self.index or image_id in self.pending:
+                return
+            self.pending[image_id] = feature.detach().cpu()
+            if len(self.pending) >= self.chunk_size:
+                self._write_chunk()
+
+    def flush(self):
+        """Write all pending features to disk."""
+        with self.lock:
+            if self.pending:
+                self._write_chunk()
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.path, 'chunk_{}.npy'.format(chunk))
+
+    def _write_chunk(self):
+        chunk = self.num_chunks
+        image_ids = list(self.pending.keys())
+        features = np.stack([self.pending[i].numpy() for i in image_ids])
+        tmp_path = os.path.join(self.path, 'tmp_chunk.npy')
+        np.save(tmp_path, features)
+        os.replace(tmp_path, self._chunk_path(chunk))
+        with open(os.path.join(self.path, 'index.txt'), 'a') as f:
+            for row, image_id in enumerate(image_ids):
+                f.write('{}\t{}\t{}\n'.format(image_id, chunk, row))
+                self.index[image_id] = (chunk, row)
+        self.num_chunks += 1
+        self.pending = {}
 
 
 class ImageLoader:
@@ -23,6 +163,12 @@ class ImageLoader:
         self.opt = opt.copy()
         self.use_cuda = False
         self.netCNN = None
+        self.extract_batchsize = opt.get('image_extract_batchsize', 1)
+        self.decode_workers = opt.get('image_decode_workers', 0)
+        self.use_feature_store = opt.get('image_feature_store', False)
+        self._decode_pool = None
+        self._batch_requests = None
+        self._extraction_lock = threading.Lock()
         self.im = opt.get('image_mode', 'no_image_model')
         if self.im not in ['no_image_model', 'raw', 'ascii']:
             if 'image_mode' not in opt or 'image_size' not in opt:
@@ -170,15 +316,96 @@ class ImageLoader:
             self.init_cnn(self.opt)
         # extract the image feature
         transform = self.transform(image).unsqueeze(0)
-        if self.use_cuda:
-            transform = transform.cuda()
-        with self.torch.no_grad():
-            feature = self.netCNN(transform)
+        feature = self._run_cnn(transform)
         # save the feature
         if path is not None:
             self.torch.save(feature.cpu(), path)
         return feature
 
+    def _run_cnn(self, images):
+        """Run the CNN on a batch of transformed images."""
+        if self.use_cuda:
+            images = images.cuda()
+        with self.torch.no_grad():
+            return self.netCNN(images)
+
+    def _extract_path(self, path):
+        """
+        Extract the feature of the image at the given path.
+
+        Images are decoded in ``--image-decode-workers`` processes if set, and
+        concurrent calls are run through the CNN together, in batches of up to
+        ``--image-extract-batchsize`` images.
+        """
+        with self._extraction_lock:
+            if self.decode_workers > 0 and self._decode_pool is None:
+                context = multiprocessing.get_context('spawn')
+                self._decode_pool = context.Pool(self.decode_workers)
+                # loaders are shared between teachers, so stop the workers at exit
+                atexit.register(self.shutdown)
+            if self.extract_batchsize > 1 and self._batch_requests is None:
+                self._batch_requests = Queue()
+                thread = threading.Thread(
+                    target=self._extract_batches,
+                    args=(self._batch_requests,),
+                    daemon=True,
+                )
+                thread.start()
+            decode_pool = self._decode_pool
+            batch_requests = self._batch_requests
+        if decode_pool is not None:
+            image = decode_pool.apply(_transform_image, (path, self.transform))
+        else:
+            image = _transform_image(path, self.transform)
+        if batch_requests is None:
+            return self._run_cnn(image.unsqueeze(0))
+        future = Future()
+        batch_requests.put((image, future))
+        return future.result()
+
+    def _extract_batches(self, requests):
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.time() + _batch_timeout
+            while len(batch) < self.extract_batchsize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = requests.get(timeout=remaining)
+                except Empty:
+                    break
+                if request is None:
+                    # answer this batch, then stop
+                    requests.put(None)
+                    break
+                batch.append(request)
+            try:
+                images = self.torch.stack([image for image, _ in batch])
+                features = self._run_cnn(images)
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                # copy, so each feature does not keep the whole batch alive, or
+                # save all of it when written to disk
+                future.set_result(features[i : i + 1].clone())
+
+    def shutdown(self):
+        """Stop the image decoding processes and the batching thread, if any."""
+        with self._extraction_lock:
+            if self._decode_pool is not None:
+                self._decode_pool.close()
+                self._decode_pool.join()
+                self._decode_pool = None
+            if self._batch_requests is not None:
+                self._batch_requests.put(None)
+                self._batch_requests = None
+
     def _img_to_ascii(self, path):
         im = Image.open(path)
         im.thumbnail((60, 40), Image.BICUBIC)
@@ -196,6 +423,7 @@ class ImageLoader:
         opt = self.opt
         mode = opt.get('image_mode', 'raw')
         is_zip = False
+        image_path = path
         if mode is None or mode == 'no_image_model':
             # don't need to load images
             return None
@@ -205,7 +433,7 @@ class ImageLoader:
             sep = path.index('.zip') + 4
             zipname = path[:sep]
             file_name = path[sep + 1 :]
-            path = ZipFile(zipname, 'r').open(file_name)
+            path = _open_zip(zipname).open(file_name)
             if opt['task'] != 'pytorch_teacher':
                 task = opt['task']
             else:
@@ -223,11 +451,24 @@ class ImageLoader:
             if not is_zip:
                 prepath, imagefn = os.path.split(path)
             dpath = os.path.join(prepath, mode)
-            if not os.path.exists(dpath):
-                build_data.make_dir(dpath)
             imagefn = imagefn.split('.')[0]
             new_path = os.path.join(prepath, mode, imagefn)
+            if self.use_feature_store:
+                store = get_feature_store(os.path.join(prepath, mode + '_store'))
+                feature = store.get(imagefn)
+                if feature is None:
+                    if os.path.isfile(new_path):
+                        # move features extracted in the old format over
+                        feature = self.torch.load(new_path)
+                    else:
+                        feature = self._extract_path(image_path)
+                    store.add(imagefn, feature)
+                return feature
+            if not os.path.exists(dpath):
+                build_data.make_dir(dpath)
             if not os.path.isfile(new_path):
-                return self.extract(Image.open(path).convert('RGB'), new_path)
+                feature = self._extract_path(image_path)
+                self.torch.save(feature.cpu(), new_path)
+                return feature
             else:
                 return self.torch.load(new_path)
@@ -13,30 +13,51 @@ between processes.
 from parlai.utils.thread import SharedTable
 from parlai.utils.misc import round_sigfigs, no_lock
 from collections import Counter
+from functools import lru_cache
 from parlai.utils.misc import warn_once
 from numbers import Number
 
+import multiprocessing
+import numpy as np
 import re
 
 DEFAULT_METRICS = {'correct', 'bleu-4', 'accuracy', 'f1'}
 ROUGE_METRICS = {'rouge-1', 'rouge-2', 'rouge-L'}
 BLEU_METRICS = {'bleu-1', 'bleu-2', 'bleu-3'}
 ALL_METRICS = DEFAULT_METRICS | ROUGE_METRICS | BLEU_METRICS
+# smoothing of BLEU n-gram precisions without any matches
+BLEU_SMOOTHING_EPSILON = 1e-12
 
 
-try:
-    from nltk.translate import bleu_score as nltkbleu
-except ImportError:
-    # User doesn't have nltk installed, so we can't use it for bleu
-    # We'll just turn off things, but we might want to warn the user
-    nltkbleu = None
+# nltk and py-rouge are slow to import, so they are imported on first use
+_rouge_available = True
+
+
+@lru_cache(maxsize=1)
+def _nltkbleu():
+    try:
+        from nltk.translate import bleu_score as nltkbleu
+    except ImportError:
+        # User doesn't have nltk installed, so we can't use it for bleu
+        # We'll just turn off things, but we might want to warn the user
+        nltkbleu = None
+    return nltkbleu
+
+
+@lru_cache(maxsize=1)
+def _rouge_module():
+    try:
+        import rouge
+    except ImportError:
+        # User doesn't have py-rouge installed, so we can't use it.
+        # We'll just turn off rouge computations
+        rouge = None
+    return rouge
+
+
+def _has_rouge():
+    return _rouge_available and _rouge_module() is not None
 
-try:
-    import rouge
-except ImportError:
-    # User doesn't have py-rouge installed, so we can't use it.
-    # We'll just turn off rouge computations
-    rouge = None
 
 re_art = re.compile(r'\b(a|an|the)\b')
 re_punc = re.compile(r'[!"#$%&()*+,-./:;<=>?@\[\]\\^`{|}~_\']')
@@ -148,6 +169,7 @@ def _f1_score(guess, answers):
 
 def _bleu(guess, answers, weights=None):
     """Compute approximate BLEU score between guess and a set of answers."""
+    nltkbleu = _nltkbleu()
     if nltkbleu is None:
         # bleu library not installed, just return a default value
         return None
@@ -163,28 +185,39 @@ def _bleu(guess, answers, weights=None):
     return nltkbleu.sentence_bleu(
         [normalize_answer(a).split(" ") for a in answers],
         normalize_answer(guess).split(" "),
-        smoothing_function=nltkbleu.SmoothingFunction(epsilon=1e-12).method1,
+        smoothing_function=nltkbleu.SmoothingFunction(
+            epsilon=BLEU_SMOOTHING_EPSILON
+        ).method1,
         weights=weights,
     )
 
 
+@lru_cache(maxsize=1)
+def _rouge_evaluator():
+    return _rouge_module().Rouge(metrics=['rouge-n', 'rouge-l'], max_n=2)
+
+
 def _rouge(guess, answers):
-    global rouge
     """Compute ROUGE score between guess and *any* answers. Return the best."""
-    if rouge is None:
+    if not _has_rouge():
         return None, None, None
-    evaluator = rouge.Rouge(metrics=['rouge-n', 'rouge-l'], max_n=2)
+    return _normalized_rouge(
+        normalize_answer(guess), [normalize_answer(a) for a in answers]
+    )
+
+
+def _normalized_rouge(guess, answers):
+    """Compute the best ROUGE scores of already normalized strings."""
+    global _rouge_available
+    evaluator = _rouge_evaluator()
     try:
-        scores = [
-            evaluator.get_scores(normalize_answer(guess), normalize_answer(a))
-            for a in answers
-        ]
+        scores = [evaluator.get_scores(guess, a) for a in answers]
     except LookupError:
         warn_once(
             'ROUGE requires nltk punkt tokenizer. Please run '
             '`python -c "import nltk; nltk.download(\'punkt\')`'
         )
-        rouge = None
+        _rouge_available = False
         return None, None, None
 
     scores_rouge1 = [score['rouge-1']['r'] for score in scores]
@@ -193,6 +226,220 @@ def _rouge(guess, answers):
     return max(scores_rouge1), max(scores_rouge2), max(scores_rougeL)
 
 
+def _count_ngrams(tokens, lengths, max_n):
+    """
+    Count the n-grams of each sentence in a batch.
+
+    :param tokens: int array with the token ids of all sentences, concatenated.
+    :param lengths: int array with the number of tokens in each sentence.
+    :param max_n: count n-grams up to this order.
+
+    :return: for each order n, a tuple ``(sents, grams, counts)`` of arrays
+        giving how often the n-gram with id ``grams[i]`` occurs in sentence
+        ``sents[i]``, sorted by sentence and n-gram id.
+    """
+    starts = np.cumsum(lengths) - lengths
+    sents = np.repeat(np.arange(len(lengths)), lengths)
+    # number of tokens from each position to the end of its sentence
+    remaining = np.repeat(starts + lengths, lengths) - np.arange(len(tokens))
+    num_tokens = int(tokens.max()) + 1 if len(tokens) else 1
+    gram_ids = np.zeros_like(tokens)
+    result = []
+    for n in range(1, max_n + 1):
+        pos = np.flatnonzero(remaining >= n)
+        if n == 1:
+            keys = tokens
+        else:
+            # extend the (n-1)-gram at each position with the next token
+            keys = gram_ids[pos] * num_tokens + tokens[pos + n - 1]
+        # renumber n-grams densely, so the ids of longer ones stay small
+        unique, dense = np.unique(keys, return_inverse=True)
+        num_grams = max(len(unique), 1)
+        gram_ids[pos] = dense
+        pairs, counts = np.unique(sents[pos] * num_grams + dense, return_counts=True)
+        result.append((pairs // num_grams, pairs % num_grams, counts))
+    return result
+
+
+def _lookup_counts(keys, counts, queries):
+    """Return the count of each query in sorted ``keys``, or 0 if missing."""
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=counts.dtype)
+    idx = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[idx] == queries, counts[idx], 0)
+
+
+def score_batch(predictions, labels, candidates=None, metrics_list=DEFAULT_METRICS):
+    """
+    Score a batch of predictions against their labels.
+
+    Computes the same scores as ``_exact_match``, ``_f1_score``, ``_bleu`` and
+    ``_rouge`` for each example, and the hits@k of the ranked candidates, but
+    normalizes each distinct string of the batch only once, and counts the
+    n-grams of all examples together.
+
+    :param predictions: list with the predicted text of each example, or None.
+    :param labels: list with the true labels of each example.
+    :param candidates: list with the ranked text candidates of each example,
+        or None.
+    :param metrics_list: which of the text metrics to compute.
+
+    :return: dict of the summed scores, and their counts, over the batch, with
+        the same keys as the counters of ``Metrics``.
+    """
+    if candidates is None:
+        candidates = [None] * len(predictions)
+    normalized = {}
+
+    def normalize(text):
+        if text not in normalized:
+            normalized[text] = normalize_answer(text)
+        return normalized[text]
+
+    scores = Counter({'cnt': len(predictions)})
+
+    # ranking metrics
+    eval_pr = Metrics.eval_pr
+    for cands, labs in zip(candidates, labels):
+        if cands is None:
+            continue
+        label_set = set(normalize(l) for l in labs)
+        rank = next(
+            (i for i, c in enumerate(cands, 1) if normalize(c) in label_set), None
+        )
+        for k in eval_pr:
+            if rank is not None and rank <= k:
+                scores['hits@' + str(k)] += 1
+        scores['hits@_cnt'] += 1
+
+    # text metrics, for examples with a prediction
+    examples = [i for i, p in enumerate(predictions) if p is not None]
+    if not examples:
+        return scores
+    guesses = [normalize(predictions[i]) for i in examples]
+    answers = [[normalize(l) for l in labels[i]] for i in examples]
+    scores['correct_cnt'] = len(examples)
+    scores['correct'] = sum(g in set(a) for g, a in zip(guesses, answers))
+
+    if 'rouge-L' in metrics_list and _has_rouge():
+        for guess, answer in zip(guesses, answers):
+            if not answer:
+                continue
+            rouge1, rouge2, rougeL = _normalized_rouge(guess, answer)
+            if rouge1 is None:
+                break
+            for k, v in (('rouge-1', rouge1), ('rouge-2', rouge2), ('rouge-L', rougeL)):
+                scores[k] += v
+                scores[k + '_cnt'] += 1
+
+    bleu_orders = []
+    if 'bleu-1' in metrics_list:
+        bleu_orders += [1, 2, 3]
+    if 'bleu-4' in metrics_list:
+        bleu_orders.append(4)
+    if not bleu_orders and 'f1' not in metrics_list:
+        return scores
+    max_n = max(bleu_orders + [1])
+    num_examples = len(examples)
+    for k in bleu_orders:
+        scores['bleu-{}_cnt'.format(k)] = num_examples
+    if 'f1' in metrics_list:
+        scores['f1_cnt'] = num_examples
+    # without any labels, the example scores zero
+    scored = [j for j in range(num_examples) if answers[j]]
+    if not scored:
+        return scores
+
+    # sentences are the guesses of the scored examples, then all their answers.
+    # like _bleu, split on single spaces, so empty strings have one token
+    sentences = [guesses[j] for j in scored]
+    owner = list(range(len(scored)))
+    for e, j in enumerate(scored):
+        sentences += answers[j]
+        owner += [e] * len(answers[j])
+    vocab = {}
+    split = [s.split(' ') for s in sentences]
+    tokens = np.array(
+        [vocab.setdefault(t, len(vocab)) for toks in split for t in toks],
+        dtype=np.int64,
+    )
+    lengths = np.array([len(toks) for toks in split], dtype=np.int64)
+    # length without the token of empty strings, as for _f1_score
+    word_lengths = np.array([len(s) and len(toks) for s, toks in zip(sentences, split)])
+    owner = np.array(owner, dtype=np.int64)
+    num_guesses = len(scored)
+    num_answers = len(sentences) - num_guesses
+    # index of the first answer of each example
+    answer_starts = np.flatnonzero(
+        np.r_[True, owner[num_guesses + 1 :] != owner[num_guesses:-1]]
+    )
+
+    numerators = np.zeros((num_guesses, max_n))
+    for n, (sents, grams, counts) in enumerate(
+        _count_ngrams(tokens, lengths, max_n), 1
+    ):
+        is_guess = sents < num_guesses
+        num_grams = int(grams.max()) + 1 if len(grams) else 1
+        guess_keys = sents[is_guess] * num_grams + grams[is_guess]
+        guess_counts = counts[is_guess]
+        answer_sents = sents[~is_guess]
+        answer_keys = owner[answer_sents] * num_grams + grams[~is_guess]
+        answer_counts = counts[~is_guess]
+
+        # clip the count of each n-gram of a guess by its count in any answer
+        unique_keys, inverse = np.unique(answer_keys, return_inverse=True)
+        max_counts = np.zeros(len(unique_keys), dtype=np.int64)
+        np.maximum.at(max_counts, inverse, answer_counts)
+        clipped = np.minimum(
+            guess_counts, _lookup_counts(unique_keys, max_counts, guess_keys)
+        )
+        numerators[:, n - 1] = np.bincount(
+            sents[is_guess], clipped, minlength=num_guesses
+        )
+
+        if n == 1 and 'f1' in metrics_list:
+            # words each answer has in common with its guess
+            common = np.minimum(
+                answer_counts, _lookup_counts(guess_keys, guess_counts, answer_keys)
+            )
+            common = np.bincount(
+                answer_sents - num_guesses, common, minlength=num_answers
+            )
+            guess_words = word_lengths[owner[num_guesses:]]
+            answer_words = word_lengths[num_guesses:]
+            common[(guess_words == 0) | (answer_words == 0)] = 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                precision = 1.0 * common / guess_words
+                recall = 1.0 * common / answer_words
+                f1 = np.where(
+                    common > 0, (2 * precision * recall) / (precision + recall), 0
+                )
+            scores['f1'] = float(np.maximum.reduceat(f1, answer_starts).sum())
+
+    if bleu_orders:
+        guess_lengths = lengths[:num_guesses]
+        answer_lengths = lengths[num_guesses:]
+        # closest answer length, preferring the shorter on ties
+        distance = np.abs(answer_lengths - guess_lengths[owner[num_guesses:]])
+        closest = np.minimum.reduceat(
+            distance * (answer_lengths.max() + 1) + answer_lengths, answer_starts
+        ) % (answer_lengths.max() + 1)
+        brevity = np.where(
+            guess_lengths > closest, 1.0, np.exp(1 - closest / guess_lengths)
+        )
+        denominators = np.maximum(1, guess_lengths[:, None] - np.arange(max_n))
+        # smooth precisions without matches like SmoothingFunction.method1
+        precisions = (
+            np.where(numerators > 0, numerators, BLEU_SMOOTHING_EPSILON) / denominators
+        )
+        log_precisions = np.log(precisions)
+        for k in bleu_orders:
+            bleu = brevity * np.exp((log_precisions[:, :k] * (1 / k)).sum(axis=1))
+            bleu[numerators[:, 0] == 0] = 0
+            scores['bleu-{}'.format(k)] = float(bleu.sum())
+    return scores
+
+
 def aggregate_metrics(reporters):
     """Aggregate metrics from multiple reports."""
     # reporters is a list of teachers or worlds
@@ -235,8 +482,73 @@ def aggregate_metrics(reporters):
     return m
 
 
+def merge_metric_states(states):
+    """
+    Merge raw metric counters, e.g. collected over disjoint shards of a dataset.
+
+    Numbers and Counters are summed, booleans are or-ed and dicts are merged
+    recursively. Any other value is taken from the first state which has it.
+
+    :param states: list of metric dicts, as in ``Metrics.state_dict()`` or the
+        ``metrics`` dicts of TorchAgents. ``None`` entries are ignored.
+
+    :return: the merged dict, or None if there was nothing to merge.
+    """
+    states = [s for s in states if s is not None]
+    if not states:
+        return None
+    merged = {}
+    for state in states:
+        for k, v in state.items():
+            if k not in merged:
+                merged[k] = v
+            elif isinstance(v, bool):
+                merged[k] = merged[k] or v
+            elif isinstance(v, Counter):
+                merged[k] = merged[k] + v
+            elif isinstance(v, dict):
+                merged[k] = merge_metric_states([merged[k], v])
+            elif isinstance(v, Number):
+                merged[k] = merged[k] + v
+    return merged
+
+
+def get_metrics_states(world):
+    """Return the raw metric counters of each agent in the world."""
+    states = []
+    for a in world.get_agents():
+        metrics = getattr(a, 'metrics', None)
+        if isinstance(metrics, Metrics):
+            states.append(metrics.state_dict())
+        elif isinstance(metrics, dict):
+            states.append(dict(metrics))
+        else:
+            states.append(None)
+    return states
+
+
+def load_metrics_states(world, states):
+    """Replace the metric counters of each agent in the world."""
+    for a, state in zip(world.get_agents(), states):
+        if state is None:
+            continue
+        if isinstance(a.metrics, Metrics):
+            a.metrics.load_state_dict(state)
+        else:
+            a.metrics.update(state)
+
+
 class Metrics(object):
-    """Class that maintains evaluation metrics over dialog."""
+    """
+    Class that maintains evaluation metrics over dialog.
+
+    Examples are scored in batches of up to ``batchsize``, and all examples
+    seen so far are scored before the metrics are reported. With
+    ``--metrics-workers``, batches are scored in background processes.
+    """
+
+    eval_pr = [1, 5, 10, 100]
+    batchsize = 128
 
     def __init__(self, opt):
         self.metrics = {}
@@ -253,12 +565,9 @@ class Metrics(object):
             optional_metrics_list.add('correct')
         for each_m in optional_metrics_list:
             if each_m.startswith('rouge'):
-                if rouge is not None:
+                if _has_rouge():
                     # only compute rouge if rouge is available
                     self.metrics_list.add(each_m)
-            elif each_m == 'bleu' and nltkbleu is None:
-                # only compute bleu if bleu is available
-                pass
             else:
                 self.metrics_list.add(each_m)
         self._print_metrics_list = (
@@ -269,14 +578,26 @@ class Metrics(object):
         for k in self._print_metrics_list:
             self.metrics[k] = 0.0
             self.metrics[k + '_cnt'] = 0
-        self.eval_pr = [1, 5, 10, 100]
         for k in self.eval_pr:
             self.metrics['hits@' + str(k)] = 0
         self.metrics['hits@_cnt'] = 0
         self.flags = {'has_text_cands': False, 'print_prediction_metrics': False}
+        # examples waiting to be scored, and batches being scored by workers
+        self._pending = []
+        self._results = []
+        self._workers = None
+        self._num_workers = opt.get('metrics_workers', 0)
         if opt.get('numthreads', 1) > 1:
             self.metrics = SharedTable(self.metrics)
             self.flags = SharedTable(self.flags)
+            # the other processes can't score examples pending in this one
+            self.batchsize = 1
+            self._num_workers = 0
+
+    def __del__(self):
+        # any batches still being scored are no longer needed
+        if getattr(self, '_workers', None) is not None:
+            self._workers.terminate()
 
     def __str__(self):
         return str(self.metrics)
@@ -293,85 +614,26 @@ class Metrics(object):
             # otherwise do nothing
             return no_lock()
 
-    def _update_ranking_metrics(self, observation, labels):
-        text_cands = observation.get('text_candidates', None)
-        if text_cands is None:
-            return
-        else:
-            # Now loop through text candidates, assuming they are sorted.
-            # If any of them is a label then score a point.
-            # maintain hits@1, 5, 10, 50, 100,  etc.
-            label_set = set(normalize_answer(l) for l in labels)
-            cnts = {k: 0 for k in self.eval_pr}
-            cnt = 0
-            for c in text_cands:
-                cnt += 1
-                if normalize_answer(c) in label_set:
-                    for k in self.eval_pr:
-                        if cnt <= k:
-                            cnts[k] += 1
-            # hits metric is 1 if cnts[k] > 0.
-            # (other metrics such as p@k and r@k take
-            # the value of cnt into account.)
-            with self._lock():
-                self.flags['has_text_cands'] = True
-                for k in self.eval_pr:
-                    if cnts[k] > 0:
-                        self.metrics['hits@' + str(k)] += 1
-                self.metrics['hits@_cnt'] += 1
-
     def update(self, observation, labels):
-        """Update metrics based on an observation and true labels."""
-        with self._lock():
-            self.metrics['cnt'] += 1
-
-        # Exact match metric.
-        correct = 0
-        prediction = observation.get('text', None)
-        if prediction is not None:
-            if _exact_match(prediction, labels):
-                correct = 1
-            with self._lock():
-                self.flags['print_prediction_metrics'] = True
-                self.metrics['correct'] += correct
-                self.metrics['correct_cnt'] += 1
-
-            # F1 and BLEU metrics.
-            if 'f1' in self.metrics_list:
-                f1 = _f1_score(prediction, labels)
-            bleu_scores = {}
-            rouge1 = rouge2 = rougeL = None
-            if 'bleu-4' in self.metrics_list:
-                bleu_scores['bleu-4'] = _bleu(prediction, labels)
-            if 'bleu-1' in self.metrics_list:
-                for i in range(3):
-                    weights = [1 / (i + 1) for _ in range(i + 1)]
-                    bleu_scores[f'bleu-{i + 1}'] = _bleu(prediction, labels, weights)
-            if 'rouge-L' in self.metrics_list:
-                rouge1, rouge2, rougeL = _rouge(prediction, labels)
-            with self._lock():
-                if 'f1' in self.metrics:
-                    self.metrics['f1'] += f1
-                    self.metrics['f1_cnt'] += 1
-                if 'bleu-4' in self.metrics:
-                    self.metrics['bleu-4'] += bleu_scores.pop('bleu-4')
-                    self.metrics['bleu-4_cnt'] += 1
-                if 'bleu-1' in self.metrics:
-                    for b, b_score in bleu_scores.items():
-                        self.metrics[b] += b_score
-                        self.metrics[f'{b}_cnt'] += 1
-                if 'rouge-L' in self.metrics and rouge1 is not None:
-                    self.metrics['rouge-1'] += rouge1
-                    self.metrics['rouge-1_cnt'] += 1
-                    self.metrics['rouge-2'] += rouge2
-                    self.metrics['rouge-2_cnt'] += 1
-                    self.metrics['rouge-L'] += rougeL
-                    self.metrics['rouge-L_cnt'] += 1
-
-        # Ranking metrics.
-        self._update_ranking_metrics(observation, labels)
-
-        # User-reported metrics
+        """
+        Update metrics based on an observation and true labels.
+
+        The text of the observation is scored later, with the rest of its batch.
+        """
+        self._pending.append(
+            (observation.get('text'), labels, observation.get('text_candidates'))
+        )
+        self._update_custom_metrics(observation)
+        if len(self._pending) >= self.batchsize:
+            self._flush()
+
+    def batch_update(self, observations, labels):
+        """Update metrics based on a batch of observations and their labels."""
+        for observation, example_labels in zip(observations, labels):
+            self.update(observation, example_labels)
+
+    def _update_custom_metrics(self, observation):
+        """Add the metrics reported by the model in the observation."""
         if 'metrics' in observation:
             for k, v in observation['metrics'].items():
                 if k not in ALL_METRICS and k != 'rouge':
@@ -392,15 +654,45 @@ class Metrics(object):
                             else:
                                 self.metrics[k] += v
 
-        # Return a dict containing the metrics for this specific example.
-        # Metrics across all data is stored internally in the class, and
-        # can be accessed with the report method.
-        loss = {}
-        loss['correct'] = correct
-        return loss
+    def _flush(self):
+        """Score the pending examples, or hand them to a worker."""
+        # add the scores of batches the workers have finished
+        while self._results and self._results[0].ready():
+            self._add_scores(self._results.pop(0).get())
+        if not self._pending:
+            return
+        predictions, labels, candidates = zip(*self._pending)
+        self._pending = []
+        args = (predictions, labels, candidates, self.metrics_list)
+        if self._num_workers > 0:
+            if self._workers is None:
+                # spawn, rather than fork, since the model may use threads
+                context = multiprocessing.get_context('spawn')
+                self._workers = context.Pool(self._num_workers)
+            self._results.append(self._workers.apply_async(score_batch, args))
+        else:
+            self._add_scores(score_batch(*args))
+
+    def _sync(self):
+        """Wait until all examples seen so far have been scored."""
+        self._flush()
+        while self._results:
+            self._add_scores(self._results.pop(0).get())
+
+    def _add_scores(self, scores):
+        """Add the scores of a batch to the metrics."""
+        with self._lock():
+            for k, v in scores.items():
+                if k in self.metrics:
+                    self.metrics[k] += v
+            if scores.get('correct_cnt'):
+                self.flags['print_prediction_metrics'] = True
+            if scores.get('hits@_cnt'):
+                self.flags['has_text_cands'] = True
 
     def report(self):
         """Report the metrics over all data seen so far."""
+        self._sync()
         m = {}
         total = self.metrics['cnt']
         m['exs'] = total
@@ -428,9 +720,36 @@ class Metrics(object):
                     )
         return m
 
+    def state_dict(self):
+        """
+        Return a copy of the raw counters behind ``report()``.
+
+        Counters from several Metrics can be combined with
+        ``merge_metric_states``, and loaded back with ``load_state_dict``.
+        """
+        self._sync()
+        with self._lock():
+            return {
+                'metrics': {k: self.metrics[k] for k in self.metrics},
+                'flags': {k: self.flags[k] for k in self.flags},
+            }
+
+    def load_state_dict(self, state):
+        """Replace the raw counters with those from ``state_dict()``."""
+        self._sync()
+        with self._lock():
+            for k, v in state['metrics'].items():
+                if k not in self.metrics and k + '_cnt' in state['metrics']:
+                    # custom metric reported by the model
+                    self.metrics_list.add(k)
+                self.metrics[k] = v
+            for k, v in state['flags'].items():
+                self.flags[k] = v
+
     def clear(self):
         """Clear all the metrics."""
         # TODO: rename to reset for consistency with rest of ParlAI
+        self._sync()
         with self._lock():
             self.metrics['cnt'] = 0
             metrics_list = (
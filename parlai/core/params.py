@@ -8,14 +8,13 @@
 import argparse
 import importlib
 import os
+import pickle
 import sys as _sys
 import datetime
 import parlai
-import git
+from collections.abc import KeysView
 
-from parlai.core.agents import get_agent_module, get_task_module
 from parlai.core.build_data import modelzoo_path
-from parlai.tasks.tasks import ids_to_tasks
 from parlai.utils.misc import Opt, load_opt_file
 
 from typing import List, Optional
@@ -23,6 +22,9 @@ from typing import List, Optional
 
 def print_git_commit():
     """Print the current git commit of ParlAI and parlai_internal."""
+    # git is slow to import, and only needed here
+    import git
+
     root = os.path.dirname(os.path.dirname(parlai.__file__))
     internal_root = os.path.join(root, 'parlai_internal')
     try:
@@ -168,6 +170,104 @@ def fix_underscores(args):
     return args
 
 
+class _ArgRecording(object):
+    """The calls made on a parser while an agent or task adds its arguments."""
+
+    # methods that add arguments, which can be replayed later
+    RECORDED_METHODS = {
+        'add_argument',
+        'add_arg',
+        'add_argument_group',
+        'add_mutually_exclusive_group',
+        'set_defaults',
+    }
+    GROUP_METHODS = {'add_argument_group', 'add_mutually_exclusive_group'}
+
+    def __init__(self):
+        self.calls = []
+        self.num_groups = 0
+        # anything which depends on more than these calls cannot be replayed
+        self.cacheable = True
+
+
+class _RecordingParser(object):
+    """
+    Stand-in for a parser or argument group, which records calls made on it.
+
+    Passed to ``add_cmdline_args`` in place of the parser, so that the
+    arguments added can be replayed from the argument registry without
+    importing the module again.
+    """
+
+    def __init__(self, target, recording, target_id=0):
+        self._target = target
+        self._recording = recording
+        self._target_id = target_id
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in _ArgRecording.RECORDED_METHODS:
+            self._recording.cacheable = False
+            return attr
+
+        def record(*args, **kwargs):
+            recording = self._recording
+            saved = dict(kwargs)
+            if isinstance(saved.get('choices'), (dict, KeysView)):
+                # only the keys are used, and the values are often classes
+                # which would have to be imported again to load the registry
+                saved['choices'] = list(saved['choices'])
+            recording.calls.append((self._target_id, name, args, saved))
+            try:
+                result = attr(*args, **kwargs)
+            except argparse.ArgumentError:
+                recording.cacheable = False
+                raise
+            if name in _ArgRecording.GROUP_METHODS:
+                recording.num_groups += 1
+                return _RecordingParser(result, recording, recording.num_groups)
+            return result
+
+        return record
+
+
+def _module_mtimes(objects=()):
+    """
+    Return the modification time of the modules arguments may depend on.
+
+    These are all ParlAI modules imported so far, and the modules defining the
+    given classes and their parents, which may live outside of ParlAI.
+    """
+    parlai_root = os.path.dirname(os.path.dirname(parlai.__file__))
+    modules = [
+        m
+        for m in list(_sys.modules.values())
+        if getattr(m, '__file__', None) and m.__file__.startswith(parlai_root)
+    ]
+    for obj in objects:
+        for cls in getattr(obj, '__mro__', [obj]):
+            module = _sys.modules.get(getattr(cls, '__module__', None))
+            if getattr(module, '__file__', None):
+                modules.append(module)
+    mtimes = {}
+    for module in modules:
+        try:
+            mtimes[module.__file__] = os.stat(module.__file__).st_mtime_ns
+        except OSError:
+            pass
+    return mtimes
+
+
+def _mtimes_match(mtimes):
+    for filename, mtime in mtimes.items():
+        try:
+            if os.stat(filename).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
 class CustomHelpFormatter(argparse.ArgumentDefaultsHelpFormatter):
     """
     Produce a custom-formatted `--help` option.
@@ -476,6 +576,21 @@ class ParlaiParser(argparse.ArgumentParser):
             default=None,
             help='Require a password for entry to the bot',
         )
+        args.add_argument(
+            '--bot-batch-size',
+            type=int,
+            default=1,
+            help='Answer the messages of up to this many conversations with a '
+            'single batch_act of the shared bot. 1 disables batching.',
+        )
+        args.add_argument(
+            '--bot-batch-timeout',
+            type=float,
+            default=0.01,
+            help='Seconds to wait for messages from other conversations before '
+            'answering a partial batch.',
+            hidden=True,
+        )
 
     def add_websockets_args(self):
         """Add websocket arguments."""
@@ -620,13 +735,57 @@ class ParlaiParser(argparse.ArgumentParser):
             type=int,
             help='batch size for minibatch training schemes',
         )
+        parlai.add_argument(
+            '--max-tokens-per-batch',
+            default=-1,
+            type=int,
+            help='If > 0, group examples of similar length into batches of up to '
+            'this many tokens (examples x longest example, counting text and '
+            'label tokens), so that the batch size varies with the length of '
+            'the examples. --batchsize is then the maximum number of examples in '
+            'a batch, and examples are chosen from 4 x --batchsize conversations.',
+        )
+        parlai.add_argument(
+            '--preprocess-workers',
+            default=0,
+            type=int,
+            help='If > 0, read and vectorize the training data and build batches '
+            'in this many background processes, while the model trains on '
+            'previous batches. Requires a TorchAgent.',
+        )
+        parlai.add_argument(
+            '--preprocess-queue-size',
+            default=8,
+            type=int,
+            help='Maximum number of batches prepared ahead by --preprocess-workers.',
+            hidden=True,
+        )
+        parlai.add_argument(
+            '--lazy-load',
+            default=False,
+            type='bool',
+            help='Read the episodes of ParlAI-format and FB-format data files from '
+            'disk when they are needed, rather than loading the whole file into '
+            'memory. An index of the episodes is saved next to the data file the '
+            'first time it is read.',
+        )
+        parlai.add_argument(
+            '--lazy-load-cache-size',
+            default=1024,
+            type=int,
+            help='Number of episodes kept in memory with --lazy-load.',
+            hidden=True,
+        )
         self.add_parlai_data_path(parlai)
 
     def add_distributed_training_args(self):
         """Add CLI args for distributed training."""
         grp = self.add_argument_group('Distributed Training')
         grp.add_argument(
-            '--distributed-world-size', type=int, help='Number of workers.'
+            '--distributed-world-size',
+            type=int,
+            help='Number of workers. Defaults to the number of GPUs, or of core '
+            'groups when training on CPU.',
         )
         grp.add_argument(
             '--verbose',
@@ -635,6 +794,14 @@ class ParlaiParser(argparse.ArgumentParser):
             help='All workers print output.',
             hidden=True,
         )
+        grp.add_argument(
+            '--distributed-cores-per-worker',
+            type=int,
+            default=4,
+            help='When training on CPU, the number of cores each worker is pinned '
+            'to. Defaults --distributed-world-size to the number of cores '
+            'divided by this.',
+        )
         return grp
 
     def add_pytorch_datateacher_args(self):
@@ -677,6 +844,18 @@ class ParlaiParser(argparse.ArgumentParser):
             'the pytorch data',
             hidden=True,
         )
+        pytorch.add_argument(
+            '--pytorch-data-format',
+            type=str,
+            choices=['json', 'binary'],
+            default='json',
+            help='Format to build the pytorch data in. binary stores the '
+            'vectorized examples as flat token arrays which are memory-mapped '
+            'when training, so the data is not parsed or tokenized again; it '
+            'implies --pytorch-preprocess, and is rebuilt whenever the '
+            'dictionary or tokenizer change',
+            hidden=True,
+        )
         pytorch.add_argument(
             '-pybsrt',
             '--pytorch-teacher-batch-sort',
@@ -767,31 +946,117 @@ class ParlaiParser(argparse.ArgumentParser):
 
     def add_model_subargs(self, model):
         """Add arguments specific to a particular model."""
+        self._add_registered_args(('model', model), self._add_model_subargs, model)
+
+    def _add_model_subargs(self, parser, model):
+        from parlai.core.agents import get_agent_module
+
         agent = get_agent_module(model)
         try:
             if hasattr(agent, 'add_cmdline_args'):
-                agent.add_cmdline_args(self)
+                agent.add_cmdline_args(parser)
         except argparse.ArgumentError:
             # already added
             pass
         try:
             if hasattr(agent, 'dictionary_class'):
                 s = class2str(agent.dictionary_class())
-                self.set_defaults(dict_class=s)
+                parser.set_defaults(dict_class=s)
         except argparse.ArgumentError:
             # already added
             pass
+        return agent
 
     def add_task_args(self, task):
         """Add arguments specific to the specified task."""
+        from parlai.tasks.tasks import ids_to_tasks
+
         for t in ids_to_tasks(task).split(','):
-            agent = get_task_module(t)
+            self._add_registered_args(('task', t), self._add_task_args, t)
+
+    def _add_task_args(self, parser, task):
+        from parlai.core.agents import get_task_module
+
+        agent = get_task_module(task)
+        try:
+            if hasattr(agent, 'add_cmdline_args'):
+                agent.add_cmdline_args(parser)
+        except argparse.ArgumentError:
+            # already added
+            pass
+        return agent
+
+    def _registry_path(self):
+        # the registry caches code rather than data, so it is kept out of both
+        # the data path and the source tree
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(
+            os.path.join('~', '.cache')
+        )
+        return os.path.join(cache_dir, 'parlai', 'arg_registry.pkl')
+
+    def _load_registry(self):
+        try:
+            with open(self._registry_path(), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # missing, or written by a different version of the code
+            return {}
+
+    def _add_registered_args(self, key, add_args, name):
+        """
+        Add the arguments of a model or task, replaying them if registered.
+
+        Finding the arguments of a model or task means importing its module,
+        and often those of torch and its other dependencies. Instead, the calls
+        its ``add_cmdline_args`` makes on the parser are saved in a registry in
+        the user's cache directory, and replayed as long as none of the modules
+        they may depend on have changed since.
+
+        :param key: the registry key, e.g. ``('model', 'seq2seq')``.
+        :param add_args: called with the parser and ``name`` to add the
+            arguments, returns the model or task class.
+        :param name: the model or task name.
+        """
+        # several checkouts of ParlAI may share the cache
+        key = (self.parlai_home,) + key
+        if not hasattr(self, '_arg_registry'):
+            self._arg_registry = self._load_registry()
+        entry = self._arg_registry.get(key)
+        if entry is not None and _mtimes_match(entry['mtimes']):
+            groups = [self]
             try:
-                if hasattr(agent, 'add_cmdline_args'):
-                    agent.add_cmdline_args(self)
+                for target_id, method, args, kwargs in entry['calls']:
+                    result = getattr(groups[target_id], method)(*args, **kwargs)
+                    if method in _ArgRecording.GROUP_METHODS:
+                        groups.append(result)
             except argparse.ArgumentError:
                 # already added
                 pass
+            return
+
+        recording = _ArgRecording()
+        cls = add_args(_RecordingParser(self, recording), name)
+        if not recording.cacheable:
+            return
+        entry = {'calls': recording.calls, 'mtimes': _module_mtimes([cls])}
+        self._arg_registry[key] = entry
+        try:
+            # merge with entries saved by other processes since we loaded
+            registry = self._load_registry()
+            registry[key] = entry
+            data = pickle.dumps(registry)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            # the arguments use types which cannot be saved
+            return
+        try:
+            path = self._registry_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
 
     def add_pyt_dataset_args(self, opt):
         """Add arguments specific to specified pytorch dataset."""
@@ -824,6 +1089,31 @@ class ParlaiParser(argparse.ArgumentParser):
                 help='crop dimension for images',
                 hidden=True,
             )
+            parlai.add_argument(
+                '--image-extract-batchsize',
+                type=int,
+                default=1,
+                help='Maximum number of images run through the CNN together '
+                'when extracting features. Images requested concurrently by '
+                'the data loading threads are batched up to this size.',
+                hidden=True,
+            )
+            parlai.add_argument(
+                '--image-decode-workers',
+                type=int,
+                default=0,
+                help='Number of processes decoding and transforming images '
+                'for feature extraction. 0 decodes in the loading thread.',
+                hidden=True,
+            )
+            parlai.add_argument(
+                '--image-feature-store',
+                type='bool',
+                default=False,
+                help='Keep extracted features in a single chunked store per '
+                'image mode rather than in one file per image.',
+                hidden=True,
+            )
         except argparse.ArgumentError:
             # already added
             pass
@@ -13,11 +13,16 @@ http://parl.ai/docs/tutorial_worlds.html#multiprocessed-pytorch-dataloader
 
 from .teachers import FixedDialogTeacher
 from parlai.utils.misc import warn_once
-from parlai.scripts.build_pytorch_data import build_data
+from parlai.scripts.build_pytorch_data import (
+    build_data,
+    BINARY_VEC_FIELDS,
+    BINARY_CANDS_FIELD,
+)
+from parlai.utils.memmap import MemmapStrings, MemmapTexts, MemmapVectors
 from .agents import get_agent_module
 import json
 import math
-import collections
+import collections.abc
 import random
 import os
 from functools import wraps
@@ -32,6 +37,7 @@ from torch.utils.data import ConcatDataset, Dataset, DataLoader, sampler
 from torch.multiprocessing import Lock, Value
 import ctypes
 from threading import Thread, Condition, RLock
+import numpy as np
 
 
 if torch.version.__version__.startswith('0.'):
@@ -284,8 +290,10 @@ def ep_length(val):
         return 1
     if isinstance(val, str):
         return len(val.replace('\n', ' ').split(' '))
-    if isinstance(val, (collections.Mapping, collections.Sequence, torch.Tensor)):
-        if isinstance(val, collections.Mapping) and val.get(
+    if isinstance(
+        val, (collections.abc.Mapping, collections.abc.Sequence, torch.Tensor)
+    ):
+        if isinstance(val, collections.abc.Mapping) and val.get(
             'deserialized_tensor', False
         ):
             return len(val['value'])
@@ -307,7 +315,9 @@ def get_dataset_classes(opt):
     not need to specify its name following the colon; e.g., it
     would just be: ``-pytd vqa_v1``
     """
-    if 'stream' in opt.get('datatype'):
+    if opt.get('pytorch_data_format') == 'binary':
+        default_dataset = BinaryDataset
+    elif 'stream' in opt.get('datatype'):
         default_dataset = StreamDataset
     else:
         default_dataset = ParlAIDataset
@@ -583,6 +593,103 @@ class ParlAIDataset(Dataset):
         return self.num_exs
 
 
+class BinaryDataset(Dataset):
+    """
+    A Pytorch Dataset of pre-tokenized examples, for random sampling.
+
+    Reads data built with ``--pytorch-data-format binary``. The vectors of each
+    example are views of the memory-mapped token arrays, so they are neither
+    parsed nor tokenized, and only the examples which are used are read.
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.datatype = opt.get('datatype')
+        self.datapath = build_data(self.opt)
+        self.length_datafile = os.path.join(self.datapath, 'data_length')
+        self.training = self.datatype.startswith('train')
+        self._load_lens()
+        self._setup_data()
+
+    def __getitem__(self, index):
+        ex = {}
+        for field, (values, mask) in self.values.items():
+            if mask[index]:
+                ex[field] = values[index].item()
+        for field, texts in self.texts.items():
+            if field in self.rows:
+                start, end = self.rows[field][index]
+                if start >= 0:
+                    ex[field] = texts[start:end]
+            else:
+                text = texts[index]
+                if text is not None:
+                    ex[field] = text
+        fields = self.fields[index]
+        if fields:
+            ex.update(json.loads(fields))
+        for field, vecs in self.vecs.items():
+            vec = vecs[index]
+            if vec is not None:
+                ex[field] = vec
+        start, end = self.cand_rows[index]
+        if start >= 0:
+            ex[BINARY_CANDS_FIELD] = self.cands[start:end]
+        return index, ex
+
+    def __len__(self):
+        return self.num_episodes()
+
+    def _load_lens(self):
+        with open(self.length_datafile) as length:
+            lengths = json.load(length)
+            self.num_eps = lengths['num_eps']
+            self.num_exs = lengths['num_exs']
+
+    def _path(self, name):
+        return os.path.join(self.datapath, name)
+
+    def _load_rows(self, field):
+        return np.load(self._path(field + '.rows'), mmap_mode='r')
+
+    def _setup_data(self):
+        with open(self._path('columns')) as f:
+            columns = json.load(f)
+        self.values = {}
+        self.texts = {}
+        self.rows = {}
+        for field, kind in columns.items():
+            name = 'column.' + field
+            if kind in ('str', 'strs'):
+                self.texts[field] = MemmapTexts(
+                    self._path(name), self._path(name + '.offsets')
+                )
+                if kind == 'strs':
+                    self.rows[field] = self._load_rows(name)
+            else:
+                self.values[field] = (
+                    np.load(self._path(name + '.values'), mmap_mode='r'),
+                    np.load(self._path(name + '.mask'), mmap_mode='r'),
+                )
+        self.fields = MemmapStrings(self._path('fields'), self._path('fields.offsets'))
+        self.vecs = {
+            field: MemmapVectors(self._path(field), self._path(field + '.offsets'))
+            for field in BINARY_VEC_FIELDS
+        }
+        self.cands = MemmapVectors(
+            self._path(BINARY_CANDS_FIELD), self._path(BINARY_CANDS_FIELD + '.offsets')
+        )
+        self.cand_rows = self._load_rows(BINARY_CANDS_FIELD)
+
+    def num_episodes(self):
+        """Return the number of episodes."""
+        return self.num_eps
+
+    def num_examples(self):
+        """Return the number of examples."""
+        return self.num_exs
+
+
 class ParlAIConcatDataset(ConcatDataset):
     """Override to set num_eps and num_exs."""
 
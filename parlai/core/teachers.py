@@ -27,8 +27,10 @@ This module provides a set of teachers that deal with dialog.
      See the class description for more details.
 
 This module also includes ``DataLoader``, a threadpool data loader for
-``FixedDialogTeacher``, and ``DialogData``/``StreamDialogData``, data
-structures for accessing textual dialog data and utilized by ``DialogTeacher``
+``FixedDialogTeacher``, and ``DialogData``/``StreamDialogData``/
+``IndexedDialogData``, data structures for accessing textual dialog data and
+utilized by ``DialogTeacher``. ``PackedEpisodes`` stores the data of a
+``DialogData`` in shared memory for hogwild training.
 """
 
 from parlai.core.agents import Teacher
@@ -41,7 +43,7 @@ from abc import abstractmethod
 
 import concurrent.futures
 import multiprocessing
-from multiprocessing import Value, Lock
+from multiprocessing import Value, Lock, RawArray
 from threading import Thread
 import queue
 import random
@@ -51,6 +53,7 @@ import os
 import torch
 import json
 import argparse
+import numpy as np
 
 
 class DataLoader(Thread):
@@ -175,6 +178,11 @@ class FixedDialogTeacher(Teacher):
         self.batchindex = opt.get('batchindex', 0)
         self.use_batch_act = False  # Batch act disabled by default
 
+        # when evaluating in several processes, only visit every num_shards-th
+        # episode, starting at shard_id
+        self.num_shards = opt.get('num_shards', 1)
+        self.shard_id = opt.get('shard_id', 0)
+
     def _lock(self):
         if hasattr(self.index, 'get_lock'):
             return self.index.get_lock()
@@ -260,6 +268,8 @@ class FixedDialogTeacher(Teacher):
                 if loop:
                     self.index.value %= num_eps
                 new_idx = self.index.value
+            if self.num_shards > 1:
+                new_idx = new_idx * self.num_shards + self.shard_id
         return new_idx
 
     def next_example(self):
@@ -285,7 +295,8 @@ class FixedDialogTeacher(Teacher):
         if (
             not self.random
             and self.episode_done
-            and self.episode_idx + self.opt.get("batchsize", 1) >= self.num_episodes()
+            and self.episode_idx + self.opt.get("batchsize", 1) * self.num_shards
+            >= self.num_episodes()
         ):
             epoch_done = True
         else:
@@ -432,8 +443,14 @@ class DialogTeacher(FixedDialogTeacher):
     In order to subclass this class, you must implement ``setup_data()`` in
     your class (or subclass another class which does, like
     ``FbDialogTeacher``), which reads your data file as an iterator.
+
+    Teachers which set ``lazy_load`` must also implement ``scan_episodes()``
+    and ``setup_episode()``, and their data is then read from disk on demand
+    with an ``IndexedDialogData``.
     """
 
+    lazy_load = False
+
     def __init__(self, opt, shared=None):
         # Check for setup_data
         if not hasattr(self, 'setup_data'):
@@ -453,12 +470,18 @@ class DialogTeacher(FixedDialogTeacher):
             # first initialize any shared objects
             data_class = StreamDialogData if self.stream else DialogData
             kwargs = {'cycle': self.training} if self.stream else {}
+            data_loader = self.setup_data
+            if self.lazy_load and not self.stream:
+                # read episodes from disk when they are requested
+                data_class = IndexedDialogData
+                kwargs = {'scan_fn': self.scan_episodes}
+                data_loader = self.setup_episode
             if shared and shared.get('data'):
                 self.data = data_class(opt, shared=shared['data'], **kwargs)
             else:
                 self.data = data_class(
                     opt,
-                    data_loader=self.setup_data,
+                    data_loader=data_loader,
                     cands=self.label_candidates(),
                     **kwargs,
                 )
@@ -572,6 +595,12 @@ class DialogData(object):
             self.image_loader = ImageLoader(opt)
             self.data = []
             self._load(data_loader, opt['datafile'])
+            if opt.get('numthreads', 1) > 1 and isinstance(self.data, list):
+                # keep hogwild processes from each copying the data
+                try:
+                    self.data = PackedEpisodes(self.data)
+                except TypeError as e:
+                    warn_once('Could not pack the data in shared memory: {}'.format(e))
             self.cands = None if cands is None else set(sys.intern(c) for c in cands)
         self.addedCands = []
         self.copied_cands = False
@@ -748,6 +777,213 @@ class DialogData(object):
         return table
 
 
+class PackedEpisodes(object):
+    """
+    Stores the episodes of a ``DialogData`` compactly, in shared memory.
+
+    ``DialogData`` normally keeps its episodes as tuples of entries, which are
+    tuples of strings. Processes forked for hogwild training share these
+    objects, but updating their reference counts gradually copies every one of
+    them into each process. Instead, this stores each distinct string once in
+    a single buffer, and the fields of each entry as columns of offsets into
+    it, all in shared memory. Episodes and entries are only built when they
+    are requested.
+
+    Supports ``len()``, iteration and indexing like the list of episodes it
+    replaces.
+
+    :param episodes:
+        the episodes, in the format built by ``DialogData``.
+    """
+
+    # kinds of rewards and label candidates
+    NONE, INT, FLOAT, BOOL, STR, TUPLE = range(6)
+
+    def __init__(self, episodes):
+        string_ids = {}
+        strings = []
+
+        def string_id(s):
+            if s is None:
+                return -1
+            if s not in string_ids:
+                string_ids[s] = len(strings)
+                strings.append(s.encode('utf-8', 'surrogatepass'))
+            return string_ids[s]
+
+        items = []
+
+        def span(values):
+            start = len(items)
+            items.extend(string_id(v) for v in values)
+            return start, len(items)
+
+        episode_offsets = [0]
+        columns = {
+            name: []
+            for name in [
+                'entry_len',
+                'text',
+                'labels_start',
+                'labels_end',
+                'reward_kind',
+                'reward',
+                'cands_kind',
+                'cands_start',
+                'cands_end',
+                'image',
+            ]
+        }
+        for episode in episodes:
+            for entry in episode:
+                entry_len = len(entry)
+                text, labels, reward, cands, image = tuple(entry) + (None,) * (
+                    5 - entry_len
+                )
+                labels_start, labels_end = (-1, -1) if labels is None else span(labels)
+                reward_kind, reward = self._pack_value(reward, string_id)
+                if cands is None:
+                    cands_kind, cands_start, cands_end = self.NONE, -1, -1
+                elif isinstance(cands, str):
+                    # 'same as last time'
+                    cands_kind, cands_start, cands_end = self.STR, string_id(cands), -1
+                else:
+                    cands_kind = self.TUPLE
+                    cands_start, cands_end = span(cands)
+                row = {
+                    'entry_len': entry_len,
+                    'text': string_id(text),
+                    'labels_start': labels_start,
+                    'labels_end': labels_end,
+                    'reward_kind': reward_kind,
+                    'reward': reward,
+                    'cands_kind': cands_kind,
+                    'cands_start': cands_start,
+                    'cands_end': cands_end,
+                    'image': string_id(image),
+                }
+                for name, value in row.items():
+                    columns[name].append(value)
+            episode_offsets.append(len(columns['text']))
+
+        dtypes = {'entry_len': np.int8, 'reward_kind': np.int8, 'cands_kind': np.int8}
+        dtypes['reward'] = np.float64
+        for name, values in columns.items():
+            setattr(self, name, self._share(values, dtypes.get(name, np.int64)))
+        self.episode_offsets = self._share(episode_offsets, np.int64)
+        self.items = self._share(items, np.int64)
+        self.string_offsets = self._share(
+            np.cumsum([0] + [len(s) for s in strings]), np.int64
+        )
+        self.chars = self._share(np.frombuffer(b''.join(strings), np.uint8), np.uint8)
+
+    @staticmethod
+    def _share(values, dtype):
+        """Copy values into a numpy array in shared memory."""
+        values = np.asarray(values, dtype=dtype)
+        raw = RawArray('b', max(values.nbytes, 1))
+        array = np.frombuffer(raw, dtype=dtype, count=len(values))
+        array[:] = values
+        return array
+
+    def _pack_value(self, value, string_id):
+        # entries record the type of their reward, so it comes back unchanged
+        if value is None:
+            return self.NONE, 0
+        elif isinstance(value, bool):
+            return self.BOOL, value
+        elif isinstance(value, int):
+            return self.INT, value
+        elif isinstance(value, float):
+            return self.FLOAT, value
+        elif isinstance(value, str):
+            return self.STR, string_id(value)
+        raise TypeError('Cannot pack rewards of type {}'.format(type(value)))
+
+    def _string(self, string_id):
+        if string_id < 0:
+            return None
+        start, end = self.string_offsets[string_id : string_id + 2]
+        return self.chars[start:end].tobytes().decode('utf-8', 'surrogatepass')
+
+    def _strings(self, start, end):
+        return tuple(self._string(i) for i in self.items[start:end])
+
+    def entry(self, idx):
+        """Build the entry with the given index, counting from the first episode."""
+        entry_len = self.entry_len[idx]
+        entry = [self._string(self.text[idx])]
+        if entry_len > 1:
+            if self.labels_start[idx] < 0:
+                entry.append(None)
+            else:
+                entry.append(
+                    self._strings(self.labels_start[idx], self.labels_end[idx])
+                )
+        if entry_len > 2:
+            kind, reward = self.reward_kind[idx], self.reward[idx]
+            if kind == self.NONE:
+                entry.append(None)
+            elif kind == self.BOOL:
+                entry.append(bool(reward))
+            elif kind == self.INT:
+                entry.append(int(reward))
+            elif kind == self.FLOAT:
+                entry.append(float(reward))
+            else:
+                entry.append(self._string(int(reward)))
+        if entry_len > 3:
+            kind = self.cands_kind[idx]
+            if kind == self.NONE:
+                entry.append(None)
+            elif kind == self.STR:
+                entry.append(self._string(self.cands_start[idx]))
+            else:
+                entry.append(self._strings(self.cands_start[idx], self.cands_end[idx]))
+        if entry_len > 4:
+            entry.append(self._string(self.image[idx]))
+        return tuple(entry[:entry_len])
+
+    def __len__(self):
+        return len(self.episode_offsets) - 1
+
+    def __getitem__(self, episode_idx):
+        """Return a view of the episode, which builds entries when indexed."""
+        if episode_idx < 0:
+            episode_idx += len(self)
+        if not 0 <= episode_idx < len(self):
+            raise IndexError('episode index out of range')
+        start, end = self.episode_offsets[episode_idx : episode_idx + 2]
+        return PackedEpisode(self, int(start), int(end))
+
+    def __iter__(self):
+        for episode_idx in range(len(self)):
+            yield self[episode_idx]
+
+
+class PackedEpisode(object):
+    """An episode of ``PackedEpisodes``, indexed like a tuple of entries."""
+
+    def __init__(self, packed, start, end):
+        self.packed = packed
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, entry_idx):
+        if entry_idx < 0:
+            entry_idx += len(self)
+        if not 0 <= entry_idx < len(self):
+            raise IndexError('entry index out of range')
+        return self.packed.entry(self.start + entry_idx)
+
+    def __iter__(self):
+        for entry_idx in range(len(self)):
+            yield self[entry_idx]
+
+
 class StreamDialogData(DialogData):
     """
     Provides a data structure for streaming textual dialog data.
@@ -923,6 +1159,149 @@ class StreamDialogData(DialogData):
         return self.data
 
 
+class IndexedEpisodeFile(object):
+    """
+    Provides random access to the episodes of a dialog file on disk.
+
+    The file is scanned once, and the byte offset, byte length and number of
+    examples of each of its episodes are saved to an index next to it, in
+    ``<path>.<name>.index.npy``. Episodes are then read by seeking to their
+    offset and parsing only them, and the most recently used episodes are kept
+    in an LRU cache. The index is memory-mapped, so processes working with the
+    same file share it rather than each holding a copy of the data.
+
+    The index is rebuilt whenever the data file changes.
+
+    :param path:
+        the data file.
+    :param name:
+        name of the file format, to tell apart indexes of the same file.
+    :param scan_fn:
+        called with the data file opened in binary mode. It should yield an
+        ``(offset, length, num_examples)`` tuple for each episode in the file.
+    :param parse_fn:
+        called with the text of an episode, returns the parsed episode.
+    :param cache_size:
+        number of parsed episodes to keep in memory.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, name, scan_fn, parse_fn, cache_size=1024):
+        self.path = path
+        self.index_path = '{}.{}.index.npy'.format(path, name)
+        self.parse_fn = parse_fn
+        self.index = self._load_index(scan_fn)
+        self.num_exs = int(self.index[1:, 2].sum())
+        self._get_episode = lru_cache(maxsize=cache_size)(self._read_episode)
+
+    def _header(self):
+        stat = os.stat(self.path)
+        return [self.VERSION, stat.st_size, stat.st_mtime_ns]
+
+    def _load_index(self, scan_fn):
+        """Load the index of the data file, building it if necessary."""
+        header = self._header()
+        if os.path.isfile(self.index_path):
+            index = np.load(self.index_path, mmap_mode='r')
+            if index.ndim == 2 and list(index[0]) == header:
+                return index
+
+        print('[building episode index: ' + self.index_path + ']')
+        with open(self.path, 'rb') as read:
+            episodes = list(scan_fn(read))
+        index = np.array([header] + episodes, dtype=np.int64).reshape(-1, 3)
+        try:
+            # write to a temporary file first, so that processes building the
+            # same index at once never read a partial one
+            tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+            with open(tmp_path, 'wb') as write:
+                np.save(write, index)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            warn_once(
+                'Could not save the episode index of {}, it will be rebuilt next '
+                'time: {}'.format(self.path, e)
+            )
+            return index
+        return np.load(self.index_path, mmap_mode='r')
+
+    def _read_episode(self, episode_idx):
+        offset, length, _ = self.index[episode_idx + 1]
+        with open(self.path, 'rb') as read:
+            read.seek(int(offset))
+            text = read.read(int(length)).decode('utf-8')
+        return self.parse_fn(text)
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, episode_idx):
+        """Return the parsed episode, reading it from disk if it isn't cached."""
+        if episode_idx < 0:
+            episode_idx += len(self)
+        if not 0 <= episode_idx < len(self):
+            raise IndexError('episode index out of range')
+        return self._get_episode(episode_idx)
+
+    def __iter__(self):
+        for episode_idx in range(len(self)):
+            yield self[episode_idx]
+
+    def num_examples(self):
+        """Return the number of examples in the file."""
+        return self.num_exs
+
+
+class IndexedDialogData(DialogData):
+    """
+    Provides random access to textual dialog data too large to load up front.
+
+    Episodes are read from disk on demand with an ``IndexedEpisodeFile``,
+    rather than all being loaded into memory at startup.
+
+    :param opt:
+        options to initialize the class
+    :param data_loader:
+        as for ``DialogData``, but called with the lines of a single episode
+        rather than with the path of the data file.
+    :param scan_fn:
+        called with the data file opened in binary mode, yields an
+        ``(offset, length, num_examples)`` tuple for each episode in the file.
+        See ``IndexedEpisodeFile``.
+    :param cands:
+        can be set to provide a list of candidate labels for every example in
+        this dataset.
+    """
+
+    def __init__(
+        self, opt, data_loader=None, cands=None, shared=None, scan_fn=None, **kwargs
+    ):
+        self.data_loader = data_loader
+        self.scan_fn = scan_fn
+        self.cache_size = opt.get('lazy_load_cache_size', 1024)
+        super().__init__(opt, data_loader, cands, shared, **kwargs)
+
+    def _load(self, data_loader, datafile):
+        """Index the data file, episodes are loaded when requested."""
+        self.data = IndexedEpisodeFile(
+            datafile,
+            'dialog',
+            self.scan_fn,
+            self._parse_episode,
+            cache_size=self.cache_size,
+        )
+
+    def _parse_episode(self, text):
+        for episode in self._read_episode(self.data_loader(text.split('\n'))):
+            return episode
+        return ()
+
+    def num_examples(self):
+        """Return total number of entries available."""
+        return self.data.num_examples()
+
+
 class FbDialogTeacher(DialogTeacher):
     """
     This module provides access to data in the Facebook Dialog format.
@@ -986,6 +1365,14 @@ class FbDialogTeacher(DialogTeacher):
     def __init__(self, opt, shared=None):
         self.opt = opt
         self.cloze = opt.get('cloze', False)
+        if opt.get('lazy_load', False):
+            if type(self).setup_data is FbDialogTeacher.setup_data:
+                self.lazy_load = True
+            else:
+                warn_once(
+                    '{} reads its data with its own setup_data, so --lazy-load is '
+                    'ignored.'.format(type(self).__name__)
+                )
         if shared and 'cands' in shared:
             self.cands = shared['cands']
         else:
@@ -1072,86 +1459,136 @@ class FbDialogTeacher(DialogTeacher):
         """
         print("[loading fbdialog data:" + path + "]")
         with open(path) as read:
-            start = True
-            x = ''
-            reward = 0
-            last_conv_id = None
-            for line in read:
-                line = line.strip().replace('\\n', '\n')
-                if len(line) == 0:
-                    # empty response
-                    continue
+            yield from self.setup_episode(read)
 
-                # first, get conversation index -- '1' means start of episode
-                space_idx = line.find(' ')
-                if space_idx == -1:
-                    # empty line, both individuals are saying whitespace
-                    conv_id = int(line)
+    def setup_episode(self, lines):
+        """
+        Read lines in the fbdialog format.
+
+        Returns the same tuples as ``setup_data()``, from an iterable over the
+        lines of one or more episodes rather than from a file.
+        """
+        start = True
+        x = ''
+        reward = 0
+        last_conv_id = None
+        for line in lines:
+            line = line.strip().replace('\\n', '\n')
+            if len(line) == 0:
+                # empty response
+                continue
+
+            # first, get conversation index -- '1' means start of episode
+            space_idx = line.find(' ')
+            if space_idx == -1:
+                # empty line, both individuals are saying whitespace
+                conv_id = int(line)
+            else:
+                conv_id = int(line[:space_idx])
+
+            # split line into constituent parts, if available:
+            # x<tab>y<tab>reward<tab>label_candidates
+            # where y, reward, and label_candidates are optional
+            split = line[space_idx + 1 :].split('\t')
+
+            # remove empty items and strip each one
+            for i in range(len(split)):
+                word = split[i].strip()
+                if len(word) == 0:
+                    split[i] = ''
                 else:
-                    conv_id = int(line[:space_idx])
-
-                # split line into constituent parts, if available:
-                # x<tab>y<tab>reward<tab>label_candidates
-                # where y, reward, and label_candidates are optional
-                split = line[space_idx + 1 :].split('\t')
-
-                # remove empty items and strip each one
-                for i in range(len(split)):
-                    word = split[i].strip()
-                    if len(word) == 0:
-                        split[i] = ''
-                    else:
-                        split[i] = word
-                # Empty reward string same as None
-                if len(split) > 2 and split[2] == '':
-                    split[2] = None
-
-                # now check if we're at a new episode
-                if last_conv_id is None or conv_id <= last_conv_id:
-                    x = x.strip()
-                    if x:
-                        yield [x, None, reward], start
-                    start = True
-                    reward = 0
-                    # start a new episode
-                    if self.cloze:
-                        x = 'Fill in the blank in the last sentence.\n{x}'.format(
-                            x=split[0]
-                        )
-                    else:
-                        x = split[0]
+                    split[i] = word
+            # Empty reward string same as None
+            if len(split) > 2 and split[2] == '':
+                split[2] = None
+
+            # now check if we're at a new episode
+            if last_conv_id is None or conv_id <= last_conv_id:
+                x = x.strip()
+                if x:
+                    yield [x, None, reward], start
+                start = True
+                reward = 0
+                # start a new episode
+                if self.cloze:
+                    x = 'Fill in the blank in the last sentence.\n{x}'.format(
+                        x=split[0]
+                    )
                 else:
-                    if x:
-                        # otherwise add current x to what we have so far
-                        x = '{x}\n{next_x}'.format(x=x, next_x=split[0])
-                    else:
-                        x = split[0]
+                    x = split[0]
+            else:
+                if x:
+                    # otherwise add current x to what we have so far
+                    x = '{x}\n{next_x}'.format(x=x, next_x=split[0])
+                else:
+                    x = split[0]
+            last_conv_id = conv_id
+            if len(split) > 2 and split[2]:
+                reward += float(split[2])
+
+            if len(split) > 1 and split[1]:
+                # only generate an example if we have a y
+                split[0] = x
+                # split labels
+                split[1] = split[1].split('|')
+                if len(split) > 3:
+                    # split label_candidates
+                    split[3] = split[3].split('|')
+                if len(split) > 2:
+                    split[2] = reward
+                else:
+                    split.append(reward)
+                if start:
+                    yield split, True
+                    start = False
+                else:
+                    yield split, False
+                # reset x in case there is unlabeled data still left
+                x = ''
+                reward = 0
+        if x:
+            yield [x, None, reward], start
+
+    def scan_episodes(self, read):
+        """
+        Find the episodes of a file in the fbdialog format, for lazy loading.
+
+        :param read:
+            the data file, opened in binary mode.
+
+        :return:
+            yields an ``(offset, length, num_examples)`` tuple for each episode.
+        """
+        offset = 0
+        start = None
+        lines = []
+        last_conv_id = None
+        for line in read:
+            text = line.decode('utf-8')
+            stripped = text.strip()
+            if stripped:
+                space_idx = stripped.find(' ')
+                if space_idx == -1:
+                    conv_id = int(stripped)
+                else:
+                    conv_id = int(stripped[:space_idx])
+                if last_conv_id is not None and conv_id <= last_conv_id:
+                    # episodes without any examples are dropped, as when loading
+                    # the whole file
+                    num_exs = sum(1 for _ in self.setup_episode(lines))
+                    if num_exs > 0:
+                        yield start, offset - start, num_exs
+                    start = None
+                    lines = []
+                if start is None:
+                    start = offset
                 last_conv_id = conv_id
-                if len(split) > 2 and split[2]:
-                    reward += float(split[2])
-
-                if len(split) > 1 and split[1]:
-                    # only generate an example if we have a y
-                    split[0] = x
-                    # split labels
-                    split[1] = split[1].split('|')
-                    if len(split) > 3:
-                        # split label_candidates
-                        split[3] = split[3].split('|')
-                    if len(split) > 2:
-                        split[2] = reward
-                    else:
-                        split.append(reward)
-                    if start:
-                        yield split, True
-                        start = False
-                    else:
-                        yield split, False
-                    # reset x in case there is unlabeled data still left
-                    x = ''
-                    reward = 0
-            if x:
-                yield [x, None, reward], start
+                lines.append(text)
+            offset += len(line)
+        if start is not None:
+            num_exs = sum(1 for _ in self.setup_episode(lines))
+            if num_exs > 0:
+                yield start, offset - start, num_exs
 
 
 class ParlAIDialogTeacher(FixedDialogTeacher):
@@ -1221,7 +1658,10 @@ class ParlAIDialogTeacher(FixedDialogTeacher):
                 self._setup_data(opt.get('parlaidialogteacher_datafile'))
         else:
             self.episodes = shared['episodes']
-            self.num_exs = sum(len(e) for e in self.episodes)
+            if 'num_exs' in shared:
+                self.num_exs = shared['num_exs']
+            else:
+                self.num_exs = sum(len(e) for e in self.episodes)
         self.id = opt.get('parlaidialogteacher_datafile', 'teacher')
         self.reset()
 
@@ -1229,6 +1669,7 @@ class ParlAIDialogTeacher(FixedDialogTeacher):
         """Share the episodes."""
         shared = super().share()
         shared['episodes'] = self.episodes
+        shared['num_exs'] = self.num_exs
         return shared
 
     def num_examples(self):
@@ -1245,6 +1686,17 @@ class ParlAIDialogTeacher(FixedDialogTeacher):
 
     def _setup_data(self, path):
         print("[loading parlAI text data:" + path + "]")
+        if self.opt.get('lazy_load', False):
+            # read episodes from disk when they are requested
+            self.episodes = IndexedEpisodeFile(
+                path,
+                'parlai',
+                self._scan_episodes,
+                self._parse_episode,
+                cache_size=self.opt.get('lazy_load_cache_size', 1024),
+            )
+            self.num_exs = self.episodes.num_examples()
+            return
         self.episodes = []
         self.num_exs = 0
         eps = []
@@ -1262,6 +1714,36 @@ class ParlAIDialogTeacher(FixedDialogTeacher):
             eps[-1].force_set('episode_done', True)
             self.episodes.append(eps)
 
+    def _scan_episodes(self, read):
+        offset = 0
+        start = None
+        num_exs = 0
+        for line in read:
+            # parse every line, as the eager path does, so lines count as
+            # examples and end episodes exactly when they would there
+            msg = str_to_msg(line.decode('utf-8').rstrip('\n'))
+            if msg:
+                if start is None:
+                    start = offset
+                num_exs += 1
+                if msg.get('episode_done', False):
+                    yield start, offset + len(line) - start, num_exs
+                    start = None
+                    num_exs = 0
+            offset += len(line)
+        if start is not None:
+            yield start, offset - start, num_exs
+
+    def _parse_episode(self, text):
+        eps = []
+        for line in text.split('\n'):
+            msg = str_to_msg(line)
+            if msg:
+                eps.append(msg)
+        # the last episode of the file may not be marked done
+        eps[-1].force_set('episode_done', True)
+        return eps
+
 
 class AbstractImageTeacher(FixedDialogTeacher):
     """
@@ -121,6 +121,17 @@ class Batch(AttrDict):
             **kwargs,
         )
 
+    def cuda(self):
+        """
+        Return a copy of the batch with its tensor fields moved to the GPU.
+
+        Used for batches built with ``use_cuda`` off, e.g. in a background
+        preprocessing worker.
+        """
+        return type(self)(
+            **{k: v.cuda() if torch.is_tensor(v) else v for k, v in self.items()}
+        )
+
 
 class Output(AttrDict):
     """
@@ -152,10 +163,12 @@ class History(object):
         (defaults to 'text')
 
     :param vec_type:
-        specify a 'list' or 'deque' to save the history in this object
+        'deque' to keep only the last `maxlen` tokens of the history vector, or
+        'list' to keep all of them
 
     :param maxlen:
-        if `vec_type` is 'deque', this sets the maximum length of that object
+        if `vec_type` is 'deque', this sets the maximum length of the history
+        vector
 
     :param p1_token:
         token indicating 'person 1'; opt must have 'person_tokens' set to True
@@ -196,6 +209,7 @@ class History(object):
         self.history_strings = []
         self.history_raw_strings = []
         self.history_vecs = []
+        self._init_token_buffer()
 
         # person token args
         self.add_person_tokens = opt.get('person_tokens', False)
@@ -215,6 +229,58 @@ class History(object):
         self.history_raw_strings = []
         self.history_strings = []
         self.history_vecs = []
+        self._init_token_buffer()
+
+    def _init_token_buffer(self):
+        """
+        Set up the ring buffer holding the tokens of the history vector.
+
+        The buffer holds the tokens of each utterance and the delimiters between
+        them, so the history vector never has to be rebuilt from history_vecs.
+        Every token is written twice, at ``i`` and ``i + capacity``, so that any
+        window of up to capacity tokens is a contiguous slice of the buffer.
+        """
+        self._bounded = self.vec_type == 'deque' and self.max_len is not None
+        capacity = max(self.max_len, 1) if self._bounded else 256
+        self._token_buffer = torch.zeros(2 * capacity, dtype=torch.long)
+        # absolute positions of the first token of the history, of the end of
+        # the history, and of the first token of each utterance in it
+        self._tokens_start = 0
+        self._tokens_end = 0
+        self._utterance_starts = deque()
+
+    def _buffer_capacity(self):
+        return self._token_buffer.size(0) // 2
+
+    def _buffer_window(self):
+        """Return the last tokens of the history in the buffer, as a view."""
+        length = self._tokens_end - self._tokens_start
+        if self._bounded:
+            length = min(length, self.max_len)
+        begin = (self._tokens_end - length) % self._buffer_capacity()
+        return self._token_buffer[begin : begin + length]
+
+    def _write_tokens(self, tokens):
+        """Append tokens after the end of the history in the buffer."""
+        capacity = self._buffer_capacity()
+        if not self._bounded:
+            needed = self._tokens_end + len(tokens) - self._tokens_start
+            if needed > capacity:
+                # grow the buffer, keeping the tokens currently in the history
+                window = self._buffer_window().clone()
+                while capacity < needed:
+                    capacity *= 2
+                self._token_buffer = self._token_buffer.new_zeros(2 * capacity)
+                self._tokens_end = self._tokens_start
+                self._write_tokens(window.tolist())
+        end = self._tokens_end + len(tokens)
+        # tokens older than the last capacity ones can never be returned
+        tokens = tokens[-capacity:]
+        positions = torch.arange(end - len(tokens), end) % capacity
+        values = torch.LongTensor(tokens)
+        self._token_buffer[positions] = values
+        self._token_buffer[positions + capacity] = values
+        self._tokens_end = end
 
     def _update_strings(self, text):
         if self.size > 0:
@@ -232,7 +298,22 @@ class History(object):
         if self.size > 0:
             while len(self.history_vecs) >= self.size:
                 self.history_vecs.pop(0)
-        self.history_vecs.append(self.parse(text))
+                # the history now starts at the next utterance, after the
+                # delimiter preceding it
+                self._utterance_starts.popleft()
+                self._tokens_start = (
+                    self._utterance_starts[0]
+                    if self._utterance_starts
+                    else self._tokens_end
+                )
+        vec = self.parse(text)
+        self.history_vecs.append(vec)
+        if self._utterance_starts:
+            self._write_tokens(self.delimiter_tok)
+        else:
+            self._tokens_start = self._tokens_end
+        self._utterance_starts.append(self._tokens_end)
+        self._write_tokens(vec)
 
     def update_history(self, obs, add_next=None):
         """
@@ -262,6 +343,12 @@ class History(object):
                 next_texts = obs[self.field].split('\n')
             else:
                 next_texts = [obs[self.field]]
+            # if the last utterance of an episode was already vectorized, e.g.
+            # by a teacher reading pre-tokenized data, the history vector is
+            # never used, so skip tokenizing it
+            vectorized = (
+                obs.get('episode_done') and obs.get(self.field + '_vec') is not None
+            )
             for text in next_texts:
                 self._update_raw_strings(text)
                 if self.add_person_tokens:
@@ -271,7 +358,8 @@ class History(object):
                 # update history string
                 self._update_strings(text)
                 # update history vecs
-                self._update_vecs(text)
+                if not vectorized:
+                    self._update_vecs(text)
 
         if obs.get('episode_done'):
             # end of this episode, clear the history when we see a new example
@@ -284,25 +372,17 @@ class History(object):
         return None
 
     def get_history_vec(self):
-        """Return a vectorized version of the history."""
+        """
+        Return a vectorized version of the history.
+
+        :return:
+            a LongTensor of the history utterances joined by the delimiter,
+            keeping only the last `maxlen` tokens if `vec_type` is 'deque'.
+        """
         if len(self.history_vecs) == 0:
             return None
-
-        if self.vec_type == 'deque':
-            history = deque(maxlen=self.max_len)
-            for vec in self.history_vecs[:-1]:
-                history.extend(vec)
-                history.extend(self.delimiter_tok)
-            history.extend(self.history_vecs[-1])
-        else:
-            # vec type is a list
-            history = []
-            for vec in self.history_vecs[:-1]:
-                history += vec
-                history += self.delimiter_tok
-            history += self.history_vecs[-1]
-
-        return history
+        # copy, so later updates to the buffer don't change the returned vector
+        return self._buffer_window().clone()
 
     def get_history_vec_list(self):
         """Return a list of history vecs."""
@@ -1298,7 +1378,7 @@ class TorchAgent(ABC, Agent):
         # check truncation
         if obs.get('text_vec') is not None:
             truncated_vec = self._check_truncate(obs['text_vec'], truncate, True)
-            obs.force_set('text_vec', torch.LongTensor(truncated_vec))
+            obs.force_set('text_vec', torch.as_tensor(truncated_vec, dtype=torch.long))
         return obs
 
     def _set_label_vec(self, obs, add_start, add_end, truncate):
@@ -1321,7 +1401,9 @@ class TorchAgent(ABC, Agent):
         elif label_type + '_vec' in obs:
             # check truncation of pre-computed vector
             truncated_vec = self._check_truncate(obs[label_type + '_vec'], truncate)
-            obs.force_set(label_type + '_vec', torch.LongTensor(truncated_vec))
+            obs.force_set(
+                label_type + '_vec', torch.as_tensor(truncated_vec, dtype=torch.long)
+            )
         else:
             # pick one label if there are multiple
             lbls = obs[label_type]
@@ -1339,11 +1421,13 @@ class TorchAgent(ABC, Agent):
         Useful to override to change vectorization behavior
         """
         if 'label_candidates_vecs' in obs:
-            if truncate is not None:
-                # check truncation of pre-computed vectors
-                vecs = obs['label_candidates_vecs']
-                for i, c in enumerate(vecs):
-                    vecs[i] = self._check_truncate(c, truncate)
+            # check truncation and type of pre-computed vectors
+            vecs = obs['label_candidates_vecs']
+            for i, c in enumerate(vecs):
+                c = self._check_truncate(c, truncate)
+                if torch.is_tensor(c):
+                    c = c.long()
+                vecs[i] = c
         elif self.rank_candidates and obs.get('label_candidates'):
             obs.force_set('label_candidates', list(obs['label_candidates']))
             obs['label_candidates_vecs'] = [
@@ -1721,7 +1805,7 @@ class TorchAgent(ABC, Agent):
             )
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
+    def batch_act(self, observations, batch=None):
         """
         Process a batch of observations (batchsize list of message dicts).
 
@@ -1731,6 +1815,10 @@ class TorchAgent(ABC, Agent):
         default behaviors are fine then just override the ``train_step`` and
         ``eval_step`` methods instead. The former is called when labels are
         present in the observations batch; otherwise, the latter is called.
+
+        :param batch:
+            the result of ``batchify(observations)``, if it was already built,
+            e.g. by a background preprocessing worker.
         """
         batch_size = len(observations)
         # initialize a list of replies with this agent's id
@@ -1740,7 +1828,10 @@ class TorchAgent(ABC, Agent):
         self.is_training = any('labels' in obs for obs in observations)
 
         # create a batch from the vectors
-        batch = self.batchify(observations)
+        if batch is None:
+            batch = self.batchify(observations)
+        elif self.use_cuda:
+            batch = batch.cuda()
 
         if self.is_training:
             output = self.train_step(batch)
@@ -14,12 +14,11 @@ Contains the following utilities:
 
 * `ref:TorchGeneratorAgent` class, which serves as a useful parent for generative torch
   agents.
-* Beam class which provides some generic beam functionality for classes to use
+* TreeSearch classes which provide batched beam search, greedy search and sampling
 """
 
 from abc import ABC, abstractmethod
 import math
-from operator import attrgetter
 
 import torch
 import torch.nn as nn
@@ -176,6 +175,33 @@ class TorchGeneratorModel(nn.Module, ABC):
         """
         pass
 
+    def extend_encoder_states(self, encoder_states, xs):
+        """
+        Encode new tokens as a continuation of an already encoded input.
+
+        Used to avoid re-encoding the whole dialogue history every turn in
+        interactive mode: if the new input consists of the previous input
+        followed by ``xs``, the previous encoder states are extended with the
+        encodings of ``xs`` only.
+
+        Implementing this method is optional. It is only valid for encoders
+        where the encodings of a prefix do not depend on later tokens (e.g.
+        unidirectional RNNs), and the default returns None to indicate that the
+        full input must be encoded again.
+
+        :param encoder_states:
+            output of model.encoder on the previous input
+        :param xs:
+            the new tokens appended to the previous input
+        :type xs:
+            LongTensor[bsz, new_seqlen]
+
+        :return:
+            encoder states for the previous input followed by xs, or None if
+            the model does not support extending its encoder states.
+        """
+        return None
+
     def forward(self, *xs, ys=None, prev_enc=None, maxlen=None, bsz=None):
         """
         Get output predictions from the model.
@@ -295,6 +321,14 @@ class TorchGeneratorAgent(TorchAgent):
         agent.add_argument(
             '--topp', type=float, default=0.9, help='p used in nucleus sampling'
         )
+        agent.add_argument(
+            '--cache-encoder-states',
+            type='bool',
+            default=False,
+            help='In interactive mode, keep the encoder states of the dialogue '
+            'history and only encode the tokens added since the last turn, for '
+            'models which support it.',
+        )
 
         super(TorchGeneratorAgent, cls).add_cmdline_args(argparser)
         return agent
@@ -361,8 +395,10 @@ class TorchGeneratorAgent(TorchAgent):
             self.build_lr_scheduler(states, hard_reset=is_finetune)
 
         if shared is None and is_distributed():
+            # CPU models (gloo backend) must not be given device_ids
+            device_ids = [self.opt['gpu']] if self.use_cuda else None
             self.model = torch.nn.parallel.DistributedDataParallel(
-                self.model, device_ids=[self.opt['gpu']], broadcast_buffers=False
+                self.model, device_ids=device_ids, broadcast_buffers=False
             )
 
         self.reset()
@@ -396,6 +432,13 @@ class TorchGeneratorAgent(TorchAgent):
             self.skip_generation = False
         else:
             self.skip_generation = self.opt.get('skip_generation', False)
+        self.cache_encoder_states = mode and self.opt.get('cache_encoder_states')
+        self._encoder_cache = None
+
+    def reset(self):
+        """Clear internal states, including any cached encoder states."""
+        super().reset()
+        self._encoder_cache = None
 
     def _dummy_batch(self, batchsize, maxlen):
         """
@@ -627,7 +670,7 @@ class TorchGeneratorAgent(TorchAgent):
         text = [self._v2t(p) for p in preds] if preds is not None else None
         return Output(text, cand_choices, token_losses=token_losses)
 
-    def _treesearch_factory(self, device):
+    def _treesearch_factory(self, device, bsz=1):
         method = self.opt.get('inference', 'greedy')
         beam_size = self.opt.get('beam_size', 1)
         if method == 'greedy':
@@ -639,6 +682,7 @@ class TorchGeneratorAgent(TorchAgent):
                 bos_token=self.START_IDX,
                 eos_token=self.END_IDX,
                 device=device,
+                bsz=bsz,
             )
         elif method == 'beam':
             return BeamSearch(
@@ -649,6 +693,7 @@ class TorchGeneratorAgent(TorchAgent):
                 bos_token=self.START_IDX,
                 eos_token=self.END_IDX,
                 device=device,
+                bsz=bsz,
             )
         elif method == 'topk':
             return TopKSampling(
@@ -660,6 +705,7 @@ class TorchGeneratorAgent(TorchAgent):
                 bos_token=self.START_IDX,
                 eos_token=self.END_IDX,
                 device=device,
+                bsz=bsz,
             )
         elif method == 'nucleus':
             return NucleusSampling(
@@ -671,10 +717,46 @@ class TorchGeneratorAgent(TorchAgent):
                 bos_token=self.START_IDX,
                 eos_token=self.END_IDX,
                 device=device,
+                bsz=bsz,
             )
         else:
             raise ValueError(f"Can't use inference method {method}")
 
+    def _encode_with_cache(self, model, batch):
+        """
+        Encode the batch input for generation.
+
+        With --cache-encoder-states in interactive mode, the encoder states of
+        the last input are kept. Since the dialogue history only grows from turn
+        to turn, the next input usually starts with the last one, and then only
+        the new tokens are encoded. The cache is invalidated whenever the input
+        is not an extension of the last one, e.g. once the history is truncated.
+        """
+        model_input = self._model_input(batch)
+        if not (
+            self.cache_encoder_states
+            and len(model_input) == 1
+            and batch.text_vec.size(0) == 1
+        ):
+            return model.encoder(*model_input)
+
+        xs = batch.text_vec
+        encoder_states = None
+        if self._encoder_cache is not None:
+            prev_xs, prev_states = self._encoder_cache
+            prev_len = prev_xs.size(1)
+            if xs.size(1) >= prev_len and torch.equal(xs[:, :prev_len], prev_xs):
+                if xs.size(1) == prev_len:
+                    encoder_states = prev_states
+                else:
+                    encoder_states = model.extend_encoder_states(
+                        prev_states, xs[:, prev_len:]
+                    )
+        if encoder_states is None:
+            encoder_states = model.encoder(xs)
+        self._encoder_cache = (xs, encoder_states)
+        return encoder_states
+
     def _generate(self, batch, beam_size, max_ts):
         """
         Generate an output with beam search.
@@ -689,23 +771,21 @@ class TorchGeneratorAgent(TorchAgent):
             the maximum length of the decoded sequence
 
         :return:
-            tuple (beam_pred_scores, n_best_pred_scores, beams)
+            tuple (beam_pred_scores, beam)
 
             - beam_preds_scores: list of (prediction, score) pairs for each sample in
               Batch
-            - n_best_preds_scores: list of n_best list of tuples (prediction, score)
-              for each sample from Batch
-            - beams :list of Beam instances defined in Beam class, can be used for any
-              following postprocessing, e.g. dot logging.
+            - beam: the batched TreeSearch instance used for generation, can be
+              used for any following postprocessing, e.g. n-best extraction.
         """
         model = self.model
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
             model = self.model.module
-        encoder_states = model.encoder(*self._model_input(batch))
+        encoder_states = self._encode_with_cache(model, batch)
         dev = batch.text_vec.device
 
         bsz = len(batch.text_lengths)
-        beams = [self._treesearch_factory(dev) for _ in range(bsz)]
+        beam = self._treesearch_factory(dev, bsz)
 
         # repeat encoder outputs and decoder inputs
         decoder_input = (
@@ -715,9 +795,11 @@ class TorchGeneratorAgent(TorchAgent):
         inds = torch.arange(bsz).to(dev).unsqueeze(1).repeat(1, beam_size).view(-1)
         encoder_states = model.reorder_encoder_states(encoder_states, inds)
         incr_state = None
+        # offset of each example's hypotheses in the flattened bsz * beam_size view
+        beam_offset = (torch.arange(bsz, device=dev) * beam_size).unsqueeze(1)
 
         for _ts in range(max_ts):
-            if all((b.is_done() for b in beams)):
+            if beam.is_done():
                 # exit early if possible
                 break
 
@@ -728,51 +810,35 @@ class TorchGeneratorAgent(TorchAgent):
             # score contains softmax scores for bsz * beam_size samples
             score = score.view(bsz, beam_size, -1)
             score = F.log_softmax(score, dim=-1)
-            for i, b in enumerate(beams):
-                if not b.is_done():
-                    b.advance(score[i])
-            incr_state_inds = torch.cat(
-                [
-                    beam_size * i + b.get_backtrack_from_current_step()
-                    for i, b in enumerate(beams)
-                ]
-            )
+            beam.advance(score)
+            incr_state_inds = (
+                beam_offset + beam.get_backtrack_from_current_step()
+            ).view(-1)
             incr_state = model.reorder_decoder_incremental_state(
                 incr_state, incr_state_inds
             )
             decoder_input = torch.index_select(decoder_input, 0, incr_state_inds)
-            selection = torch.cat(
-                [b.get_output_from_current_step() for b in beams]
-            ).unsqueeze(-1)
+            selection = beam.get_output_from_current_step().view(-1, 1)
             decoder_input = torch.cat([decoder_input, selection], dim=-1)
 
         # get all finilized candidates for each sample (and validate them)
-        n_best_beam_preds_scores = [b.get_rescored_finished() for b in beams]
+        n_best_beam_preds_scores = beam.get_rescored_finished()
 
         # get the top prediction for each beam (i.e. minibatch sample)
         beam_preds_scores = [n_best_list[0] for n_best_list in n_best_beam_preds_scores]
 
-        return beam_preds_scores, beams
-
-
-class _HypothesisTail(object):
-    """Hold some bookkeeping about a hypothesis."""
-
-    # use slots because we don't want dynamic attributes here
-    __slots__ = ['timestep', 'hypid', 'score', 'tokenid']
-
-    def __init__(self, timestep, hypid, score, tokenid):
-        self.timestep = timestep
-        self.hypid = hypid
-        self.score = score
-        self.tokenid = tokenid
+        return beam_preds_scores, beam
 
 
 class TreeSearch(object):
     """
     Abstract Tree Search class.
 
-    It keeps information about beam_size concurrent, developing hypotheses.
+    It keeps information about beam_size concurrent, developing hypotheses for
+    each of the bsz examples in a batch. All bookkeeping (scores, backpointers,
+    outputs and finished hypotheses) is kept as [bsz, beam_size] tensors, so the
+    whole batch is advanced with a handful of tensor operations per step.
+
     Concrete implementations make choices about which token to explore next at
     each point in the tree. Different choices result in different generation
     algorithms.
@@ -787,6 +853,7 @@ class TreeSearch(object):
         eos_token=2,
         min_length=3,
         device='cpu',
+        bsz=1,
     ):
         """
         Instantiate Beam object.
@@ -805,33 +872,60 @@ class TreeSearch(object):
             minimum length of the predicted sequence
         :param device:
             What device to use for computations
+        :param bsz:
+            number of examples searched over in parallel
         """
         self.beam_size = beam_size
+        self.bsz = bsz
         self.block_ngram = block_ngram
         self.min_length = min_length
         self.eos = eos_token
         self.bos = bos_token
         self.pad = padding_token
         self.device = device
-        # recent score for each hypo in the beam
+        # recent score for each hypo in the beam, (bsz, beam_size) after the
+        # first step
         self.scores = None
         # self.scores values per each time step
-        self.all_scores = [torch.Tensor([0.0] * beam_size).to(self.device)]
+        self.all_scores = [torch.zeros(bsz, beam_size, device=self.device)]
         # backtracking id to hypothesis at previous time step
         self.bookkeep = []
         # output tokens at each time step
         self.outputs = [
-            torch.Tensor(self.beam_size).long().fill_(self.bos).to(self.device)
+            torch.full((bsz, beam_size), bos_token, dtype=torch.long, device=device)
         ]
-        # keeps tuples (score, time_step, hyp_id)
-        self.finished = []
-        self.eos_top = False
-        self.eos_top_ts = None
-        self.n_best_counter = 0
-        self.partial_hyps = [[self.bos] for i in range(beam_size)]
+        # marks which hypotheses were finalized at each time step
+        # masks are uint8 rather than bool, which needs torch >= 1.2
+        self.finished = [torch.zeros(bsz, beam_size, dtype=torch.uint8, device=device)]
+        self.eos_top = torch.zeros(bsz, dtype=torch.uint8, device=device)
+        self.n_best_counter = torch.zeros(bsz, dtype=torch.long, device=device)
+        # examples which completed their search before the current step
+        self.done = torch.zeros(bsz, dtype=torch.uint8, device=device)
+        # incremental ngram index used for blocking: the token history of each
+        # live hypothesis, and the packed (n-1)-gram ending at each of its
+        # positions. Kept in a preallocated (2, bsz, beam_size, capacity)
+        # buffer, which is written in place and doubled when full.
+        self._history = torch.full(
+            (2, bsz, beam_size, 32), bos_token, dtype=torch.long, device=device
+        )
+        # the buffer the history is reordered into at the next step
+        self._spare_history = torch.empty_like(self._history)
+        self._history_len = 1
+        # modulus used to roll the packed keys forward, set on the first step
+        self._ngram_key_mod = None
+
+    @property
+    def partial_hyps(self):
+        """Full token history of each live hypothesis, (bsz, beam_size, steps)."""
+        return self._history[0, :, :, : self._history_len]
+
+    @property
+    def ngram_keys(self):
+        """Packed (n-1)-gram ending at each position of partial_hyps."""
+        return self._history[1, :, :, : self._history_len]
 
     def get_output_from_current_step(self):
-        """Get the outputput at the current step."""
+        """Get the output at the current step."""
         return self.outputs[-1]
 
     def get_backtrack_from_current_step(self):
@@ -844,51 +938,121 @@ class TreeSearch(object):
         Select the next vocabulary item in these beams.
 
         :param logprobs:
-            a (beamsize x vocab) tensor of log probabilities. If this is the first
-            turn in the dialogue, it will be a (1 x vocab) tensor.
+            a (bsz x beamsize x vocab) tensor of log probabilities.
         :param prior_scores:
-            a (beamsize) tensor of weights with the cumulative running
-            log-probability of each beam. If the first turn, it will be a (1) tensor.
+            a (bsz x beamsize) tensor of weights with the cumulative running
+            log-probability of each beam. If this is the first step, it will be a
+            (bsz x 1) tensor.
 
         :return:
             a (hypothesis_ids, token_id, scores) tuple, where:
 
-            - hypothesis_ids is a LongTensor of hypotheses we're extending. May have
-              repeats, but should always be (beamsize) long.
-            - token_ids is a (beamsize) LongTensor of next-token choices for
+            - hypothesis_ids is a (bsz x beamsize) LongTensor of hypotheses we're
+              extending. May have repeats.
+            - token_ids is a (bsz x beamsize) LongTensor of next-token choices for
               each of the hypotheses.
-            - scores is a (beamsize) Tensor with the updated cumulative log-probs
-              of each beam.
+            - scores is a (bsz x beamsize) Tensor with the updated cumulative
+              log-probs of each beam.
         """
         pass
 
+    def _block_ngrams(self, logprobs):
+        """
+        Disallow tokens which would repeat an ngram of each hypothesis.
+
+        Every position j of a hypothesis holds the key of the (n-1)-gram ending
+        there, and the token at j + 1 completes an ngram. Positions whose key
+        equals that of the current suffix give the tokens to block, which are
+        written into ``logprobs`` in place for the whole batch at once.
+        """
+        n = self.block_ngram
+        hyps = self.partial_hyps
+        if self._ngram_key_mod is None:
+            self._init_ngram_keys(logprobs.size(-1))
+        if n == 1:
+            # unigram blocking disallows every token seen so far
+            return logprobs.scatter_(-1, hyps, neginf(logprobs.dtype))
+        elif hyps.size(-1) < n - 1:
+            return logprobs
+        elif self._ngram_key_mod:
+            next_tokens = hyps[:, :, 1:]
+            matches = self.ngram_keys[:, :, :-1] == self.ngram_keys[:, :, -1:]
+            # the first n - 2 positions don't end a full (n-1)-gram
+            matches[:, :, : n - 2] = 0
+        else:
+            # packed keys would overflow, so compare the (n-1)-grams directly
+            windows = hyps.unfold(-1, n - 1, 1)
+            matches = (windows[:, :, :-1] == windows[:, :, -1:]).all(dim=-1)
+            next_tokens = hyps[:, :, n - 1 :]
+
+        # only index the (hypothesis, token) pairs to block, rather than
+        # building a mask the size of logprobs
+        batch_ids, hyp_ids, positions = matches.nonzero().t()
+        tokens = next_tokens[batch_ids, hyp_ids, positions]
+        logprobs[batch_ids, hyp_ids, tokens] = neginf(logprobs.dtype)
+        return logprobs
+
+    def _init_ngram_keys(self, vocab_size):
+        """
+        Choose how (n-1)-grams are packed into the incremental key index.
+
+        Keys are exact base-``vocab_size`` numbers, so they are only used when
+        the largest key fits in a LongTensor.
+        """
+        self._vocab_size = vocab_size
+        if self.block_ngram > 1 and vocab_size ** (self.block_ngram - 1) < 2 ** 63:
+            self._ngram_key_mod = vocab_size ** (self.block_ngram - 2)
+        else:
+            self._ngram_key_mod = 0
+
+    def _update_ngram_index(self, hyp_ids, tok_ids):
+        """Extend the hypotheses and their ngram keys with the chosen tokens."""
+        length = self._history_len
+        if length == self._history.size(-1):
+            # out of room, so double the capacity of both buffers
+            grown = self._history.new_zeros(self._history.shape[:-1] + (2 * length,))
+            grown[..., :length] = self._history
+            self._history = grown
+            self._spare_history = torch.empty_like(grown)
+        # reorder the histories into the spare buffer, by parent hypothesis
+        index = hyp_ids.view(1, self.bsz, -1, 1).expand(2, -1, -1, length)
+        history = self._spare_history
+        torch.gather(self._history[..., :length], 2, index, out=history[..., :length])
+        self._spare_history = self._history
+        self._history = history
+        history[0, :, :, length] = tok_ids
+        if self._ngram_key_mod:
+            # roll the key of each parent's last (n-1)-gram forward one token
+            last_keys = history[1, :, :, length - 1]
+            history[1, :, :, length] = (
+                last_keys % self._ngram_key_mod
+            ) * self._vocab_size + tok_ids
+        self._history_len = length + 1
+
     def advance(self, logprobs):
-        """Advance the beam one step."""
+        """
+        Advance every beam in the batch one step.
+
+        :param logprobs:
+            a (bsz x beamsize x vocab) tensor of log probabilities.
+        """
         current_length = len(self.all_scores) - 1
         if current_length < self.min_length:
             # penalize all eos probs to make it decode longer
-            for hyp_id in range(logprobs.size(0)):
-                logprobs[hyp_id][self.eos] = neginf(logprobs.dtype)
+            logprobs[:, :, self.eos] = neginf(logprobs.dtype)
 
         if self.scores is None:
-            self.scores = torch.zeros(1).type_as(logprobs).to(logprobs.device)
-
-        # penalize hypotheses ending in EOS on the prior scores (self.scores) level
-        # this is related to search which uses prior scores (self.scores) (e.g. beam)
-        for hyp_id, token in enumerate(self.outputs[-1]):
-            if token == self.eos:
-                self.scores[hyp_id] = neginf(self.scores.dtype)
+            self.scores = torch.zeros(self.bsz, 1).type_as(logprobs)
+        else:
+            # penalize hypotheses ending in EOS on the prior scores (self.scores)
+            # level. this is related to search which uses prior scores (e.g. beam)
+            self.scores = self.scores.masked_fill(
+                self.outputs[-1] == self.eos, neginf(self.scores.dtype)
+            )
 
         # beam blocking
         if self.block_ngram > 0:
-            for beam_id, hyp in enumerate(self.partial_hyps):
-                if len(hyp) < self.block_ngram - 1:
-                    continue
-                ngrams = self._find_ngrams(hyp, self.block_ngram)
-                prefix = hyp[-(self.block_ngram - 1) :]
-                for ngram in ngrams:
-                    if prefix == list(ngram[:-1]) or self.block_ngram == 1:
-                        logprobs[beam_id][ngram[-1]] = neginf(logprobs.dtype)
+            logprobs = self._block_ngrams(logprobs)
 
         hyp_ids, tok_ids, self.scores = self.select_paths(logprobs, self.scores)
         # use clone() here to ensure that self.all_scores will not be changed
@@ -897,70 +1061,58 @@ class TreeSearch(object):
 
         self.outputs.append(tok_ids)
         self.bookkeep.append(hyp_ids)
-        self.partial_hyps = [
-            self.partial_hyps[hyp_ids[i]] + [tok_ids[i].item()]
-            for i in range(self.beam_size)
-        ]
-
-        #  check new hypos for eos label, if we have some, add to finished
-        for hypid in range(self.beam_size):
-            if self.outputs[-1][hypid] == self.eos:
-                if self.scores[hypid] == neginf(self.scores.dtype):
-                    continue
-                #  this is finished hypo, adding to finished
-                eostail = _HypothesisTail(
-                    timestep=len(self.outputs) - 1,
-                    hypid=hypid,
-                    score=self.all_scores[-1][hypid],
-                    tokenid=self.eos,
-                )
-                self.finished.append(eostail)
-                self.n_best_counter += 1
-
-        if self.outputs[-1][0] == self.eos:
-            self.eos_top = True
-            if self.eos_top_ts is None:
-                self.eos_top_ts = len(self.outputs) - 1
+        if self.block_ngram > 0:
+            self._update_ngram_index(hyp_ids, tok_ids)
+
+        # check new hypos for eos label, if we have some, add to finished.
+        # examples which were already done are frozen and can't collect more.
+        not_done = self.done == 0
+        finished = (
+            (tok_ids == self.eos)
+            & (self.scores != neginf(self.scores.dtype))
+            & not_done.unsqueeze(1)
+        ).byte()
+        self.finished.append(finished)
+        self.n_best_counter += finished.long().sum(dim=1)
+        self.eos_top |= ((tok_ids[:, 0] == self.eos) & not_done).byte()
+        self.done = self.eos_top & (self.n_best_counter >= self.beam_size).byte()
 
     def is_done(self):
-        """Return whether beam search is complete."""
-        return self.eos_top and self.n_best_counter >= self.beam_size
+        """Return whether the search is complete for every example in the batch."""
+        return bool(self.done.all())
 
-    def _find_ngrams(self, input_list, n):
-        """Find ngrams of size n in input list."""
-        return list(zip(*[input_list[i:] for i in range(n)]))
-
-    def _get_hyp_from_finished(self, hypothesis_tail):
+    def _get_hyps_from_finished(self, batch_ids, timesteps, hyp_ids):
         """
-        Extract hypothesis ending with EOS at timestep with hyp_id.
-
-        :param timestep:
-            timestep with range up to len(self.outputs) - 1
+        Extract the token sequences of several finished hypotheses at once.
 
-        :param hyp_id:
-            id with range up to beam_size - 1
+        :param batch_ids:
+            LongTensor[n] of the examples the hypotheses belong to
+        :param timesteps:
+            LongTensor[n] of the timesteps at which the hypotheses ended
+        :param hyp_ids:
+            LongTensor[n] of the ids of the hypotheses at those timesteps
 
         :return:
-            hypothesis sequence
+            list of n LongTensors, each a hypothesis sequence including BOS and
+            EOS
         """
-        hyp_idx = []
-        endback = hypothesis_tail.hypid
-        for i in range(hypothesis_tail.timestep, -1, -1):
-            hyp_idx.append(
-                _HypothesisTail(
-                    timestep=i,
-                    hypid=endback,
-                    score=self.all_scores[i][endback],
-                    tokenid=self.outputs[i][endback],
-                )
+        max_ts = int(timesteps.max()) if timesteps.numel() else 0
+        tokens = torch.full(
+            (timesteps.size(0), max_ts + 1),
+            self.pad,
+            dtype=torch.long,
+            device=timesteps.device,
+        )
+        endback = hyp_ids.clone()
+        for i in range(max_ts, -1, -1):
+            active = timesteps >= i
+            tokens[:, i] = torch.where(
+                active, self.outputs[i][batch_ids, endback], tokens[:, i]
             )
-            endback = self.bookkeep[i - 1][endback]
-
-        return hyp_idx
-
-    def _get_pretty_hypothesis(self, list_of_hypotails):
-        """Return hypothesis as a tensor of token ids."""
-        return torch.stack([ht.tokenid for ht in reversed(list_of_hypotails)])
+            if i > 0:
+                prev = self.bookkeep[i - 1][batch_ids, endback]
+                endback = torch.where(active, prev, endback)
+        return [tokens[j, : int(ts) + 1] for j, ts in enumerate(timesteps)]
 
     def get_rescored_finished(self, n_best=None):
         """
@@ -973,59 +1125,51 @@ class TreeSearch(object):
             number of finalized hypotheses to return
 
         :return:
-            list of (tokens, score) pairs, in sorted order, where:
+            for each example in the batch, a list of (tokens, score) pairs, in
+            sorted order, where:
               - tokens is a tensor of token ids
               - score is the adjusted log probability of the entire utterance
         """
         # if we never actually finished, force one
-        if not self.finished:
-            self.outputs[-1][0] = self.eos
-            self.finished.append(
-                _HypothesisTail(
-                    timestep=len(self.outputs) - 1,
-                    hypid=0,
-                    score=self.all_scores[-1][0],
-                    tokenid=self.outputs[-1][0],
-                )
-            )
-
-        rescored_finished = []
-        for finished_item in self.finished:
-            current_length = finished_item.timestep + 1
-            # these weights are from Google NMT paper
-            length_penalty = math.pow((1 + current_length) / 6, 0.65)
-            rescored_finished.append(
-                _HypothesisTail(
-                    timestep=finished_item.timestep,
-                    hypid=finished_item.hypid,
-                    score=finished_item.score / length_penalty,
-                    tokenid=finished_item.tokenid,
-                )
-            )
-
-        # Note: beam size is almost always pretty small, so sorting is cheap enough
-        srted = sorted(rescored_finished, key=attrgetter('score'), reverse=True)
-
-        if n_best is not None:
-            srted = srted[:n_best]
-
-        n_best_list = [
-            (self._get_pretty_hypothesis(self._get_hyp_from_finished(hyp)), hyp.score)
-            for hyp in srted
-        ]
-
-        # check that there is at least one finished candidate
-        # and assert that each of them contains only one EOS
-        assert (
-            len(n_best_list) >= 1
-        ), f'TreeSearch returned {len(n_best_list)} candidates, must be >= 1'
-        for (pred, score) in n_best_list:
+        never_finished = self.n_best_counter == 0
+        if never_finished.any():
+            self.outputs[-1][never_finished, 0] = self.eos
+            self.finished[-1][never_finished, 0] = 1
+            self.n_best_counter[never_finished] = 1
+
+        finished = torch.stack(self.finished)
+        all_scores = torch.stack(self.all_scores)
+        timesteps, batch_ids, hyp_ids = finished.nonzero().unbind(1)
+        current_length = (timesteps + 1).type_as(all_scores)
+        # these weights are from Google NMT paper
+        length_penalty = ((1 + current_length) / 6).pow(0.65)
+        scores = all_scores[timesteps, batch_ids, hyp_ids] / length_penalty
+        hyps = self._get_hyps_from_finished(batch_ids, timesteps, hyp_ids)
+
+        per_example = [[] for _ in range(self.bsz)]
+        for batch_id, hyp, score in zip(batch_ids.tolist(), hyps, scores):
+            per_example[batch_id].append((hyp, score))
+
+        results = []
+        for n_best_list in per_example:
+            # Note: beam size is almost always pretty small, so sorting is cheap
+            srted = sorted(n_best_list, key=lambda x: x[1].item(), reverse=True)
+            if n_best is not None:
+                srted = srted[:n_best]
+
+            # check that there is at least one finished candidate
+            # and assert that each of them contains only one EOS
             assert (
-                pred == self.eos
-            ).sum() == 1, f'TreeSearch returned a finalized hypo with multiple end tokens \
-            with score {score.item():.2f}'
+                len(srted) >= 1
+            ), f'TreeSearch returned {len(srted)} candidates, must be >= 1'
+            for (pred, score) in srted:
+                assert (
+                    pred == self.eos
+                ).sum() == 1, f'TreeSearch returned a finalized hypo with multiple end tokens \
+                with score {score.item():.2f}'
+            results.append(srted)
 
-        return n_best_list
+        return results
 
 
 class GreedySearch(TreeSearch):
@@ -1042,9 +1186,9 @@ class GreedySearch(TreeSearch):
             raise ValueError('Greedy search can only be run with beam size 1.')
 
     def select_paths(self, logprobs, prior_scores):
-        tok_scores, tok_ids = logprobs.max(1)
+        tok_scores, tok_ids = logprobs.max(-1)
         best_scores = tok_scores + prior_scores
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
+        hyp_ids = _beam_arange(logprobs)
         return (hyp_ids, tok_ids, best_scores)
 
 
@@ -1053,18 +1197,19 @@ class BeamSearch(TreeSearch):
 
     def select_paths(self, logprobs, prior_scores):
         """Select the next vocabulary item in these beams."""
-        # if numel is 1, then this is the first time step, only one hyp is expanded
-        if prior_scores.numel() == 1:
-            logprobs = logprobs[0:1]
+        # if there is only one prior score, then this is the first time step, and
+        # only one hyp is expanded
+        if prior_scores.size(1) == 1:
+            logprobs = logprobs[:, 0:1]
 
         # beam search actually looks over all hypotheses together so we flatten
-        beam_scores = logprobs + prior_scores.unsqueeze(1).expand_as(logprobs)
-        flat_beam_scores = beam_scores.view(-1)
+        beam_scores = logprobs + prior_scores.unsqueeze(-1)
+        flat_beam_scores = beam_scores.view(beam_scores.size(0), -1)
         best_scores, best_idxs = torch.topk(flat_beam_scores, self.beam_size, dim=-1)
         voc_size = logprobs.size(-1)
 
         # get the backtracking hypothesis id as a multiple of full voc_sizes
-        hyp_ids = best_idxs / voc_size
+        hyp_ids = best_idxs // voc_size
         # get the actual word id from residual of the same division
         tok_ids = best_idxs % voc_size
 
@@ -1090,10 +1235,12 @@ class TopKSampling(TreeSearch):
     def select_paths(self, logprobs, prior_scores):
         values, indices = logprobs.topk(self.k, dim=-1)
         probs = torch.softmax(values, dim=-1)
-        choices = torch.multinomial(probs, 1)[:, 0]
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
-        tok_ids = indices[hyp_ids, choices]
-        scores = values[hyp_ids, choices]
+        choices = torch.multinomial(probs.view(-1, self.k), 1).view(
+            probs.shape[:-1] + (1,)
+        )
+        hyp_ids = _beam_arange(logprobs)
+        tok_ids = indices.gather(-1, choices).squeeze(-1)
+        scores = values.gather(-1, choices).squeeze(-1)
         best_scores = prior_scores.expand_as(scores) + scores
         return (hyp_ids, tok_ids, best_scores)
 
@@ -1122,13 +1269,21 @@ class NucleusSampling(TreeSearch):
         # The subtraction here is so that we always include the first word to
         # go over p. For example, if the most probable token has a prob of 0.5, and
         # p = 0.3, then we need still need to include that first token.
-        mask = (sprobs.cumsum(dim=-1) - sprobs[:, :1]) >= self.p
+        mask = (sprobs.cumsum(dim=-1) - sprobs[..., :1]) >= self.p
         sprobs[mask] = 0
-        sprobs.div_(sprobs.sum(dim=-1).unsqueeze(1))
-        choices = torch.multinomial(sprobs, 1)[:, 0]
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
-        tok_ids = sinds[hyp_ids, choices]
+        sprobs.div_(sprobs.sum(dim=-1, keepdim=True))
+        choices = torch.multinomial(sprobs.view(-1, sprobs.size(-1)), 1).view(
+            sprobs.shape[:-1] + (1,)
+        )
+        hyp_ids = _beam_arange(logprobs)
+        tok_ids = sinds.gather(-1, choices).squeeze(-1)
         # Convert back to logspace.
-        scores = sprobs[hyp_ids, choices].log()
+        scores = sprobs.gather(-1, choices).squeeze(-1).log()
         best_scores = prior_scores.expand_as(scores) + scores
         return (hyp_ids, tok_ids, best_scores)
+
+
+def _beam_arange(logprobs):
+    """Return (bsz x beamsize) hypothesis ids which extend each beam in place."""
+    bsz, beam_size = logprobs.shape[:2]
+    return torch.arange(beam_size, device=logprobs.device).unsqueeze(0).expand(bsz, -1)
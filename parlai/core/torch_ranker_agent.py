@@ -11,16 +11,39 @@ See the TorchRankerAgent tutorial for examples.
 """
 
 from abc import abstractmethod
+import hashlib
 from itertools import islice
+import multiprocessing
 import os
+import shutil
 from tqdm import tqdm
 
+import numpy as np
 import torch
 
+from parlai.utils.candidate_index import (
+    IVFIndex,
+    build_candidate_index,
+    load_candidate_index,
+)
 from parlai.utils.distributed import is_distributed
+from parlai.utils.memmap import (
+    MemmapStrings,
+    is_memmap_file,
+    load_memmap_tensor,
+    save_memmap_tensor,
+)
 from parlai.core.torch_agent import TorchAgent, Output
 from parlai.utils.misc import round_sigfigs, padded_3d, warn_once, padded_tensor
 
+# agent whose vectorize_fixed_candidates() is run by forked vectorization workers
+_VECTORIZE_AGENT = None
+
+
+def _vectorize_fixed_candidates_worker(cands_batch):
+    """Vectorize a batch of candidates in a forked worker process."""
+    return [v.numpy() for v in _VECTORIZE_AGENT.vectorize_fixed_candidates(cands_batch)]
+
 
 class TorchRankerAgent(TorchAgent):
     """
@@ -92,6 +115,76 @@ class TorchRankerAgent(TorchAgent):
             'or evaluating on fixed candidate set when the encoding of '
             'the candidates is independent of the input.',
         )
+        agent.add_argument(
+            '--candidate-vectorize-workers',
+            type=int,
+            default=0,
+            help='Number of worker processes used to vectorize fixed candidates. '
+            'If 0, vectorizes them in the main process. Workers are forked, so '
+            'this is ignored on platforms without fork.',
+        )
+        agent.add_argument(
+            '--candidate-encode-batch-tokens',
+            type=int,
+            default=0,
+            help='Maximum number of tokens (candidates x longest candidate) in '
+            'each batch when encoding fixed candidates. Candidates are encoded '
+            'in order of length, so short candidates are encoded in larger '
+            'batches. If 0, encodes 256 candidates at a time.',
+        )
+        agent.add_argument(
+            '--candidate-encode-shard-size',
+            type=int,
+            default=50000,
+            help='Number of fixed candidate encodings checkpointed together while '
+            'encoding. An interrupted run resumes from the last completed shard, '
+            'as long as the model and candidates have not changed.',
+        )
+        agent.add_argument(
+            '--memmap-fixed-candidates',
+            type='bool',
+            default=False,
+            help='Memory-map the fixed candidates and their cached vectors and '
+            'encodings instead of loading them into memory. Newly saved vecs and '
+            'encs files are written in a memory-mappable format, and an index of '
+            'the candidates file is saved next to them. Data is paged in as it '
+            'is used, and shared with other processes through the page cache.',
+        )
+        agent.add_argument(
+            '--fixed-candidate-index',
+            type=str,
+            default='none',
+            choices=['none', 'flat', 'ivf', 'pq'],
+            help='Rank fixed candidates by searching an index of their cached '
+            'encodings for the top candidates, instead of scoring every one. '
+            '"flat" is exact, "ivf" only scores candidates in the clusters '
+            'closest to the context, and "pq" scores compressed encodings. The '
+            'index is saved next to the encodings file, and reused along with '
+            'them under --fixed-candidate-vecs reuse. Requires '
+            '--encode-candidate-vecs and a model which implements '
+            'encode_context().',
+        )
+        agent.add_argument(
+            '--candidate-index-nlist',
+            type=int,
+            default=0,
+            help='Number of clusters in the ivf candidate index. If <= 0, uses '
+            '4 * sqrt(number of candidates).',
+        )
+        agent.add_argument(
+            '--candidate-index-nprobe',
+            type=int,
+            default=8,
+            help='Number of clusters searched for each context in the ivf '
+            'candidate index.',
+        )
+        agent.add_argument(
+            '--candidate-index-subvectors',
+            type=int,
+            default=8,
+            help='Number of subvectors (bytes per candidate) in the pq candidate '
+            'index.',
+        )
         agent.add_argument(
             '--init-model',
             type=str,
@@ -167,6 +260,16 @@ class TorchRankerAgent(TorchAgent):
 
         self.rank_top_k = opt.get('rank_top_k', -1)
 
+        if (
+            opt.get('fixed_candidate_index', 'none') != 'none'
+            and type(self).encode_context is TorchRankerAgent.encode_context
+        ):
+            # fail now, rather than at the first evaluation after training
+            raise RuntimeError(
+                '--fixed-candidate-index requires a model which implements '
+                'encode_context(), which {} does not.'.format(type(self).__name__)
+            )
+
         # Vectorize and save fixed/vocab candidates once upfront if applicable
         self.set_fixed_candidates(shared)
         self.set_vocab_candidates(shared)
@@ -183,8 +286,10 @@ class TorchRankerAgent(TorchAgent):
             self.build_lr_scheduler(states, hard_reset=is_finetune)
 
         if shared is None and is_distributed():
+            # CPU models (gloo backend) must not be given device_ids
+            device_ids = [self.opt['gpu']] if self.use_cuda else None
             self.model = torch.nn.parallel.DistributedDataParallel(
-                self.model, device_ids=[self.opt['gpu']], broadcast_buffers=False
+                self.model, device_ids=device_ids, broadcast_buffers=False
             )
 
     def build_criterion(self):
@@ -231,6 +336,25 @@ class TorchRankerAgent(TorchAgent):
         build_cands(opt)
         return path
 
+    def encode_context(self, batch):
+        """
+        Encode the batch contexts into vectors which score candidates by dot product.
+
+        Optional; only needed to rank fixed candidates with
+        --fixed-candidate-index, for models which score a candidate by the
+        inner product of its encoding with a single context encoding.
+
+        :param Batch batch:
+            a Batch object (defined in torch_agent.py)
+
+        :return:
+            a [bsz, dim] FloatTensor of context encodings
+        """
+        raise NotImplementedError(
+            'Abstract method: user must implement encode_context() to use '
+            '--fixed-candidate-index.'
+        )
+
     @abstractmethod
     def score_candidates(self, batch, cand_vecs, cand_encs=None):
         """
@@ -395,31 +519,41 @@ class TorchRankerAgent(TorchAgent):
             batch, source=self.eval_candidates, mode='eval'
         )
 
-        cand_encs = None
-        if self.encode_candidate_vecs and self.eval_candidates in ['fixed', 'vocab']:
-            # if we cached candidate encodings for a fixed list of candidates,
-            # pass those into the score_candidates function
-            if self.eval_candidates == 'fixed':
-                cand_encs = self.fixed_candidate_encs
-            elif self.eval_candidates == 'vocab':
-                cand_encs = self.vocab_candidate_encs
-
-        scores = self.score_candidates(batch, cand_vecs, cand_encs=cand_encs)
-        if self.rank_top_k > 0:
-            _, ranks = scores.topk(
-                min(self.rank_top_k, scores.size(1)), 1, largest=True
-            )
+        if self.eval_candidates == 'fixed' and self.fixed_candidate_index is not None:
+            # only retrieve the top candidates from the index, so there are no
+            # scores for the full candidate set (and no loss)
+            scores = None
+            num_cands = len(cands)
+            ranks = self._search_fixed_candidate_index(batch)
         else:
-            _, ranks = scores.sort(1, descending=True)
+            cand_encs = None
+            if self.encode_candidate_vecs and self.eval_candidates in [
+                'fixed',
+                'vocab',
+            ]:
+                # if we cached candidate encodings for a fixed list of candidates,
+                # pass those into the score_candidates function
+                if self.eval_candidates == 'fixed':
+                    cand_encs = self.fixed_candidate_encs
+                elif self.eval_candidates == 'vocab':
+                    cand_encs = self.vocab_candidate_encs
+
+            scores = self.score_candidates(batch, cand_vecs, cand_encs=cand_encs)
+            num_cands = scores.size(1)
+            if self.rank_top_k > 0:
+                _, ranks = scores.topk(min(self.rank_top_k, num_cands), 1, largest=True)
+            else:
+                _, ranks = scores.sort(1, descending=True)
 
         # Update metrics
         if label_inds is not None:
-            loss = self.criterion(scores, label_inds)
-            self.metrics['loss'] += loss.item()
+            if scores is not None:
+                loss = self.criterion(scores, label_inds)
+                self.metrics['loss'] += loss.item()
             self.metrics['examples'] += batchsize
             for b in range(batchsize):
                 rank = (ranks[b] == label_inds[b]).nonzero()
-                rank = rank.item() if len(rank) == 1 else scores.size(1)
+                rank = rank.item() if len(rank) == 1 else num_cands
                 self.metrics['rank'] += 1 + rank
                 self.metrics['mrr'] += 1.0 / (1 + rank)
 
@@ -434,7 +568,7 @@ class TorchRankerAgent(TorchAgent):
             # using a generator instead of a list comprehension allows
             # to cap the number of elements.
             cand_preds_generator = (
-                cand_list[rank] for rank in ordering if rank < len(cand_list)
+                cand_list[rank] for rank in ordering if 0 <= rank < len(cand_list)
             )
             cand_preds.append(list(islice(cand_preds_generator, max_preds)))
 
@@ -447,6 +581,19 @@ class TorchRankerAgent(TorchAgent):
         preds = [cand_preds[i][0] for i in range(batchsize)]
         return Output(preds, cand_preds)
 
+    def _search_fixed_candidate_index(self, batch):
+        """
+        Retrieve the top fixed candidates for each context from the index.
+
+        :return:
+            a [bsz, k] LongTensor of candidate indices, best first. k is
+            --rank-top-k if set, or --cap-num-predictions otherwise.
+        """
+        k = self.rank_top_k if self.rank_top_k > 0 else self.opt['cap_num_predictions']
+        context_encs = self.encode_context(batch).float()
+        _, ranks = self.fixed_candidate_index.search(context_encs, k)
+        return ranks
+
     def block_repeats(self, cand_preds):
         """Heuristic to block a model repeating a line from the history."""
         history_strings = []
@@ -700,6 +847,7 @@ class TorchRankerAgent(TorchAgent):
         shared['fixed_candidates'] = self.fixed_candidates
         shared['fixed_candidate_vecs'] = self.fixed_candidate_vecs
         shared['fixed_candidate_encs'] = self.fixed_candidate_encs
+        shared['fixed_candidate_index'] = self.fixed_candidate_index
         shared['vocab_candidates'] = self.vocab_candidates
         shared['vocab_candidate_vecs'] = self.vocab_candidate_vecs
         shared['vocab_candidate_encs'] = self.vocab_candidate_encs
@@ -802,7 +950,9 @@ class TorchRankerAgent(TorchAgent):
             self.fixed_candidates = shared['fixed_candidates']
             self.fixed_candidate_vecs = shared['fixed_candidate_vecs']
             self.fixed_candidate_encs = shared['fixed_candidate_encs']
+            self.fixed_candidate_index = shared['fixed_candidate_index']
         else:
+            self.fixed_candidate_index = None
             opt = self.opt
             cand_path = self.fixed_candidates_path
             if 'fixed' in (self.candidates, self.eval_candidates):
@@ -813,19 +963,27 @@ class TorchRankerAgent(TorchAgent):
                         print("[setting fixed_candidates path to: " + path + " ]")
                         self.fixed_candidates_path = path
                         cand_path = self.fixed_candidates_path
+                setting = self.opt['fixed_candidate_vecs']
+                model_dir, model_file = os.path.split(self.opt['model_file'])
+                model_name = os.path.splitext(model_file)[0]
+                cands_name = os.path.splitext(os.path.basename(cand_path))[0]
                 # Load candidates
                 print("[ Loading fixed candidate set from {} ]".format(cand_path))
-                with open(cand_path, 'r', encoding='utf-8') as f:
-                    cands = [line.strip() for line in f.readlines()]
+                if self.opt.get('memmap_fixed_candidates'):
+                    offsets_path = os.path.join(
+                        model_dir, '.'.join([model_name, cands_name, 'offsets'])
+                    )
+                    if setting == 'replace' and os.path.isfile(offsets_path):
+                        os.remove(offsets_path)
+                    cands = MemmapStrings(cand_path, offsets_path)
+                else:
+                    with open(cand_path, 'r', encoding='utf-8') as f:
+                        cands = [line.strip() for line in f.readlines()]
                 # Load or create candidate vectors
                 if os.path.isfile(self.opt['fixed_candidate_vecs']):
                     vecs_path = opt['fixed_candidate_vecs']
                     vecs = self.load_candidates(vecs_path)
                 else:
-                    setting = self.opt['fixed_candidate_vecs']
-                    model_dir, model_file = os.path.split(self.opt['model_file'])
-                    model_name = os.path.splitext(model_file)[0]
-                    cands_name = os.path.splitext(os.path.basename(cand_path))[0]
                     vecs_path = os.path.join(
                         model_dir, '.'.join([model_name, cands_name, 'vecs'])
                     )
@@ -845,10 +1003,13 @@ class TorchRankerAgent(TorchAgent):
                     enc_path = os.path.join(
                         model_dir, '.'.join([model_name, cands_name, 'encs'])
                     )
-                    if setting == 'reuse' and os.path.isfile(enc_path):
+                    encs_reused = setting == 'reuse' and os.path.isfile(enc_path)
+                    if encs_reused:
                         encs = self.load_candidates(enc_path, cand_type='encodings')
                     else:
-                        encs = self._make_candidate_encs(self.fixed_candidate_vecs)
+                        encs = self._make_candidate_encs(
+                            self.fixed_candidate_vecs, path=enc_path
+                        )
                         self._save_candidates(
                             encs, path=enc_path, cand_type='encodings'
                         )
@@ -859,6 +1020,17 @@ class TorchRankerAgent(TorchAgent):
                         self.fixed_candidate_encs = self.fixed_candidate_encs.half()
                     else:
                         self.fixed_candidate_encs = self.fixed_candidate_encs.float()
+
+                    index_type = self.opt.get('fixed_candidate_index', 'none')
+                    if index_type != 'none':
+                        index_path = os.path.join(
+                            model_dir,
+                            '.'.join([model_name, cands_name, index_type, 'index']),
+                        )
+                        # an index over encodings made just now is rebuilt too
+                        self.fixed_candidate_index = self._make_candidate_index(
+                            index_type, index_path, reuse=encs_reused
+                        )
                 else:
                     self.fixed_candidate_encs = None
 
@@ -867,26 +1039,94 @@ class TorchRankerAgent(TorchAgent):
                 self.fixed_candidate_vecs = None
                 self.fixed_candidate_encs = None
 
+    def _make_candidate_index(self, index_type, path, reuse=True):
+        """Load or build the index over the fixed candidate encodings."""
+        encs = self.fixed_candidate_encs
+        index = None
+        if reuse and os.path.isfile(path):
+            print("[ Loading fixed candidate index from {} ]".format(path))
+            try:
+                index = load_candidate_index(path, encs, index_type=index_type)
+            except ValueError as e:
+                # built for other candidates, or with other settings
+                print("[ {}, rebuilding it ]".format(e))
+            if isinstance(index, IVFIndex):
+                # only used when searching, so taken from the current options
+                index.nprobe = self.opt.get('candidate_index_nprobe', 8)
+        if index is None:
+            print("[ Building {} fixed candidate index ]".format(index_type))
+            index = build_candidate_index(
+                index_type,
+                encs,
+                nlist=self.opt.get('candidate_index_nlist', 0),
+                nprobe=self.opt.get('candidate_index_nprobe', 8),
+                num_subvectors=self.opt.get('candidate_index_subvectors', 8),
+            )
+            print("[ Saving fixed candidate index to {} ]".format(path))
+            index.save(path)
+        return index.to(encs.device)
+
     def load_candidates(self, path, cand_type='vectors'):
-        """Load fixed candidates from a path."""
+        """
+        Load fixed candidates from a path.
+
+        Files written with --memmap-fixed-candidates are memory-mapped.
+        """
         print("[ Loading fixed candidate set {} from {} ]".format(cand_type, path))
+        if is_memmap_file(path):
+            return load_memmap_tensor(path)
+        if self.opt.get('memmap_fixed_candidates'):
+            warn_once(
+                "[ Fixed candidate {} at {} can't be memory-mapped, loading them "
+                "into memory. Use --fixed-candidate-vecs replace to rewrite them. ]"
+                "".format(cand_type, path)
+            )
         return torch.load(path, map_location=lambda cpu, _: cpu)
 
     def _make_candidate_vecs(self, cands):
-        """Prebuild cached vectors for fixed candidates."""
+        """
+        Prebuild cached vectors for fixed candidates.
+
+        Batches of candidates are vectorized in --candidate-vectorize-workers
+        forked processes, if set.
+        """
+        global _VECTORIZE_AGENT
         cand_batches = [cands[i : i + 512] for i in range(0, len(cands), 512)]
+        num_workers = self.opt.get('candidate_vectorize_workers', 0)
+        if num_workers > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+            warn_once(
+                "[ Can't fork on this platform, ignoring "
+                "--candidate-vectorize-workers. ]"
+            )
+            num_workers = 0
         print(
             "[ Vectorizing fixed candidate set ({} batch(es) of up to 512) ]"
             "".format(len(cand_batches))
         )
         cand_vecs = []
-        for batch in tqdm(cand_batches):
-            cand_vecs.extend(self.vectorize_fixed_candidates(batch))
+        if num_workers > 0:
+            _VECTORIZE_AGENT = self
+            try:
+                ctx = multiprocessing.get_context('fork')
+                with ctx.Pool(num_workers) as pool:
+                    for vecs in tqdm(
+                        pool.imap(_vectorize_fixed_candidates_worker, cand_batches),
+                        total=len(cand_batches),
+                    ):
+                        cand_vecs.extend(torch.from_numpy(v) for v in vecs)
+            finally:
+                _VECTORIZE_AGENT = None
+        else:
+            for batch in tqdm(cand_batches):
+                cand_vecs.extend(self.vectorize_fixed_candidates(batch))
         return padded_3d([cand_vecs], dtype=cand_vecs[0].dtype).squeeze(0)
 
     def _save_candidates(self, vecs, path, cand_type='vectors'):
         """Save cached vectors."""
         print("[ Saving fixed candidate set {} to {} ]".format(cand_type, path))
+        if self.opt.get('memmap_fixed_candidates'):
+            save_memmap_tensor(vecs, path)
+            return
         with open(path, 'wb') as f:
             torch.save(vecs, f)
 
@@ -907,25 +1147,120 @@ class TorchRankerAgent(TorchAgent):
             '--encode-candidate-vecs True.'
         )
 
-    def _make_candidate_encs(self, vecs):
+    def _make_candidate_encs(self, vecs, path=None):
         """
         Encode candidates from candidate vectors.
 
         Requires encode_candidates() to be implemented.
+
+        Candidates are encoded in order of length, with their padding trimmed, in
+        batches of up to --candidate-encode-batch-tokens tokens. If path is given,
+        finished encodings are checkpointed in shards of
+        --candidate-encode-shard-size candidates in the directory
+        ``path + '.shards'``, so that an interrupted run resumes from the last
+        completed shard. The directory is removed once all candidates are encoded.
+        Checkpointing is disabled in distributed mode.
+
+        :param vecs:
+            a [num_cands, seq_len] LongTensor of padded candidate vectors
+        :param path:
+            where the encodings will be saved, if they will be
         """
+        lengths = (vecs != self.NULL_IDX).sum(1).cpu().numpy()
+        order = torch.from_numpy(np.argsort(lengths, kind='stable'))
+        shard_size = self.opt.get('candidate_encode_shard_size', 50000)
+        if shard_size <= 0:
+            shard_size = len(vecs)
+        shards = order.split(shard_size)
+
+        shard_dir = None
+        if path is not None and not is_distributed():
+            # in distributed mode every worker encodes the candidates, so they
+            # can't share a shard directory
+            shard_dir = path + '.shards'
+            self._init_candidate_shard_dir(shard_dir, vecs, shard_size)
 
-        cand_encs = []
-        vec_batches = [vecs[i : i + 256] for i in range(0, len(vecs), 256)]
         print(
-            "[ Encoding fixed candidates set from ({} batch(es) of up to 256) ]"
-            "".format(len(vec_batches))
+            "[ Encoding fixed candidates set ({} shard(s) of up to {}) ]"
+            "".format(len(shards), shard_size)
         )
         # Put model into eval mode when encoding candidates
         self.model.eval()
+        cand_encs = [None] * len(shards)
+        for i, shard in enumerate(tqdm(shards)):
+            shard_path = None
+            if shard_dir is not None:
+                shard_path = os.path.join(shard_dir, 'shard_{}'.format(i))
+                if os.path.isfile(shard_path):
+                    cand_encs[i] = torch.load(shard_path, map_location='cpu')
+                    continue
+            cand_encs[i] = self._encode_candidate_shard(vecs, lengths, shard)
+            if shard_path is not None:
+                # write then rename, so a crash never leaves a partial shard
+                with open(shard_path + '.tmp', 'wb') as f:
+                    torch.save(cand_encs[i], f)
+                os.replace(shard_path + '.tmp', shard_path)
+
+        cand_encs = torch.cat([e.to(vecs.device) for e in cand_encs], 0)
+        # undo the length sort
+        encs = torch.empty_like(cand_encs)
+        encs[order.to(encs.device)] = cand_encs
+        if shard_dir is not None:
+            shutil.rmtree(shard_dir)
+        return encs
+
+    def _encode_candidate_shard(self, vecs, lengths, inds):
+        """Encode the candidates at inds, which are sorted by length."""
+        budget = self.opt.get('candidate_encode_batch_tokens', 0)
+        shard_lengths = np.maximum(lengths[inds.numpy()], 1).tolist()
+        batches = []
+        start = 0
+        while start < len(inds):
+            if budget > 0:
+                # lengths are increasing, so the last candidate is the longest
+                end = start + 1
+                while (
+                    end < len(inds) and (end + 1 - start) * shard_lengths[end] <= budget
+                ):
+                    end += 1
+            else:
+                end = min(start + 256, len(inds))
+            batches.append((inds[start:end], shard_lengths[end - 1]))
+            start = end
+
+        shard_encs = []
         with torch.no_grad():
-            for vec_batch in tqdm(vec_batches):
-                cand_encs.append(self.encode_candidates(vec_batch))
-        return torch.cat(cand_encs, 0)
+            for batch_inds, max_len in batches:
+                batch = vecs[batch_inds.to(vecs.device), :max_len]
+                shard_encs.append(self.encode_candidates(batch).cpu())
+        return torch.cat(shard_encs, 0)
+
+    def _init_candidate_shard_dir(self, shard_dir, vecs, shard_size):
+        """
+        Set up the directory of checkpointed candidate encodings.
+
+        Existing shards are kept only if they were encoded by the same model from
+        the same candidate vectors; otherwise they are removed.
+        """
+        fingerprint = hashlib.sha1(str(shard_size).encode())
+        for tensor in [vecs] + list(self.model.state_dict().values()):
+            fingerprint.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        fingerprint = fingerprint.hexdigest()
+
+        fingerprint_path = os.path.join(shard_dir, 'fingerprint')
+        if os.path.isfile(fingerprint_path):
+            with open(fingerprint_path) as f:
+                if f.read() == fingerprint:
+                    print(
+                        "[ Resuming candidate encoding from shards in {} ]"
+                        "".format(shard_dir)
+                    )
+                    return
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+        with open(fingerprint_path, 'w') as f:
+            f.write(fingerprint)
 
     def vectorize_fixed_candidates(self, cands_batch, add_start=False, add_end=False):
         """
@@ -25,6 +25,13 @@ Worlds are the basic environments which define how agents interact with one anot
     ``BatchWorld(World)`` is a container for doing minibatch training over a world by
     collecting batches of N copies of the environment (each with different state).
 
+    ``DynamicBatchWorld(World)`` is like ``BatchWorld``, but batches examples of
+    similar length together, up to a maximum number of tokens per batch.
+
+    ``BackgroundPreprocessWorld(World)`` runs copies of a batch world in worker
+    processes, which read and vectorize the training data and build batches
+    while the agent trains on the previous ones.
+
 
 All worlds are initialized with the following parameters:
 
@@ -49,15 +56,21 @@ import time
 from functools import lru_cache
 
 try:
-    from torch.multiprocessing import Process, Value, Condition, Semaphore
+    from torch.multiprocessing import Process, Value, Condition, Semaphore, Queue
 except ImportError:
-    from multiprocessing import Process, Value, Semaphore, Condition  # noqa: F401
+    from multiprocessing import (  # noqa: F401
+        Process,
+        Value,
+        Semaphore,
+        Condition,
+        Queue,
+    )
 from parlai.core.agents import (
     create_agents_from_shared,
     create_task_agent_from_taskname,
 )
 from parlai.core.metrics import aggregate_metrics
-from parlai.utils.misc import Message, Timer, display_messages
+from parlai.utils.misc import Message, Timer, display_messages, warn_once
 from parlai.tasks.tasks import ids_to_tasks
 
 
@@ -842,6 +855,399 @@ class BatchWorld(World):
         self.world.shutdown()
 
 
+class DynamicBatchWorld(World):
+    """
+    DynamicBatchWorld batches examples of similar length up to a token budget.
+
+    Like ``BatchWorld``, it keeps many copies of a two-agent world, but it keeps
+    a pool of ``4 * batchsize`` of them. Each parley, every copy which isn't
+    waiting to be batched gets a new example from its teacher, which its agent
+    observes. Then the waiting examples are sorted by length, and a run of
+    similar length is batched, as many as fit in ``--max-tokens-per-batch``
+    tokens (number of examples times the longest example, counting both text
+    and label tokens), and at most ``--batchsize``. Only the copies in the
+    batch move on to their next example.
+    """
+
+    def __init__(self, opt, world):
+        super().__init__(opt)
+        self.opt = opt
+        if not isinstance(world, DialogPartnerWorld):
+            raise TypeError(
+                '--max-tokens-per-batch only supports worlds with a teacher and '
+                'one agent, not {}.'.format(type(world).__name__)
+            )
+        self.random = opt.get('datatype', None) == 'train'
+        self.world = world
+        self.max_tokens = opt['max_tokens_per_batch']
+        self.max_batchsize = opt['batchsize']
+        self.worlds = []
+        for i in range(4 * self.max_batchsize):
+            # each copy needs a distinct batchindex, which the agents use to
+            # find their replies in the shared batch_reply
+            shared = world.share()
+            shared['batchindex'] = i
+            for agent_shared in shared.get('agents', ''):
+                agent_shared['batchindex'] = i
+            _override_opts_in_shared(shared, {'batchindex': i})
+            self.worlds.append(shared['world_class'](opt, None, shared))
+        # observation and length of the example each copy is waiting on
+        self._observations = [None] * len(self.worlds)
+        self._lengths = [None] * len(self.worlds)
+        self._batch_reply = [{} for _ in self.worlds]
+        self.batch = []
+        self.acts = [None] * len(self.world.get_agents())
+
+    def _example_length(self, observation):
+        """Return the number of text and label tokens in an observation."""
+        if 'text_vec' in observation:
+            length = len(observation['text_vec'])
+        else:
+            length = len(observation.get('text', '').split())
+        for key in ['labels', 'eval_labels']:
+            if key + '_vec' in observation:
+                return length + len(observation[key + '_vec'])
+            if key in observation:
+                return length + len(next(iter(observation[key])).split())
+        return length
+
+    def _fill_pool(self):
+        """Get a new example for every copy that isn't waiting on one."""
+        for i, w in enumerate(self.worlds):
+            if self._observations[i] is not None or w.epoch_done():
+                continue
+            teacher, agent = w.get_agents()
+            acts = w.get_acts()
+            acts[0] = teacher.act()
+            observation = agent.observe(validate(acts[0]))
+            if observation is None:
+                raise ValueError('Agents should return what they observed.')
+            if 'text' not in observation and 'text_vec' not in observation:
+                # end of data, or an empty example: nothing to batch
+                continue
+            self._observations[i] = observation
+            self._lengths[i] = self._example_length(observation)
+
+    def _choose_batch(self):
+        """Choose which waiting copies to batch together."""
+        waiting = sorted(
+            (i for i, obs in enumerate(self._observations) if obs is not None),
+            key=lambda i: self._lengths[i],
+        )
+        if not waiting:
+            return []
+        # start at a random example when training, and from the longest
+        # otherwise, then add the examples of closest length while they fit
+        start = random.randrange(len(waiting)) if self.random else len(waiting) - 1
+        end = start + 1
+        longest = self._lengths[waiting[start]]
+        while end - start < self.max_batchsize and end < len(waiting):
+            length = self._lengths[waiting[end]]
+            if (end + 1 - start) * length > self.max_tokens:
+                break
+            longest = length
+            end += 1
+        while (
+            end - start < self.max_batchsize
+            and start > 0
+            and (end - start + 1) * longest <= self.max_tokens
+        ):
+            start -= 1
+        return waiting[start:end]
+
+    def parley(self):
+        """Batch a set of examples of similar length and act on them."""
+        self._fill_pool()
+        self.batch = self._choose_batch()
+        if not self.batch:
+            return
+
+        teacher_acts = [self.worlds[i].get_acts()[0] for i in self.batch]
+        agent = self.world.get_agents()[1]
+        if hasattr(agent, 'batch_act') and not (
+            hasattr(agent, 'use_batch_act') and not agent.use_batch_act
+        ):
+            batch_actions = agent.batch_act([self._observations[i] for i in self.batch])
+        else:
+            # Reverts to running on each individually.
+            batch_actions = [self.worlds[i].get_agents()[1].act() for i in self.batch]
+        replies = getattr(agent, 'replies', None)
+        if replies and replies.get('batch_reply') is not None:
+            # the agent copies look up their replies by their batchindex
+            for i, action in zip(self.batch, batch_actions):
+                self._batch_reply[i] = action
+            replies['batch_reply'] = self._batch_reply
+
+        for i, action in zip(self.batch, batch_actions):
+            w = self.worlds[i]
+            w.get_acts()[1] = action
+            w.get_agents()[0].observe(validate(action))
+            self._observations[i] = None
+            self._lengths[i] = None
+        self.acts = [teacher_acts, batch_actions]
+        self.update_counters()
+
+    def update_counters(self):
+        """Update how many examples and epochs have completed."""
+        self.total_parleys += 1
+        self.total_exs += len(self.batch)
+        if self.num_examples():
+            self.total_epochs = self.total_exs / self.num_examples()
+        elif self.epoch_done():
+            self.total_epochs += 1
+
+    def display(self):
+        """Display the last batch."""
+        s = "[--batchsize " + str(len(self.batch)) + "--]\n"
+        for i in self.batch:
+            s += "[batch world " + str(i) + ":]\n"
+            s += self.worlds[i].display() + '\n'
+        s += "[--end of batch--]"
+        return s
+
+    def num_examples(self):
+        """Return the number of examples for the root world."""
+        return self.world.num_examples()
+
+    def num_episodes(self):
+        """Return the number of episodes for the root world."""
+        return self.world.num_episodes()
+
+    def getID(self):
+        """Return the ID of the root world."""
+        return self.world.getID()
+
+    def get_agents(self):
+        """Return the agents of the root world."""
+        return self.world.get_agents()
+
+    def get_task_agent(self):
+        """Return task agent of the root world."""
+        return self.world.get_task_agent()
+
+    def episode_done(self):
+        """
+        Return whether the episode is done.
+
+        A batch world is never finished, so this always returns `False`.
+        """
+        return False
+
+    def epoch_done(self):
+        """Return if every copy is done and no examples are left to batch."""
+        if self.world.epoch_done():
+            return True
+        if any(obs is not None for obs in self._observations):
+            return False
+        return all(w.epoch_done() for w in self.worlds)
+
+    def report(self):
+        """Report metrics for the root world."""
+        return self.world.report()
+
+    def reset(self):
+        """Reset the root world, all copies, and the examples waiting."""
+        self.world.reset()
+        for w in self.worlds:
+            w.reset()
+        self._observations = [None] * len(self.worlds)
+        self._lengths = [None] * len(self.worlds)
+        self.batch = []
+
+    def reset_metrics(self):
+        """Reset metrics in the root world."""
+        self.world.reset_metrics()
+
+    def save_agents(self):
+        """Save the agents in the root world."""
+        self.world.save_agents()
+
+    def shutdown(self):
+        """Shutdown each world."""
+        for w in self.worlds:
+            w.shutdown()
+        self.world.shutdown()
+
+
+class BackgroundPreprocessProcess(Process):
+    """
+    Process child used for ``BackgroundPreprocessWorld``.
+
+    Each process parleys in its own copy of the batch world, forked from the
+    main process, but the agent in it only builds batches: every batch of
+    observations is batchified and put in the queue, for the agent in the main
+    process to act on.
+    """
+
+    def __init__(self, world, queue, seed):
+        self.world = world
+        self.queue = queue
+        self.seed = seed
+        super().__init__(daemon=True)
+
+    def _batch_act(self, observations):
+        """Queue a batch instead of acting on it."""
+        self.queue.put((observations, self.agent.batchify(observations)))
+        self.agent.replies['batch_reply'] = None
+        return [
+            Message({'id': self.agent.getID(), 'episode_done': False})
+            for _ in observations
+        ]
+
+    def run(self):
+        """Build batches forever."""
+        import torch
+
+        # don't sample the same examples as the other workers
+        random.seed(self.seed)
+        torch.manual_seed(self.seed)
+        torch.set_num_threads(1)
+        self.agent = self.world.get_agents()[1]
+        # batches move to the GPU in the main process
+        self.agent.use_cuda = False
+        self.agent.batch_act = self._batch_act
+        while True:
+            self.world.parley()
+
+
+class BackgroundPreprocessWorld(World):
+    """
+    Prepare batches in worker processes while the agent trains.
+
+    Reading examples from the teacher and vectorizing them in the agent's
+    ``observe`` run on the same thread as the model otherwise, which then sits
+    idle. This world forks ``--preprocess-workers`` processes, each running
+    its own copy of the batch world: its teachers act, its agent copies
+    observe, so each batch row keeps its own episode and history, and the
+    agent batchifies the observations. Batches are prefetched into a queue of
+    at most ``--preprocess-queue-size`` batches, and the agent in the main
+    process acts on them, with the teacher's metrics updated from the labels.
+
+    Only training is supported, and the agent must be a ``TorchAgent``. Since
+    the workers can't see the agent's replies, ``--use-reply model`` is not
+    supported. Ordered data is read by a single worker, so that each example
+    is seen once per epoch.
+    """
+
+    def __init__(self, opt, world):
+        super().__init__(opt)
+        self.opt = opt
+        self.world = world
+        agent = world.get_agents()[1]
+        if not hasattr(agent, 'batchify'):
+            raise TypeError(
+                '--preprocess-workers only supports agents which batchify their '
+                'observations, like TorchAgent, not {}.'.format(type(agent).__name__)
+            )
+        if opt.get('use_reply') == 'model':
+            raise RuntimeError(
+                '--preprocess-workers does not support --use-reply model, since '
+                'the workers build the history before the model replies.'
+            )
+        self.agent = agent
+        num_workers = opt['preprocess_workers']
+        if opt['datatype'] != 'train' and num_workers > 1:
+            warn_once(
+                'Ordered data is preprocessed by one worker, so that each example '
+                'is only seen once per epoch.'
+            )
+            num_workers = 1
+        self.queue = Queue(maxsize=opt.get('preprocess_queue_size', 8))
+        self.workers = [
+            BackgroundPreprocessProcess(world, self.queue, random.randrange(2 ** 31))
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self.acts = [None, None]
+
+    def parley(self):
+        """Act on the next batch prepared by the workers."""
+        observations, batch = self.queue.get()
+        batch_actions = self.agent.batch_act(observations, batch=batch)
+        # the teachers are in the workers, so update their metrics here
+        labels = [o.get('labels', o.get('eval_labels')) for o in observations]
+        self.world.get_task_agent().metrics.batch_update(
+            [a for a, l in zip(batch_actions, labels) if l is not None],
+            [l for l in labels if l is not None],
+        )
+        self.acts = [observations, batch_actions]
+        self.update_counters()
+
+    def update_counters(self):
+        """Update how many examples and epochs have completed."""
+        self.total_parleys += 1
+        self.total_exs += len(self.acts[0])
+        if self.num_examples():
+            self.total_epochs = self.total_exs / self.num_examples()
+
+    def display(self):
+        """Display the last batch."""
+        s = "[--batchsize " + str(len(self.acts[0])) + "--]\n"
+        for i, (observation, action) in enumerate(zip(*self.acts)):
+            s += "[batch row " + str(i) + ":]\n"
+            s += display_messages([observation, action]) + '\n'
+        s += "[--end of batch--]"
+        return s
+
+    def num_examples(self):
+        """Return the number of examples for the batch world."""
+        return self.world.num_examples()
+
+    def num_episodes(self):
+        """Return the number of episodes for the batch world."""
+        return self.world.num_episodes()
+
+    def getID(self):
+        """Return the ID of the batch world."""
+        return self.world.getID()
+
+    def get_agents(self):
+        """Return the agents of the batch world."""
+        return self.world.get_agents()
+
+    def get_task_agent(self):
+        """Return task agent of the batch world."""
+        return self.world.get_task_agent()
+
+    def episode_done(self):
+        """
+        Return whether the episode is done.
+
+        The workers always have batches in progress, so this returns `False`.
+        """
+        return False
+
+    def epoch_done(self):
+        """
+        Return whether the epoch is done.
+
+        Training data is never exhausted, so this always returns `False`.
+        """
+        return False
+
+    def report(self):
+        """Report metrics for the batch world."""
+        return self.world.report()
+
+    def reset_metrics(self):
+        """Reset metrics in the batch world."""
+        self.world.reset_metrics()
+
+    def save_agents(self):
+        """Save the agents in the batch world."""
+        self.world.save_agents()
+
+    def shutdown(self):
+        """Stop the workers, and shutdown the batch world."""
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.queue.cancel_join_thread()
+        self.world.shutdown()
+
+
 class HogwildProcess(Process):
     """
     Process child used for ``HogwildWorld``.
@@ -871,7 +1277,7 @@ class HogwildProcess(Process):
         """
         world = self.shared['world_class'](self.opt, None, self.shared)
         if self.opt.get('batchsize', 1) > 1:
-            world = BatchWorld(self.opt, world)
+            world = _batch_world(self.opt, world)
         self.sync['threads_sem'].release()
         with world:
             while True:
@@ -1221,8 +1627,36 @@ def create_task(opt, user_agents, default_world=None):
         # use hogwild world if more than one thread requested
         # hogwild world will create sub batch worlds as well if bsz > 1
         world = HogwildWorld(opt, world)
+    elif _preprocess_in_background(opt, user_agents):
+        # build batches in background processes
+        world = BackgroundPreprocessWorld(opt, _batch_world(opt, world))
     elif opt.get('batchsize', 1) > 1:
         # otherwise check if should use batchworld
-        world = BatchWorld(opt, world)
+        world = _batch_world(opt, world)
 
     return world
+
+
+def _preprocess_in_background(opt, user_agents):
+    """Return whether to build training batches in background processes."""
+    return (
+        opt.get('preprocess_workers', 0) > 0
+        and opt['datatype'].startswith('train')
+        and 'evalmode' not in opt['datatype']
+        # not e.g. for the dictionary, while it is built
+        and all(hasattr(agent, 'batchify') for agent in user_agents)
+    )
+
+
+def _batch_world(opt, world):
+    """Wrap world in a batch world, batching by tokens if requested."""
+    if opt.get('max_tokens_per_batch', -1) > 0:
+        if isinstance(world, DialogPartnerWorld):
+            return DynamicBatchWorld(opt, world)
+        warn_once(
+            '--max-tokens-per-batch only supports worlds with a teacher and one '
+            'agent, not {}. Batching by --batchsize instead.'.format(
+                type(world).__name__
+            )
+        )
+    return BatchWorld(opt, world)
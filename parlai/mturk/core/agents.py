@@ -6,7 +6,7 @@
 
 import logging
 import time
-from queue import Queue
+from queue import Queue, Empty
 import uuid
 
 from parlai.core.agents import Agent
@@ -358,8 +358,12 @@ class MTurkAgent(Agent):
         self.msg_queue = None
         self.recieved_packets = None
 
-    def get_new_act_message(self):
-        """Get a new act message if one exists, return None otherwise"""
+    def get_new_act_message(self, wait=0):
+        """Get a new act message if one exists, return None otherwise
+
+        :param wait:
+            seconds to wait for a message to arrive before returning None
+        """
         # See if any agent has disconnected
         if self.disconnected or self.some_agent_disconnected:
             return self._get_episode_done_msg(MTURK_DISCONNECT_MESSAGE)
@@ -368,12 +372,16 @@ class MTurkAgent(Agent):
         if self.hit_is_returned:
             return self._get_episode_done_msg(RETURN_MESSAGE)
 
-        if self.msg_queue is not None:
-            # Check if Turker sends a message
-            while not self.msg_queue.empty():
-                msg = self.msg_queue.get()
-                if msg['id'] == self.id:
-                    return msg
+        msg_queue = self.msg_queue
+        if msg_queue is not None:
+            # Check if Turker sends a message, waiting for the first one
+            try:
+                msg = msg_queue.get(timeout=wait) if wait else msg_queue.get_nowait()
+                while msg['id'] != self.id:
+                    msg = msg_queue.get_nowait()
+                return msg
+            except Empty:
+                pass
 
         # There are no messages to be sent
         return None
@@ -446,9 +454,10 @@ class MTurkAgent(Agent):
             if timeout:
                 start_time = time.time()
 
-            # Wait for agent's new message
+            # Wait for agent's new message, waking up periodically to check
+            # for disconnects and timeouts
             while True:
-                msg = self.get_new_act_message()
+                msg = self.get_new_act_message(wait=shared_utils.THREAD_SHORT_SLEEP)
                 self.message_request_time = None
                 if msg is not None:
                     if onboard is not None:
@@ -465,7 +474,6 @@ class MTurkAgent(Agent):
                     if (current_time - start_time) > timeout:
                         self.message_request_time = None
                         return self.prepare_timeout()
-                time.sleep(shared_utils.THREAD_SHORT_SLEEP)
 
     def episode_done(self):
         """Return whether or not this agent believes the conversation to
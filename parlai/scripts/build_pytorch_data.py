@@ -11,20 +11,50 @@ such that each episode is one example for a model.
 
 One can set the ``--context-len`` flag to specify how many past utterances
 are used in a flattened episode.
+
+With ``--pytorch-data-format binary``, the examples are vectorized by the agent
+and the token ids of their text, labels and label candidates are stored in flat
+int32 arrays, which the PytorchDataTeacher memory-maps instead of parsing JSON
+and tokenizing the text again every epoch. The data is built once for each
+dictionary and tokenizer, identified by a hash of them.
 """
 from parlai.core.agents import create_agent
 from parlai.core.message import Message
 from parlai.core.worlds import create_task
 from parlai.scripts.build_dict import build_dict, setup_args as dict_setup
+from parlai.utils.memmap import (
+    MemmapTextsWriter,
+    MemmapVectorsWriter,
+    build_line_offsets,
+)
 import copy
+import hashlib
 import os
 import json
 import random
-import collections
+import collections.abc
+import numpy as np
 import torch
 import tqdm
+from array import array
 from collections import deque
 
+# vector fields stored in separate flat arrays in the binary data format
+BINARY_VEC_FIELDS = ['text_vec', 'labels_vec', 'eval_labels_vec']
+BINARY_CANDS_FIELD = 'label_candidates_vecs'
+# options which change how an agent vectorizes its observations
+VECTORIZE_OPTS = [
+    'text_truncate',
+    'label_truncate',
+    'truncate',
+    'history_size',
+    'delimiter',
+    'person_tokens',
+    'split_lines',
+    'add_p1_after_newln',
+    'rank_candidates',
+]
+
 
 def get_pyt_dict_file(opt):
     if opt.get('dict_file') and os.path.exists(opt.get('dict_file')):
@@ -54,9 +84,9 @@ def make_serializable(obj):
     for key, val in obj.items():
         if isinstance(val, (int, str, bytes, dict, list, tuple, bool)):
             new_obj[key] = val
-        elif isinstance(val, collections.Mapping):
+        elif isinstance(val, collections.abc.Mapping):
             new_obj[key] = dict(val)
-        elif isinstance(val, collections.Sequence):
+        elif isinstance(val, collections.abc.Sequence):
             new_obj[key] = list(val)
         elif torch.is_tensor(val):
             new_obj[key] = {
@@ -67,10 +97,181 @@ def make_serializable(obj):
     return new_obj
 
 
+def get_vectorization_hash(agent):
+    """
+    Hash the dictionary and tokenizer options an agent vectorizes text with.
+
+    Binary data is only valid for the vectorization it was built with, so this
+    hash is part of its path.
+    """
+    dictionary = getattr(agent, 'dict', None)
+    if dictionary is None:
+        raise RuntimeError(
+            '--pytorch-data-format binary requires an agent with a dictionary, '
+            'such as a TorchAgent'
+        )
+    digest = hashlib.sha1()
+    for idx, tok in sorted(dictionary.ind2tok.items()):
+        digest.update('{}\t{}\n'.format(idx, tok).encode('utf-8'))
+    opts = {
+        k: v
+        for k, v in agent.opt.items()
+        if k in VECTORIZE_OPTS
+        or (k.startswith('dict_') and k not in ('dict_file', 'dict_maxexs'))
+    }
+    digest.update(json.dumps(opts, sort_keys=True, default=str).encode('utf-8'))
+    codecs = '{}.codecs'.format(agent.opt.get('dict_file'))
+    if os.path.isfile(codecs):
+        # bpe merges
+        with open(codecs, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class BinaryDataWriter(object):
+    """
+    Write vectorized examples in the binary pytorch data format.
+
+    The vectors of each field in BINARY_VEC_FIELDS are written to a flat int32
+    array ``<field>`` with a table of their positions ``<field>.offsets``.
+    Label candidate vectors are written the same way, with the range of the
+    candidates of each example in ``label_candidates_vecs.rows``.
+
+    The remaining fields are stored by column, with the kind of each column in
+    ``columns``: bools and numbers in an array ``column.<field>.values`` with a
+    mask of the examples which have the field, strings with MemmapTextsWriter,
+    and lists of strings, such as labels, as a list of strings plus the range of
+    each example's strings in ``column.<field>.rows``. Any field which doesn't fit its
+    column is written in a line of JSON in ``fields``, which is empty for most
+    examples.
+    """
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.vecs = {
+            field: self._writer(field)
+            for field in BINARY_VEC_FIELDS + [BINARY_CANDS_FIELD]
+        }
+        self.cand_rows = array('q')
+        self.columns = {}
+        self.values = {}
+        self.texts = {}
+        self.rows = {}
+        self.num_exs = 0
+        self.fields = open(os.path.join(datapath, 'fields'), 'w')
+
+    def _writer(self, name, writer_class=MemmapVectorsWriter):
+        path = os.path.join(self.datapath, name)
+        return writer_class(path, path + '.offsets')
+
+    def _add_rows(self, rows, strings, writer):
+        while len(rows) < 2 * self.num_exs:
+            rows.extend((-1, -1))
+        rows.extend((len(writer), len(writer) + len(strings)))
+        for string in strings:
+            writer.add(string)
+
+    def _add_column(self, field, value):
+        """Store a field in its column, and return whether it fit."""
+        kind = _column_kind(value)
+        if kind is None:
+            return False
+        if field not in self.columns:
+            self.columns[field] = kind
+            if kind in ('str', 'strs'):
+                self.texts[field] = self._writer('column.' + field, MemmapTextsWriter)
+            if kind == 'strs':
+                self.rows[field] = array('q')
+            elif kind != 'str':
+                self.values[field] = {}
+        if self.columns[field] != kind:
+            return False
+        if kind == 'strs':
+            self._add_rows(self.rows[field], value, self.texts[field])
+        elif kind == 'str':
+            writer = self.texts[field]
+            while len(writer) < self.num_exs:
+                writer.add(None)
+            writer.add(value)
+        else:
+            self.values[field][self.num_exs] = value
+        return True
+
+    def write(self, ex):
+        """Write an example."""
+        ex = dict(ex)
+        for field in BINARY_VEC_FIELDS:
+            self.vecs[field].add(ex.pop(field, None))
+        cands = ex.pop(BINARY_CANDS_FIELD, None)
+        if cands is None:
+            self.cand_rows.extend((-1, -1))
+        else:
+            self._add_rows(self.cand_rows, cands, self.vecs[BINARY_CANDS_FIELD])
+        rest = {k: v for k, v in ex.items() if not self._add_column(k, v)}
+        self.fields.write((json.dumps(make_serializable(rest)) if rest else '') + '\n')
+        self.num_exs += 1
+
+    def _save(self, name, array_):
+        with open(os.path.join(self.datapath, name), 'wb') as f:
+            np.save(f, array_)
+
+    def _save_rows(self, name, rows):
+        while len(rows) < 2 * self.num_exs:
+            rows.extend((-1, -1))
+        self._save(name, np.frombuffer(rows, dtype=np.int64).reshape(-1, 2))
+
+    def close(self):
+        """Finish writing, and save the offset tables."""
+        for writer in self.vecs.values():
+            writer.close()
+        self._save_rows(BINARY_CANDS_FIELD + '.rows', self.cand_rows)
+        for field, writer in self.texts.items():
+            while len(writer) < self.num_exs:
+                writer.add(None)
+            writer.close()
+        for field, rows in self.rows.items():
+            self._save_rows('column.' + field + '.rows', rows)
+        for field, values in self.values.items():
+            column = np.zeros(self.num_exs, dtype=self.columns[field])
+            mask = np.zeros(self.num_exs, dtype=bool)
+            index = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+            column[index] = list(values.values())
+            mask[index] = True
+            self._save('column.' + field + '.values', column)
+            self._save('column.' + field + '.mask', mask)
+        with open(os.path.join(self.datapath, 'columns'), 'w') as f:
+            json.dump(self.columns, f)
+        self.fields.close()
+        path = os.path.join(self.datapath, 'fields')
+        build_line_offsets(path, path + '.offsets')
+
+
+def _column_kind(value):
+    """
+    Return the kind of column which can store a value in the binary format.
+
+    This is the numpy dtype of bools and numbers, 'str' for strings or 'strs'
+    for lists of strings, or None if the value has to be stored as JSON.
+    """
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int64' if -(2 ** 63) <= value < 2 ** 63 else None
+    if isinstance(value, float):
+        return 'float64'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return 'strs'
+    return None
+
+
 def build_data(opt):
     if not opt.get('model', False):
         opt['model'] = 'repeat_label'
-    preprocess = opt.get('pytorch_preprocess', True)
+    binary = opt.get('pytorch_data_format', 'json') == 'binary'
+    # the binary format stores the agent's vectors
+    preprocess = opt.get('pytorch_preprocess', True) or binary
     opt['dict_file'] = get_pyt_dict_file(opt)
     dictionary = None
     if 'dict_maxexs' in opt:
@@ -115,6 +316,8 @@ def build_data(opt):
     )
     if preprocess:
         datapath += '_{}_preprocess'.format(agent.getID().replace(':', '_'))
+    if binary:
+        datapath += '_binary_{}'.format(get_vectorization_hash(agent))
     if os.path.isdir(datapath) and 'data_length' in os.listdir(datapath):
         # Data already built
         print("[ pytorch data already built, at {}. ]".format(datapath))
@@ -138,43 +341,54 @@ def build_data(opt):
     )
     idx_to_char = []
     cumulative_char_len = 0
+    if binary:
+        binary_data = BinaryDataWriter(datapath)
+    else:
+        pytorch_data = open(os.path.join(datapath, 'data'), 'w')
     # pass examples to dictionary
-    with open(os.path.join(datapath, 'data'), 'w') as pytorch_data:
-        while num_exs < total_exs:
-            while not episode_done:
-                # TODO: eventually all teachers should return Messages, so
-                # we should assert this
-                action = Message(teacher.act())
-                current.append(action)
-                episode_done = action.get('episode_done', False)
-
-            # build separate episodes
-            for ex in current:
-                context.append(ex.get('text', ''))
-                if len(context) > 1:
-                    ex.force_set('text', '\n'.join(context))
-                ex.force_set('episode_done', True)
-                labels = ex.get('labels', ex.get('eval_labels', None))
-                if labels is not None and include_labels:
-                    context.append(random.choice(labels))
-                # generate observation from new example
-                if preprocess:
-                    ex = agent.observe(ex)
+    while num_exs < total_exs:
+        while not episode_done:
+            # TODO: eventually all teachers should return Messages, so
+            # we should assert this
+            action = Message(teacher.act())
+            current.append(action)
+            episode_done = action.get('episode_done', False)
+
+        # build separate episodes
+        for ex in current:
+            context.append(ex.get('text', ''))
+            if len(context) > 1:
+                ex.force_set('text', '\n'.join(context))
+            ex.force_set('episode_done', True)
+            labels = ex.get('labels', ex.get('eval_labels', None))
+            if labels is not None and include_labels:
+                context.append(random.choice(labels))
+            # generate observation from new example
+            if preprocess:
+                ex = agent.observe(ex)
+                if not (binary and BINARY_CANDS_FIELD in ex):
                     ex.pop('label_candidates', '')
-                    ex['preprocessed'] = True
-                num_eps += 1
-                num_exs += 1
-                pbar.update(1)
-                ex_len = pytorch_data.write(json.dumps(make_serializable(ex)) + "\n")
-                idx_to_char.append(cumulative_char_len)
-                cumulative_char_len += ex_len
-            # reset
-            episode_done = False
-            current.clear()
-            context.clear()
+                ex['preprocessed'] = True
+            num_eps += 1
+            num_exs += 1
+            pbar.update(1)
+            if binary:
+                binary_data.write(ex)
+                continue
+            ex_len = pytorch_data.write(json.dumps(make_serializable(ex)) + "\n")
+            idx_to_char.append(cumulative_char_len)
+            cumulative_char_len += ex_len
+        # reset
+        episode_done = False
+        current.clear()
+        context.clear()
     pbar.close()
-    with open(os.path.join(datapath, 'char_index'), 'w') as char_index:
-        json.dump(idx_to_char, char_index)
+    if binary:
+        binary_data.close()
+    else:
+        pytorch_data.close()
+        with open(os.path.join(datapath, 'char_index'), 'w') as char_index:
+            json.dump(idx_to_char, char_index)
     with open(os.path.join(datapath, 'data_length'), 'w') as pytorch_data_len:
         pytorch_data_len.write(json.dumps({'num_eps': num_eps, 'num_exs': num_exs}))
     if dictionary:
@@ -30,6 +30,8 @@ An example sbatch script is below, for a 2-host, 8-GPU setup (16 total gpus):
   srun python -u -m parlai.scripts.distributed_train \
     -m seq2seq -t convai2 --dict-file /path/to/dict-file
 
+On CPU-only clusters, drop ``--gres`` and add ``--no-cuda``: workers will then
+communicate over the gloo backend, each pinned to its share of the task's cores.
 """
 
 import os
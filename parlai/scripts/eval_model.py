@@ -19,10 +19,18 @@ Examples
 from parlai.core.params import ParlaiParser, print_announcements
 from parlai.core.agents import create_agent
 from parlai.core.logs import TensorboardLogger
-from parlai.core.metrics import aggregate_task_reports
+from parlai.core.metrics import (
+    aggregate_task_reports,
+    get_metrics_states,
+    load_metrics_states,
+    merge_metric_states,
+)
+from parlai.core.teachers import FixedDialogTeacher
 from parlai.core.worlds import create_task
+from parlai.utils.distributed import override_print
 from parlai.utils.misc import TimeLogger
 
+import multiprocessing
 import random
 
 
@@ -53,12 +61,29 @@ def setup_args(parser=None):
         'ppl,f1,accuracy,hits@1,rouge,bleu'
         'the rouge metrics will be computed as rouge-1, rouge-2 and rouge-l',
     )
+    parser.add_argument(
+        '--metrics-workers',
+        type=int,
+        default=0,
+        hidden=True,
+        help='Score predictions in this many background processes, instead of '
+        'in the main loop. Worth it for --metrics all on generation tasks.',
+    )
+    parser.add_argument(
+        '--eval-workers',
+        type=int,
+        default=1,
+        help='Evaluate in this many processes. Each loads the model once, and '
+        'evaluates a disjoint shard of the episodes of every task. Metrics are '
+        'merged exactly at the end.',
+    )
     TensorboardLogger.add_cmdline_args(parser)
     parser.set_defaults(datatype='valid')
     return parser
 
 
-def _eval_single_world(opt, agent, task):
+def _run_single_world(opt, agent, task):
+    """Evaluate the agent on one task, and return the world afterwards."""
     print(
         '[ Evaluating task {} using datatype {}. ] '.format(
             task, opt.get('datatype', 'N/A')
@@ -67,6 +92,12 @@ def _eval_single_world(opt, agent, task):
     task_opt = opt.copy()  # copy opt since we're editing the task
     task_opt['task'] = task
     world = create_task(task_opt, agent)  # create worlds for tasks
+    if opt.get('num_shards', 1) > 1 and not isinstance(
+        world.get_task_agent(), FixedDialogTeacher
+    ):
+        raise TypeError(
+            '--eval-workers requires a teacher derived from FixedDialogTeacher.'
+        )
 
     # set up logging
     log_every_n_secs = opt.get('log_every_n_secs', -1)
@@ -89,11 +120,106 @@ def _eval_single_world(opt, agent, task):
             text, report = log_time.log(report['exs'], world.num_examples(), report)
             print(text)
 
+    return world
+
+
+def _eval_single_world(opt, agent, task):
+    world = _run_single_world(opt, agent, task)
     report = world.report()
     world.reset()
     return report
 
 
+# the agent of an --eval-workers process, loaded once and reused for every task
+_shard_agent = None
+
+
+def _get_shard_agent(opt):
+    global _shard_agent
+    if _shard_agent is None:
+        _shard_agent = create_agent(opt, requireModelExists=True)
+    return _shard_agent
+
+
+def _eval_shard(opt, shard_id, num_shards):
+    """
+    Evaluate every task on one shard of its episodes.
+
+    Run in a separate process for each shard.
+
+    :return: for each task, the metric counters of each agent in its world.
+    """
+    random.seed(42)
+    opt = opt.copy()
+    opt['shard_id'] = shard_id
+    opt['num_shards'] = num_shards
+    if opt['num_examples'] > 0:
+        # split the examples as evenly as the episodes
+        num_examples = opt['num_examples']
+        opt['num_examples'] = num_examples // num_shards + (
+            shard_id < num_examples % num_shards
+        )
+
+    # only the first worker logs progress
+    with override_print(suppress=shard_id > 0):
+        agent = _get_shard_agent(opt)
+        states = []
+        for task in opt['task'].split(','):
+            world = _run_single_world(opt, agent, task)
+            states.append(get_metrics_states(world))
+            world.reset()
+    return states
+
+
+def _report_shards(opt, task_states):
+    """
+    Load the merged metric counters of each task into a world, and report them.
+
+    Run in one of the worker processes, so the agent is already loaded there.
+    """
+    with override_print(suppress=True):
+        agent = _get_shard_agent(opt)
+        reports = []
+        for task, states in zip(opt['task'].split(','), task_states):
+            task_opt = opt.copy()
+            task_opt['task'] = task
+            world = create_task(task_opt, agent)
+            load_metrics_states(world, states)
+            reports.append(world.report())
+            world.reset()
+    return reports
+
+
+def _eval_sharded(opt):
+    """
+    Evaluate the tasks in --eval-workers processes, and merge their metrics.
+
+    The merged counters are reported by a world of one of the workers, so the
+    reports are exactly those of a single process evaluation, and the model is
+    never loaded in this process.
+    """
+    if 'stream' in opt['datatype']:
+        raise ValueError('--eval-workers does not support streaming datatypes.')
+    num_shards = opt['eval_workers']
+    if opt['num_examples'] > 0:
+        # every shard needs some of the examples, as 0 means all of them
+        num_shards = min(num_shards, opt['num_examples'])
+    # spawn, rather than fork, so workers may use their own GPU contexts
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(num_shards) as pool:
+        shard_states = pool.starmap(
+            _eval_shard, [(opt, i, num_shards) for i in range(num_shards)]
+        )
+        task_states = [
+            [
+                merge_metric_states(agent_states)
+                for agent_states in zip(*[states[i] for states in shard_states])
+            ]
+            for i in range(len(opt['task'].split(',')))
+        ]
+        return pool.apply(_report_shards, (opt, task_states))
+
+
 def eval_model(opt, print_parser=None):
     """Evaluates a model.
 
@@ -103,19 +229,24 @@ def eval_model(opt, print_parser=None):
     :return: the final result of calling report()
     """
     random.seed(42)
-
-    # load model and possibly print opt
-    agent = create_agent(opt, requireModelExists=True)
-    if print_parser:
-        # show args after loading model
-        print_parser.opt = agent.opt
-        print_parser.print_args()
-
     tasks = opt['task'].split(',')
-    reports = []
-    for task in tasks:
-        task_report = _eval_single_world(opt, agent, task)
-        reports.append(task_report)
+
+    if opt.get('eval_workers', 1) > 1:
+        # the model is only loaded in the workers
+        if print_parser:
+            print_parser.print_args()
+        reports = _eval_sharded(opt)
+    else:
+        # load model and possibly print opt
+        agent = create_agent(opt, requireModelExists=True)
+        if print_parser:
+            # show args after loading model
+            print_parser.opt = agent.opt
+            print_parser.print_args()
+        reports = []
+        for task in tasks:
+            task_report = _eval_single_world(opt, agent, task)
+            reports.append(task_report)
 
     report = aggregate_task_reports(
         reports, tasks, micro=opt.get('aggregate_micro', True)
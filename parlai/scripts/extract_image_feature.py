@@ -18,6 +18,15 @@ To extract the image feature of COCO images:
 
   python examples/extract_image_feature.py -t vqa_v1 -im resnet152
 
+To run the CNN on batches of 64 images decoded by 8 processes, and keep the
+features in a single store rather than one file per image:
+
+.. code-block:: shell
+
+  python examples/extract_image_feature.py -t vqa_v1 -im resnet152 -bs 64 \\
+    --image-extract-batchsize 64 --image-decode-workers 8 \\
+    --image-feature-store true
+
 """
 import importlib
 import h5py
@@ -28,6 +37,7 @@ import datetime
 import tqdm
 
 from parlai.core.params import ParlaiParser
+from parlai.core.image_featurizers import flush_feature_stores
 from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
 from parlai.core.worlds import create_task
 
@@ -95,7 +105,8 @@ def extract_feats(opt):
     opt['gpu'] = 0
     opt['num_epochs'] = 1
     opt['use_hdf5'] = False
-    opt['num_load_threads'] = 20
+    # enough loading threads to fill the batches of the CNN
+    opt['num_load_threads'] = max(20, opt.get('image_extract_batchsize', 1))
     print("[ Loading Images ]")
     # create repeat label agent and assign it to the specified task
     if opt.get('pytorch_teacher_dataset') is None:
@@ -108,6 +119,7 @@ def extract_feats(opt):
             world.parley()
             pbar.update()
         pbar.close()
+        flush_feature_stores()
     elif opt.get('use_hdf5_extraction', False):
         # TODO Deprecate
         '''One can specify a Pytorch Dataset for custom image loading'''
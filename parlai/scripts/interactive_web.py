@@ -3,15 +3,32 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
-"""Talk with a model using a web UI."""
+"""
+Talk with a model using a web UI.
 
+Each session, identified by a ``session_id`` cookie or an ``X-Session-Id``
+header, talks to its own copy of the model, so conversations keep separate
+histories. Concurrent requests are answered by a pool of ``--workers`` model
+copies, and models which implement ``batch_act`` answer up to
+``--max-batch-size`` of them at once. Beyond ``--max-pending`` requests in
+flight, the server answers with 503. ``/health`` and ``/metrics`` report on the
+state of the server.
+"""
 
+
+from collections import OrderedDict
+from http.cookies import SimpleCookie
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from parlai.scripts.interactive import setup_args
-from parlai.core.agents import create_agent
+from parlai.core.agents import create_agent, create_agent_from_shared
 from parlai.core.worlds import create_task
+from parlai.chat_service.core.batching import BotBatcher
 
 import json
+import threading
+import time
+import uuid
 
 HOST_NAME = 'localhost'
 PORT = 8080
@@ -155,14 +172,102 @@ WEB_HTML = """
 """  # noqa: E501
 
 
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle each request in its own thread."""
+
+    daemon_threads = True
+    # queue bursts of connections rather than refusing them
+    request_queue_size = 128
+
+
+class Session(object):
+    """The model copy holding a single conversation."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+
+
+def get_session(session_id):
+    """
+    Return the session with the given id, creating it if needed.
+
+    Only the ``--max-sessions`` most recently used sessions are kept.
+    """
+    with SHARED['lock']:
+        sessions = SHARED['sessions']
+        if session_id in sessions:
+            sessions.move_to_end(session_id)
+            return sessions[session_id]
+        if SHARED['batcher'] is not None:
+            bot = SHARED['batcher'].create_bot()
+        else:
+            bot = create_agent_from_shared(SHARED['shared_agent'])
+        session = Session(bot)
+        sessions[session_id] = session
+        while len(sessions) > SHARED['opt']['max_sessions']:
+            sessions.popitem(last=False)
+        return session
+
+
+def reset_session(session_id):
+    """Forget the conversation of the given session."""
+    with SHARED['lock']:
+        SHARED['sessions'].pop(session_id, None)
+
+
+def _update_metrics(**kwargs):
+    with SHARED['lock']:
+        for k, v in kwargs.items():
+            SHARED['metrics'][k] += v
+
+
+def get_metrics():
+    """Return a report on the requests answered so far."""
+    with SHARED['lock']:
+        metrics = dict(SHARED['metrics'])
+        metrics['sessions'] = len(SHARED['sessions'])
+    replied = metrics['requests'] - metrics['errors']
+    metrics['mean_latency'] = metrics.pop('latency') / max(replied, 1)
+    batcher = SHARED['batcher']
+    if batcher is not None:
+        metrics['pending'] = batcher.num_pending()
+        metrics['mean_batch_size'] = batcher.num_replies / max(batcher.num_batches, 1)
+    return metrics
+
+
 class MyHandler(BaseHTTPRequestHandler):
     """Handle HTTP requests."""
 
-    def _interactive_running(self, opt, reply_text):
+    def _interactive_running(self, session, reply_text):
         reply = {'episode_done': False, 'text': reply_text}
-        SHARED['agent'].observe(reply)
-        model_res = SHARED['agent'].act()
-        return model_res
+        # a session answers one message at a time, keeping its history in order
+        with session.lock:
+            session.bot.observe(reply)
+            if SHARED['batcher'] is not None:
+                return session.bot.act()
+            with SHARED['workers']:
+                return session.bot.act()
+
+    def _session_id(self):
+        session_id = self.headers.get('X-Session-Id')
+        if session_id is None:
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            if 'session_id' in cookie:
+                session_id = cookie['session_id'].value
+        return session_id
+
+    def _send_json(self, status_code, data, session_id=None):
+        content = bytes(json.dumps(data), 'utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if session_id is not None:
+            self.send_header('Set-Cookie', 'session_id={}; Path=/'.format(session_id))
+        if status_code == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(content)
 
     def do_HEAD(self):
         """Handle HEAD requests."""
@@ -172,29 +277,45 @@ class MyHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Handle POST request, especially replying to a chat message."""
+        session_id = self._session_id()
+        new_session_id = None
+        if session_id is None:
+            session_id = new_session_id = uuid.uuid4().hex
         if self.path == '/interact':
             content_length = int(self.headers['Content-Length'])
             body = self.rfile.read(content_length)
-            model_response = self._interactive_running(
-                SHARED.get('opt'), body.decode('utf-8')
-            )
-
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            json_str = json.dumps(model_response)
-            self.wfile.write(bytes(json_str, 'utf-8'))
+            with SHARED['lock']:
+                overloaded = SHARED['in_flight'] >= SHARED['opt']['max_pending']
+                if not overloaded:
+                    SHARED['in_flight'] += 1
+            if overloaded:
+                _update_metrics(rejected=1)
+                return self._send_json(503, {'error': 'Server overloaded.'})
+            start = time.time()
+            try:
+                model_response = self._interactive_running(
+                    get_session(session_id), body.decode('utf-8')
+                )
+            except Exception as e:
+                _update_metrics(requests=1, errors=1)
+                return self._send_json(500, {'error': repr(e)})
+            finally:
+                with SHARED['lock']:
+                    SHARED['in_flight'] -= 1
+            _update_metrics(requests=1, latency=time.time() - start)
+            self._send_json(200, model_response, new_session_id)
         elif self.path == '/reset':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            SHARED['agent'].reset()
-            self.wfile.write(bytes("{}", 'utf-8'))
+            reset_session(session_id)
+            self._send_json(200, {}, new_session_id)
         else:
             return self._respond({'status': 500})
 
     def do_GET(self):
         """Respond to GET request, especially the initial load."""
+        if self.path == '/health':
+            return self._send_json(200, {'status': 'ok'})
+        if self.path == '/metrics':
+            return self._send_json(200, get_metrics())
         paths = {
             '/': {'status': 200},
             '/favicon.ico': {'status': 202},  # Need for chrome
@@ -207,6 +328,10 @@ class MyHandler(BaseHTTPRequestHandler):
     def _handle_http(self, status_code, path, text=None):
         self.send_response(status_code)
         self.send_header('Content-type', 'text/html')
+        if path == '/' and self._session_id() is None:
+            self.send_header(
+                'Set-Cookie', 'session_id={}; Path=/'.format(uuid.uuid4().hex)
+            )
         self.end_headers()
         content = WEB_HTML.format(STYLE_SHEET, FONT_AWESOME)
         return bytes(content, 'UTF-8')
@@ -216,11 +341,54 @@ class MyHandler(BaseHTTPRequestHandler):
         self.wfile.write(response)
 
 
-def setup_interactive(shared):
-    """Build and parse CLI opts."""
+def setup_interactive(shared, args=None):
+    """
+    Build and parse CLI opts, and load the model.
+
+    :param args:
+        command line arguments to parse, instead of those of the process
+    """
     parser = setup_args()
     parser.add_argument('--port', type=int, default=PORT, help='Port to listen on.')
-    SHARED['opt'] = parser.parse_args(print_args=False)
+    parser.add_argument(
+        '--host', default=HOST_NAME, type=str, help='Host name to listen on.'
+    )
+    server = parser.add_argument_group('Web Server Arguments')
+    server.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of copies of the model answering requests concurrently.',
+    )
+    server.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=1,
+        help='Maximum number of concurrent requests answered in one batch, '
+        'for models which implement batch_act.',
+    )
+    server.add_argument(
+        '--batch-timeout',
+        type=float,
+        default=0.01,
+        hidden=True,
+        help='Seconds to wait for more requests to fill a batch.',
+    )
+    server.add_argument(
+        '--max-sessions',
+        type=int,
+        default=1000,
+        help='Maximum number of conversations kept. The least recently used '
+        'are forgotten first.',
+    )
+    server.add_argument(
+        '--max-pending',
+        type=int,
+        default=100,
+        help='Maximum number of requests in flight. Beyond this, the server '
+        'answers with 503.',
+    )
+    SHARED['opt'] = parser.parse_args(args, print_args=False)
 
     SHARED['opt']['task'] = 'parlai.agents.local_human.local_human:LocalHumanAgent'
 
@@ -229,6 +397,21 @@ def setup_interactive(shared):
     SHARED['agent'] = agent
     SHARED['world'] = create_task(SHARED.get('opt'), SHARED['agent'])
 
+    # sessions get their own copies of the model
+    opt = SHARED['opt']
+    SHARED['shared_agent'] = agent.share()
+    SHARED['sessions'] = OrderedDict()
+    SHARED['lock'] = threading.Lock()
+    SHARED['in_flight'] = 0
+    SHARED['metrics'] = {'requests': 0, 'errors': 0, 'rejected': 0, 'latency': 0.0}
+    if hasattr(agent, 'batch_act'):
+        SHARED['batcher'] = BotBatcher(
+            agent, opt['max_batch_size'], opt['batch_timeout'], opt['workers']
+        )
+    else:
+        SHARED['batcher'] = None
+        SHARED['workers'] = threading.BoundedSemaphore(opt['workers'])
+
     # show args after loading model
     parser.opt = agent.opt
     parser.print_args()
@@ -238,11 +421,13 @@ def setup_interactive(shared):
 if __name__ == '__main__':
     opt = setup_interactive(SHARED)
     MyHandler.protocol_version = 'HTTP/1.0'
-    httpd = HTTPServer((HOST_NAME, opt['port']), MyHandler)
-    print('http://{}:{}/'.format(HOST_NAME, opt['port']))
+    httpd = ThreadedHTTPServer((opt['host'], opt['port']), MyHandler)
+    print('http://{}:{}/'.format(opt['host'], opt['port']))
 
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
     httpd.server_close()
+    if SHARED['batcher'] is not None:
+        SHARED['batcher'].shutdown()
@@ -6,11 +6,16 @@
 
 
 """
-Main launch script for single-host, multi-GPU training.
+Main launch script for single-host, multi-GPU or multi-core training.
 
 This is a drop-in replacement for train_model.py.  This script will launch N
 subprocess, each which runs the full training loop independently.
 
+With --no-cuda (or on a host without GPUs), workers communicate over the gloo
+backend, and each worker is pinned to its own group of
+--distributed-cores-per-worker cores. Validation is split between the workers
+for teachers derived from FixedDialogTeacher.
+
 Uses torch.nn.parallel.DistributedDataParallel for its main uses.  Agents must
 specifically implement the wrapper of DistributedDatParallel, but all
 TorchRankerAgents and TorchGeneratorAgents support this.
@@ -33,21 +38,60 @@ import parlai.scripts.train_model as single_train
 import parlai.utils.distributed as distributed_utils
 
 
+def use_gloo(opt):
+    """Return whether distributed workers should run on CPU with gloo."""
+    return opt.get('no_cuda', False) or not torch.cuda.is_available()
+
+
+def pin_cpu_threads(local_rank, cores_per_worker):
+    """
+    Restrict this worker to its own group of cores.
+
+    Worker ``local_rank`` is pinned to the ``local_rank``-th group of
+    ``cores_per_worker`` cores, wrapping around if there are more workers than
+    groups, and torch's intra-op thread pool is sized to match.
+
+    :param int local_rank: rank of the worker on this host.
+    :param int cores_per_worker: number of cores to give each worker.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        # no affinity control on this platform, just size the thread pool
+        torch.set_num_threads(cores_per_worker)
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_worker = min(cores_per_worker, len(cores))
+    num_groups = len(cores) // cores_per_worker
+    start = (local_rank % num_groups) * cores_per_worker
+    group = cores[start : start + cores_per_worker]
+    os.sched_setaffinity(0, group)
+    torch.set_num_threads(len(group))
+
+
+def cpu_world_size(opt):
+    """Return the default number of CPU workers for this host."""
+    if hasattr(os, 'sched_getaffinity'):
+        num_cores = len(os.sched_getaffinity(0))
+    else:
+        num_cores = os.cpu_count() or 1
+    return max(1, num_cores // opt['distributed_cores_per_worker'])
+
+
 def multiprocess_train(
     rank, opt, port=61337, rank_offset=0, gpu=None, hostname='localhost'
 ):
     """
     Subprocess which initializes distributed training, and begins training.
 
-    This should be launched n times for n GPUs; this is handled either in main
-    or via srun.
+    This should be launched n times for n GPUs (or n CPU core groups); this is
+    handled either in main or via srun.
 
     :param int rank: This process's rank - 1. (Starts at -1 ... n - 2). See comments.
     :param opt: command line options
     :param int port: A TCP port to use. This will need to be changed to run
         multiple distributed training setups on the same machine.
     :param int gpu: Which GPU to use. Defaults to using rank and local devices,
-        but must be manually specified when using many-hosts.
+        but must be manually specified when using many-hosts. When training on
+        CPU, this is the worker's rank on its host, and selects its core group.
     :param str hostname: Hostname of the main server.
     """
     # Set per-host options
@@ -56,7 +100,13 @@ def multiprocess_train(
     # and distributed train
     rank = rank + rank_offset
     opt['rank'] = rank
-    if gpu is None:
+    cpu = use_gloo(opt)
+    if cpu:
+        # default assumption is all workers share the host
+        local_rank = rank if gpu is None else gpu
+        gpu = -1
+        opt['no_cuda'] = True
+    elif gpu is None:
         # default assumption is local GPUs
         gpu = rank % torch.cuda.device_count()
     opt['gpu'] = gpu
@@ -64,6 +114,8 @@ def multiprocess_train(
     if 'override' not in opt:
         opt['override'] = {}
     opt['override']['gpu'] = gpu
+    if cpu:
+        opt['override']['no_cuda'] = True
 
     # Suppress output of workers except the main host.
     if opt.get('verbose') or rank != 0:
@@ -74,17 +126,21 @@ def multiprocess_train(
 
     with distributed_utils.override_print(suppress_output, print_prefix):
         # perform distributed setup, ensuring all hosts are ready
-        torch.cuda.set_device(opt['gpu'])
+        if cpu:
+            pin_cpu_threads(local_rank, opt['distributed_cores_per_worker'])
+        else:
+            torch.cuda.set_device(opt['gpu'])
         dist.init_process_group(
-            backend="nccl",
+            backend="gloo" if cpu else "nccl",
             init_method="tcp://{}:{}".format(hostname, port),
             world_size=opt['distributed_world_size'],
             rank=rank,
         )
         print("Distributed group initialized")
 
-        # manual_seed can be a noop without this
-        torch.cuda.init()
+        if not cpu:
+            # manual_seed can be a noop without this
+            torch.cuda.init()
         # make sure all parameters will be in sync
         torch.manual_seed(42)
         # force a sync so that no one gets ahead, and all are seeded together
@@ -96,6 +152,13 @@ def multiprocess_train(
 
 def launch_and_train(opt, port):
     """Perform a fork() to many processes."""
+    if opt['distributed_world_size'] is None:
+        if use_gloo(opt):
+            # one worker per group of cores
+            opt['distributed_world_size'] = cpu_world_size(opt)
+        else:
+            # one worker per GPU
+            opt['distributed_world_size'] = torch.cuda.device_count()
     # Launch multiple subprocesses
     spawncontext = torch.multiprocessing.spawn(
         multiprocess_train,
@@ -121,7 +184,6 @@ def launch_and_train(opt, port):
 def setup_args():
     parser = single_train.setup_args()
     parser.add_distributed_training_args()
-    parser.set_defaults(distributed_world_size=torch.cuda.device_count())
     return parser
 
 
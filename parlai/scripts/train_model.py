@@ -32,7 +32,13 @@ import os
 import signal
 
 from parlai.core.agents import create_agent, create_agent_from_shared
-from parlai.core.metrics import aggregate_task_reports
+from parlai.core.metrics import (
+    aggregate_task_reports,
+    get_metrics_states,
+    load_metrics_states,
+    merge_metric_states,
+)
+from parlai.core.teachers import FixedDialogTeacher
 from parlai.core.worlds import create_task
 from parlai.core.params import ParlaiParser, print_announcements
 from parlai.utils.misc import Timer, round_sigfigs, warn_once
@@ -44,6 +50,7 @@ from parlai.utils.distributed import (
     all_gather_list,
     is_distributed,
     num_workers,
+    get_rank,
 )
 from parlai.scripts.build_pytorch_data import get_pyt_dict_file
 
@@ -191,18 +198,36 @@ def setup_args(parser=None) -> ParlaiParser:
         'ppl,f1,accuracy,hits@1,rouge,bleu'
         'the rouge metrics will be computed as rouge-1, rouge-2 and rouge-l',
     )
+    train.add_argument(
+        '--metrics-workers',
+        type=int,
+        default=0,
+        hidden=True,
+        help='Score predictions in this many background processes, instead of '
+        'in the main loop. Worth it for --metrics all on generation tasks.',
+    )
     TensorboardLogger.add_cmdline_args(parser)
     parser = setup_dict_args(parser)
     return parser
 
 
 def _maybe_load_eval_worlds(agent, opt, datatype):
-    if not is_primary_worker():
+    if num_workers() > 1:
+        # every worker evaluates its own shard of the episodes
+        opt = opt.copy()
+        opt['shard_id'] = get_rank()
+        opt['num_shards'] = num_workers()
+    elif not is_primary_worker():
         # only need the validation on the main worker
         return None
     return load_eval_worlds(agent, opt, datatype)
 
 
+def _is_sharded(world):
+    """Return whether each worker evaluates its own shard of the world."""
+    return num_workers() > 1 and isinstance(world.get_task_agent(), FixedDialogTeacher)
+
+
 def load_eval_worlds(agent, opt, datatype):
     """
     Create a new eval world for the agent and the given opt.
@@ -256,6 +281,16 @@ def _run_single_eval(opt, valid_world, max_exs):
     # run evaluation on a single world
     valid_world.reset()
 
+    sharded = _is_sharded(valid_world)
+    if not sharded and not is_primary_worker():
+        # only the main worker evaluates teachers which can't be sharded
+        return None
+    if sharded and max_exs > 0:
+        # split the examples between the workers as evenly as the episodes
+        max_exs = max_exs // num_workers() + (get_rank() < max_exs % num_workers())
+        # no examples at all would mean no limit
+        max_exs = max(max_exs, 1)
+
     cnt = 0
     max_cnt = max_exs if max_exs > 0 else float('inf')
     while not valid_world.epoch_done() and cnt < max_cnt:
@@ -265,6 +300,12 @@ def _run_single_eval(opt, valid_world, max_exs):
             print(valid_world.report())
         cnt += valid_world.opt['batchsize']
 
+    if sharded:
+        # merge the metric counters of every shard
+        shard_states = all_gather_list(get_metrics_states(valid_world))
+        load_metrics_states(
+            valid_world, [merge_metric_states(states) for states in zip(*shard_states)],
+        )
     valid_report = valid_world.report()
     valid_world.reset()  # make sure world doesn't remember valid data
 
@@ -296,6 +337,9 @@ def run_eval(valid_worlds, opt, datatype, max_exs=-1, write_log=False):
     for v_world in valid_worlds:
         task_report = _run_single_eval(opt, v_world, max_exs / len(valid_worlds))
         reports.append(task_report)
+    if not is_primary_worker():
+        # the other workers only evaluated their shards for the main worker
+        return None
 
     tasks = [world.getID() for world in valid_worlds]
     report = aggregate_task_reports(
@@ -759,10 +803,18 @@ class TrainLoop:
                     self.save_model('.checkpoint')
                     self.save_time.reset()
 
-        if not self.saved and is_primary_worker():
-            # save agent
+        # only the primary worker knows whether it saved a best model, and every
+        # worker must make the same choice to reload it
+        if not sync_object(self.saved):
+            # save agent. every worker holds the same model, so none reload it
             self.save_model()
-        elif opt.get('model_file'):
+            reload_model = False
+        else:
+            reload_model = bool(opt.get('model_file'))
+        # make sure the primary worker has finished writing the model before
+        # any worker reloads it
+        sync_object(None)
+        if reload_model:
             # reload best validation model
             self.agent = create_agent(opt)
 
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Indexes for maximum inner product search over fixed candidate encodings.
+
+Ranking a large fixed candidate set by scoring every candidate against every
+query is expensive. These indexes return only the top k candidates for a batch
+of query vectors, trading some exactness for speed and memory:
+
+* ``FlatIndex``: exact search, scores every candidate in chunks.
+* ``IVFIndex``: clusters the candidates, and only scores the candidates in the
+  clusters closest to each query.
+* ``PQIndex``: compresses candidates with product quantization and scores the
+  compressed codes with per-query lookup tables.
+
+Use ``build_candidate_index`` to create an index of a given type, and
+``load_candidate_index`` to restore one written with ``CandidateIndex.save``.
+The flat and IVF indexes score the original encodings, which are not saved
+with the index and must be passed back in when loading it.
+"""
+
+import math
+
+import torch
+
+
+def kmeans(vecs, num_clusters, num_iters=20, seed=42, chunksize=65536):
+    """
+    Cluster vectors with Lloyd's algorithm.
+
+    :param vecs:
+        a (n x d) FloatTensor of vectors to cluster
+    :param num_clusters:
+        number of centroids to learn
+    :param num_iters:
+        number of assignment / update rounds
+    :param seed:
+        seed used to pick the initial centroids
+
+    :return:
+        (centroids, assignments) pair, where centroids is a
+        (num_clusters x d) FloatTensor and assignments is a (n) LongTensor
+    """
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(vecs.size(0), generator=generator)[:num_clusters]
+    centroids = vecs[init.to(vecs.device)].clone()
+    assignments = None
+    for _ in range(num_iters):
+        assignments = _nearest_centroids(vecs, centroids, chunksize)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vecs)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        nonempty = counts > 0
+        # empty clusters keep their previous centroid
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).to(
+            sums.dtype
+        )
+    return centroids, _nearest_centroids(vecs, centroids, chunksize)
+
+
+def _nearest_centroids(vecs, centroids, chunksize):
+    """Assign each vector to the closest centroid in L2 distance."""
+    centroid_norms = (centroids * centroids).sum(dim=1)
+    assignments = []
+    for chunk in vecs.split(chunksize):
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 doesn't change the argmin
+        dists = centroid_norms.unsqueeze(0) - 2 * chunk.mm(centroids.t())
+        assignments.append(dists.argmin(dim=1))
+    return torch.cat(assignments)
+
+
+def _merge_topk(best_scores, best_inds, scores, inds, k):
+    """Merge a new set of scored candidates into the running top k."""
+    if best_scores is not None:
+        scores = torch.cat([best_scores, scores], dim=1)
+        inds = torch.cat([best_inds, inds], dim=1)
+    k = min(k, scores.size(1))
+    best_scores, positions = scores.topk(k, dim=1)
+    return best_scores, inds.gather(1, positions)
+
+
+class CandidateIndex(object):
+    """
+    Abstract index over a fixed set of candidate encodings.
+
+    Candidates are scored by inner product with the query vectors, as done by
+    bi-encoder rankers.
+    """
+
+    def __init__(self, chunksize=65536, **kwargs):
+        self.chunksize = chunksize
+        self.num_candidates = 0
+        self.encs = None
+
+    def build(self, encs):
+        """
+        Build the index over candidate encodings.
+
+        :param encs:
+            a (num_cands x d) FloatTensor of candidate encodings
+        """
+        raise NotImplementedError('Abstract method: implement build()')
+
+    def search(self, queries, k):
+        """
+        Find the top k candidates for each query.
+
+        :param queries:
+            a (bsz x d) FloatTensor of query encodings
+        :param k:
+            number of candidates to return per query
+
+        :return:
+            (scores, indices) pair of (bsz x k) tensors, sorted by descending
+            score. Scores may be approximate, depending on the index type.
+        """
+        raise NotImplementedError('Abstract method: implement search()')
+
+    def state_dict(self):
+        """Return the tensors and settings needed to restore the index."""
+        return {'num_candidates': self.num_candidates, 'chunksize': self.chunksize}
+
+    def load_state_dict(self, state_dict):
+        """Restore the index from the output of state_dict()."""
+        self.num_candidates = state_dict['num_candidates']
+        self.chunksize = state_dict['chunksize']
+
+    def set_encodings(self, encs):
+        """Attach the candidate encodings scored by the index, if it uses them."""
+        self.encs = encs
+
+    def to(self, device):
+        """Move the index tensors to the given device."""
+        for k, v in vars(self).items():
+            if torch.is_tensor(v):
+                setattr(self, k, v.to(device))
+        return self
+
+    def save(self, path):
+        """Save the index to a path."""
+        with open(path, 'wb') as f:
+            torch.save({'type': self.index_type, 'state': self.state_dict()}, f)
+
+
+class FlatIndex(CandidateIndex):
+    """Exact index, which scores every candidate."""
+
+    index_type = 'flat'
+
+    def build(self, encs):
+        self.set_encodings(encs)
+        self.num_candidates = encs.size(0)
+
+    def search(self, queries, k):
+        best_scores, best_inds = None, None
+        for start in range(0, self.num_candidates, self.chunksize):
+            chunk = self.encs[start : start + self.chunksize].type_as(queries)
+            scores = queries.mm(chunk.t())
+            inds = torch.arange(start, start + chunk.size(0), device=queries.device)
+            best_scores, best_inds = _merge_topk(
+                best_scores, best_inds, scores, inds.expand_as(scores), k
+            )
+        return best_scores, best_inds
+
+
+class IVFIndex(CandidateIndex):
+    """
+    Inverted file index.
+
+    Candidates are clustered with k-means, and each query only scores the
+    candidates in the ``nprobe`` clusters whose centroids have the highest inner
+    product with the query. Scores of the returned candidates are exact.
+    """
+
+    index_type = 'ivf'
+
+    def __init__(self, nlist=0, nprobe=8, **kwargs):
+        super().__init__(**kwargs)
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+    def build(self, encs):
+        self.set_encodings(encs)
+        self.num_candidates = encs.size(0)
+        nlist = self.nlist
+        if nlist <= 0:
+            # common rule of thumb for the number of lists
+            nlist = 4 * int(math.sqrt(self.num_candidates))
+        nlist = max(1, min(nlist, self.num_candidates))
+        self.centroids, assignments = kmeans(
+            encs.float(), nlist, chunksize=self.chunksize
+        )
+        # store the candidates grouped by cluster, with offsets to each group
+        assignments, order = assignments.sort()
+        counts = torch.bincount(assignments, minlength=nlist)
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        self.order = order
+
+    def search(self, queries, k):
+        nprobe = min(self.nprobe, self.centroids.size(0))
+        _, probes = queries.mm(self.centroids.t()).topk(nprobe, dim=1)
+        offsets = self.offsets.tolist()
+        all_scores, all_inds = [], []
+        for query, clusters in zip(queries, probes.tolist()):
+            inds = torch.cat(
+                [self.order[offsets[c] : offsets[c + 1]] for c in clusters]
+            )
+            scores = self.encs[inds].type_as(query).mv(query)
+            scores, top = scores.topk(min(k, scores.size(0)))
+            all_scores.append(scores)
+            all_inds.append(inds[top])
+        return _pad_results(all_scores, all_inds, k)
+
+    def state_dict(self):
+        state = super().state_dict()
+        state.update(
+            nlist=self.nlist,
+            nprobe=self.nprobe,
+            centroids=self.centroids,
+            offsets=self.offsets,
+            order=self.order,
+        )
+        return state
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        for k in ('nlist', 'nprobe', 'centroids', 'offsets', 'order'):
+            setattr(self, k, state_dict[k])
+
+
+class PQIndex(CandidateIndex):
+    """
+    Product quantization index.
+
+    Each candidate is split into ``num_subvectors`` pieces, and each piece is
+    replaced by the id of its nearest centroid in a per-piece codebook of up to
+    256 entries, so a candidate is stored in ``num_subvectors`` bytes. Queries
+    precompute their inner product with every codebook entry and score the
+    codes by table lookups. Scores are approximate.
+    """
+
+    index_type = 'pq'
+
+    def __init__(self, num_subvectors=8, max_train=65536, **kwargs):
+        super().__init__(**kwargs)
+        self.num_subvectors = num_subvectors
+        self.max_train = max_train
+
+    def build(self, encs):
+        encs = encs.float()
+        num_cands, dim = encs.shape
+        if dim % self.num_subvectors != 0:
+            raise ValueError(
+                'Encoding dimension {} is not divisible by {} subvectors'.format(
+                    dim, self.num_subvectors
+                )
+            )
+        self.num_candidates = num_cands
+        subvecs = encs.view(num_cands, self.num_subvectors, -1)
+        num_codes = min(256, num_cands)
+        generator = torch.Generator().manual_seed(42)
+        train = torch.randperm(num_cands, generator=generator)[: self.max_train]
+        codebooks, codes = [], []
+        for m in range(self.num_subvectors):
+            centroids, _ = kmeans(
+                subvecs[train.to(encs.device), m], num_codes, chunksize=self.chunksize
+            )
+            codebooks.append(centroids)
+            codes.append(_nearest_centroids(subvecs[:, m], centroids, self.chunksize))
+        # num_subvectors x num_codes x subdim
+        self.codebooks = torch.stack(codebooks)
+        self.codes = torch.stack(codes, dim=1).to(torch.uint8)
+
+    def search(self, queries, k):
+        bsz = queries.size(0)
+        subqueries = queries.view(bsz, self.num_subvectors, -1)
+        # bsz x num_subvectors x num_codes
+        tables = torch.einsum(
+            'bmd,mkd->bmk', subqueries, self.codebooks.type_as(queries)
+        )
+        subvector_ids = torch.arange(self.num_subvectors, device=queries.device)
+        best_scores, best_inds = None, None
+        for start in range(0, self.num_candidates, self.chunksize):
+            codes = self.codes[start : start + self.chunksize].long()
+            # bsz x chunk x num_subvectors -> bsz x chunk
+            scores = tables[:, subvector_ids, codes].sum(dim=-1)
+            inds = torch.arange(start, start + codes.size(0), device=queries.device)
+            best_scores, best_inds = _merge_topk(
+                best_scores, best_inds, scores, inds.expand_as(scores), k
+            )
+        return best_scores, best_inds
+
+    def state_dict(self):
+        state = super().state_dict()
+        state.update(
+            num_subvectors=self.num_subvectors,
+            max_train=self.max_train,
+            codebooks=self.codebooks,
+            codes=self.codes,
+        )
+        return state
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        for k in ('num_subvectors', 'max_train', 'codebooks', 'codes'):
+            setattr(self, k, state_dict[k])
+
+
+def _pad_results(all_scores, all_inds, k):
+    """Stack per-query results, padding queries which found fewer than k."""
+    k = min(k, max(s.size(0) for s in all_scores))
+    scores = all_scores[0].new_full((len(all_scores), k), float('-inf'))
+    inds = all_inds[0].new_full((len(all_inds), k), -1)
+    for i, (s, ind) in enumerate(zip(all_scores, all_inds)):
+        scores[i, : s.size(0)] = s[:k]
+        inds[i, : ind.size(0)] = ind[:k]
+    return scores, inds
+
+
+CANDIDATE_INDEXES = {
+    FlatIndex.index_type: FlatIndex,
+    IVFIndex.index_type: IVFIndex,
+    PQIndex.index_type: PQIndex,
+}
+
+
+def build_candidate_index(index_type, encs, **kwargs):
+    """
+    Build a candidate index of the given type.
+
+    :param index_type:
+        one of 'flat', 'ivf' or 'pq'
+    :param encs:
+        a (num_cands x d) FloatTensor of candidate encodings
+    :param kwargs:
+        index specific settings, e.g. nlist and nprobe for 'ivf' or
+        num_subvectors for 'pq'
+    """
+    if index_type not in CANDIDATE_INDEXES:
+        raise ValueError('Unknown candidate index type: {}'.format(index_type))
+    index = CANDIDATE_INDEXES[index_type](**kwargs)
+    index.build(encs)
+    return index
+
+
+def load_candidate_index(path, encs=None, index_type=None):
+    """
+    Load a candidate index written with CandidateIndex.save().
+
+    :param path:
+        path to the saved index
+    :param encs:
+        the candidate encodings the index was built from. Required for the
+        flat and IVF indexes, which score them directly.
+    :param index_type:
+        if given, the type of index expected.
+
+    :raises ValueError:
+        if the saved index is not of the expected type, or was built over a
+        different number of candidates than ``encs``.
+    """
+    saved = torch.load(path, map_location=lambda cpu, _: cpu)
+    if index_type is not None and saved['type'] != index_type:
+        raise ValueError(
+            'Candidate index at {} is of type {}, not {}'.format(
+                path, saved['type'], index_type
+            )
+        )
+    num_candidates = saved['state']['num_candidates']
+    if encs is not None and num_candidates != encs.size(0):
+        raise ValueError(
+            'Candidate index at {} was built over {} candidates, not {}'.format(
+                path, num_candidates, encs.size(0)
+            )
+        )
+    index = CANDIDATE_INDEXES[saved['type']]()
+    index.load_state_dict(saved['state'])
+    if saved['type'] != PQIndex.index_type:
+        index.set_encodings(encs)
+    return index
@@ -15,6 +15,9 @@ in non-distributed mode.
 import builtins
 import pickle
 import contextlib
+import numpy as np
+
+from parlai.utils.misc import warn_once
 
 try:
     import torch.version
@@ -37,8 +40,11 @@ def validate_params(opt):
             "visit https://pytorch.org for instructions."
         )
 
-    if opt.get('no_cuda', False):
-        raise ValueError('Distributed mode only makes sense when using GPUs.')
+    if not opt.get('no_cuda', False) and not torch.cuda.is_available():
+        raise ValueError(
+            'No GPUs are available. Use --no-cuda to train on CPU with the gloo '
+            'backend.'
+        )
 
     if opt.get('numthreads', 1) != 1:
         raise ValueError('--numthreads must be 1 for distributed training.')
@@ -64,6 +70,26 @@ def num_workers():
         return dist.get_world_size()
 
 
+def get_rank():
+    """Get the rank of this worker, or 0 when not distributed."""
+    if not is_distributed():
+        return 0
+    else:
+        return dist.get_rank()
+
+
+def get_buffer_device():
+    """
+    Return the device communication buffers must live on.
+
+    The nccl backend only communicates CUDA tensors, while gloo works on CPU
+    tensors.
+    """
+    if is_distributed() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def is_primary_worker():
     """
     Determine if we are the primary (master) worker.
@@ -106,71 +132,89 @@ def override_print(suppress=False, prefix=None):
     builtins.print = builtin_print
 
 
-def all_gather_list(data, max_size=16384):
+def _encode_object(data, device):
+    """
+    Pickle an object into a uint8 tensor on the given device.
+
+    The pickle is wrapped without a python-level copy, so the only copies are
+    the ones made by pickle and by moving the tensor to ``device``.
+    """
+    enc = bytearray(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    # torch.frombuffer needs torch >= 1.10, so wrap it with numpy instead
+    return torch.from_numpy(np.frombuffer(enc, dtype=np.uint8)).to(device)
+
+
+def _decode_object(buffer, caller):
+    """Unpickle an object from a uint8 tensor produced by _encode_object."""
+    try:
+        return pickle.loads(memoryview(buffer.cpu().numpy()))
+    except pickle.UnpicklingError:
+        raise RuntimeError(
+            'There was an unpickling error in {}. This likely '
+            'means your workers got out of syncronization (e.g. one is '
+            'expecting to sync and another is not.)'.format(caller)
+        )
+
+
+def _warn_max_size(max_size, caller):
+    if max_size is not None:
+        warn_once(
+            'The max_size argument of {} is deprecated and ignored, as payloads '
+            'of any size are supported.'.format(caller),
+            DeprecationWarning,
+        )
+
+
+def all_gather_list(data, max_size=None):
     """
     Gather arbitrary data from all nodes into a list.
 
     Similar to `~torch.distributed.all_gather` but for arbitrary Python
-    data. Note that *data* must be picklable.
+    data. Note that *data* must be picklable. Sizes are exchanged first, so the
+    data may be arbitrarily large.
 
     :param data:
         data from the local worker to be gathered on other workers
-    :param int max_size:
-        maximum size of the data to be gathered across workers
+    :param max_size:
+        deprecated and ignored.
 
     :returns:
         a list containing [data1, data2, ...] of all workers
     """
+    _warn_max_size(max_size, 'all_gather_list')
     if not is_distributed():
         # fall back to just keeping things basic if we're not distributed
         return [data]
 
-    # stolen shamelessly from fairseq
-    # https://github.com/pytorch/fairseq/blob/c37250ab1c845919af721cd3f5c4cec2993aefe1/fairseq/distributed_utils.py#L116-L170
-    rank = dist.get_rank()
     world_size = dist.get_world_size()
+    device = get_buffer_device()
+
+    enc = _encode_object(data, device)
+    local_size = torch.tensor([enc.numel()], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(local_size) for _ in range(world_size)]
+    dist.all_gather(sizes, local_size)
+    sizes = [int(size.item()) for size in sizes]
+
+    # all_gather needs equally sized tensors, so pad to the largest payload
+    padded_size = max(sizes)
+    if enc.numel() < padded_size:
+        padding = torch.zeros(
+            padded_size - enc.numel(), dtype=torch.uint8, device=device
+        )
+        enc = torch.cat([enc, padding])
+    buffers = [
+        torch.empty(padded_size, dtype=torch.uint8, device=device)
+        for _ in range(world_size)
+    ]
+    dist.all_gather(buffers, enc)
 
-    buffer_size = max_size * world_size
-    if (
-        not hasattr(all_gather_list, '_buffer')
-        or all_gather_list._buffer.numel() < buffer_size
-    ):
-        all_gather_list._buffer = torch.cuda.ByteTensor(buffer_size)
-
-    buffer = all_gather_list._buffer
-    buffer.zero_()
-
-    enc = pickle.dumps(data)
-    enc_size = len(enc)
-    if enc_size + 2 > max_size:
-        raise ValueError('encoded data exceeds max_size: {}'.format(enc_size + 2))
-    assert max_size < 255 * 256
-
-    buffer_rank = buffer[rank * max_size : (rank + 1) * max_size]
-    buffer_rank[0] = enc_size // 255  # this encoding works for max_size < 65k
-    buffer_rank[1] = enc_size % 255
-    buffer_rank[2 : enc_size + 2] = torch.ByteTensor(list(enc))
-
-    dist.all_reduce(buffer)
-
-    result = []
-    for i in range(world_size):
-        out_buffer = buffer[i * max_size : (i + 1) * max_size]
-        size = (255 * out_buffer[0].item()) + out_buffer[1].item()
-        if size > 0:
-            try:
-                result.append(pickle.loads(bytes(out_buffer[2 : size + 2].tolist())))
-            except pickle.UnpicklingError:
-                raise RuntimeError(
-                    'There was an unpickling error in all_gather_list. This likely '
-                    'means your workers got out of syncronization (e.g. one is '
-                    'expecting to sync and another is not.)'
-                )
-
-    return result
+    return [
+        _decode_object(buffer[:size], 'all_gather_list')
+        for buffer, size in zip(buffers, sizes)
+    ]
 
 
-def sync_object(data, max_size=16384):
+def sync_object(data, max_size=None):
     """
     Sync an object among all workers.
 
@@ -179,47 +223,33 @@ def sync_object(data, max_size=16384):
     flow decisions are made the same.
 
     :param object data:
-        The object to synchronize. Must be pickleable.
-    :param int max_size:
-        The maximum size of this object in bytes. Large values than 255^2 are not
-        supported.
+        The object to synchronize. Must be pickleable, but may be arbitrarily
+        large.
+    :param max_size:
+        deprecated and ignored.
 
     :return: the synchronized data
     """
+    _warn_max_size(max_size, 'sync_object')
     if not is_distributed():
         return data
 
-    # prepare the buffer
-    if not hasattr(sync_object, '_buffer') or sync_object._buffer.numel() < max_size:
-        # cuda is safe because distributed mode is only okay with CUDA
-        sync_object._buffer = torch.cuda.ByteTensor(max_size)
-
-    buffer = sync_object._buffer
+    device = get_buffer_device()
 
+    # broadcast the size first, so the other workers can allocate the buffer
     if is_primary_worker():
-        enc = pickle.dumps(data)
-        enc_size = len(enc)
-        if (enc_size + 2 > max_size) or (enc_size > 255 * 255):
-            # can't store the size in the first 2 bytes
-            raise ValueError('encoded data exceeds max_size')
-
-        buffer[0] = enc_size // 255
-        buffer[1] = enc_size % 255
-        buffer[2 : enc_size + 2] = torch.ByteTensor(list(enc))
+        enc = _encode_object(data, device)
+        size = torch.tensor([enc.numel()], dtype=torch.long, device=device)
+    else:
+        size = torch.zeros(1, dtype=torch.long, device=device)
+    dist.broadcast(size, 0)
 
-    dist.broadcast(buffer, 0)
+    if not is_primary_worker():
+        enc = torch.empty(int(size.item()), dtype=torch.uint8, device=device)
+    dist.broadcast(enc, 0)
 
     if not is_primary_worker():
-        # deserialize the data
-        enc_size = buffer[0].item() * 255 + buffer[1].item()
-        try:
-            data = pickle.loads(bytes(buffer[2 : enc_size + 2].tolist()))
-        except pickle.UnpicklingError:
-            raise RuntimeError(
-                'There was an unpickling error in sync_object. This likely '
-                'means your workers got out of syncronization (e.g. one is '
-                'expecting to sync and another is not.)'
-            )
+        data = _decode_object(enc, 'sync_object')
 
     return data
 
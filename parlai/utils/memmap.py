@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Memory-mapped storage for large, read-only sets of strings and tensors.
+
+Tensors are stored in the numpy ``.npy`` format and strings as a plain text file
+with one string per line, plus an index of the byte offset of each line. Lists
+of integer vectors of different lengths, such as tokenized text, are stored as
+one flat int32 array plus the offsets of each vector. All are memory-mapped when
+loaded, so data is paged in lazily as it is accessed, and processes which map
+the same file share its pages through the OS page cache instead of each holding
+a copy.
+"""
+
+from array import array
+from collections.abc import Sequence
+import os
+
+import numpy as np
+import torch
+
+_NUMPY_MAGIC = b'\x93NUMPY'
+
+
+def is_memmap_file(path):
+    """Return whether path holds a tensor saved with save_memmap_tensor."""
+    with open(path, 'rb') as f:
+        return f.read(len(_NUMPY_MAGIC)) == _NUMPY_MAGIC
+
+
+def save_memmap_tensor(tensor, path):
+    """
+    Save a tensor in a format which can be memory-mapped by load_memmap_tensor.
+
+    :param tensor:
+        the tensor to save
+    :param path:
+        file to write. Unlike ``numpy.save``, no extension is added.
+    """
+    with open(path, 'wb') as f:
+        np.save(f, tensor.detach().cpu().numpy())
+
+
+def load_memmap_tensor(path):
+    """
+    Memory-map a tensor saved with save_memmap_tensor.
+
+    The mapping is copy-on-write: pages are read from disk on first access and
+    shared with every other process mapping the file, and in-place changes
+    affect only this process and are never written back.
+    """
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+def build_line_offsets(path, offsets_path):
+    """
+    Index the byte offset of every line of a text file.
+
+    The file is streamed, so it is never fully loaded into memory.
+
+    :param path:
+        text file to index
+    :param offsets_path:
+        file to save the offsets to. It holds num_lines + 1 offsets; the last
+        one is the size of the text file.
+    """
+    offsets = array('q', [0])
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    with open(offsets_path, 'wb') as f:
+        np.save(f, np.frombuffer(offsets, dtype=np.int64))
+
+
+class MemmapStrings(Sequence):
+    """
+    Read-only list of the lines of a text file, decoded lazily.
+
+    Lines are stripped of surrounding whitespace, like
+    ``[line.strip() for line in f.readlines()]``, but only the offsets index is
+    read when the list is created.
+
+    :param path:
+        utf-8 text file with one string per line
+    :param offsets_path:
+        index of the text file, built with build_line_offsets. It is (re)built
+        if it doesn't exist, or if it doesn't match the size of the text file.
+    """
+
+    def __init__(self, path, offsets_path):
+        self.path = path
+        self.offsets_path = offsets_path
+        size = os.path.getsize(path)
+        offsets = None
+        if os.path.isfile(offsets_path):
+            offsets = np.load(offsets_path, mmap_mode='r')
+            if offsets[-1] != size:
+                offsets = None
+        if offsets is None:
+            build_line_offsets(path, offsets_path)
+            offsets = np.load(offsets_path, mmap_mode='r')
+        self._offsets = offsets
+        # np.memmap can't map empty files
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if size else None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('MemmapStrings index out of range')
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._data[start:end].tobytes().decode('utf-8').strip()
+
+    def __reduce__(self):
+        # reopen the mapping in other processes rather than copying the data
+        return (self.__class__, (self.path, self.offsets_path))
+
+
+class MemmapVectorsWriter(object):
+    """
+    Write a list of integer vectors, to be read with MemmapVectors.
+
+    Vectors are streamed to disk as they are added, so the list is never held
+    in memory.
+
+    :param path:
+        file to write the tokens of all vectors to, as a flat int32 array
+    :param offsets_path:
+        file to save the (start, end) positions of each vector to
+    """
+
+    def __init__(self, path, offsets_path):
+        self.path = path
+        self.offsets_path = offsets_path
+        self._file = open(path, 'wb')
+        self._offsets = array('q')
+        self._size = 0
+
+    def __len__(self):
+        return len(self._offsets) // 2
+
+    def add(self, vec):
+        """
+        Append a vector, or None, and return its index.
+
+        :param vec:
+            sequence or tensor of integers. None is stored as a missing vector.
+        """
+        if vec is None:
+            self._offsets.extend((-1, -1))
+        else:
+            if torch.is_tensor(vec):
+                vec = vec.tolist()
+            tokens = array('i', vec)
+            tokens.tofile(self._file)
+            self._offsets.extend((self._size, self._size + len(tokens)))
+            self._size += len(tokens)
+        return len(self) - 1
+
+    def close(self):
+        """Finish writing the vectors, and save the offsets."""
+        self._file.close()
+        offsets = np.frombuffer(self._offsets, dtype=np.int64).reshape(-1, 2)
+        with open(self.offsets_path, 'wb') as f:
+            np.save(f, offsets)
+
+
+class MemmapVectors(Sequence):
+    """
+    Read-only list of integer vectors written with MemmapVectorsWriter.
+
+    Each vector is returned as an int32 tensor which is a view of the mapped
+    file, so nothing is copied or parsed when it is accessed. Missing vectors
+    are returned as None.
+
+    :param path:
+        file holding the tokens of all vectors
+    :param offsets_path:
+        file holding the (start, end) positions of each vector
+    """
+
+    dtype = np.int32
+
+    def __init__(self, path, offsets_path):
+        self.path = path
+        self.offsets_path = offsets_path
+        self._offsets = np.load(offsets_path, mmap_mode='r')
+        # np.memmap can't map empty files
+        if os.path.getsize(path):
+            self._data = np.memmap(path, dtype=self.dtype, mode='c')
+        else:
+            self._data = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self._offsets[i]
+        if start < 0:
+            return None
+        return torch.from_numpy(self._data[start:end])
+
+    def __reduce__(self):
+        # reopen the mapping in other processes rather than copying the data
+        return (self.__class__, (self.path, self.offsets_path))
+
+
+class MemmapTextsWriter(MemmapVectorsWriter):
+    """
+    Write a list of strings, to be read with MemmapTexts.
+
+    Unlike the lines read by MemmapStrings, the strings may contain newlines and
+    surrounding whitespace. They are written as utf-8 to a flat byte array, with
+    the (start, end) positions of each string saved to ``offsets_path``.
+    """
+
+    def add(self, text):
+        """
+        Append a string, or None, and return its index.
+        """
+        if text is None:
+            self._offsets.extend((-1, -1))
+        else:
+            data = text.encode('utf-8')
+            self._file.write(data)
+            self._offsets.extend((self._size, self._size + len(data)))
+            self._size += len(data)
+        return len(self) - 1
+
+
+class MemmapTexts(MemmapVectors):
+    """
+    Read-only list of strings written with MemmapTextsWriter.
+
+    Strings are decoded when they are accessed. Missing strings are returned as
+    None.
+    """
+
+    dtype = np.uint8
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self._offsets[i]
+        if start < 0:
+            return None
+        return self._data[start:end].tobytes().decode('utf-8')
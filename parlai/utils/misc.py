@@ -12,23 +12,14 @@ import json
 import pickle
 import random
 import time
-import traceback
+import sys
 from typing import Any, Dict, List
 import warnings
 
 from parlai.core.message import Message
 
-# some of the utility methods are helpful for Torch
-try:
-    import torch
-
-    # default type in padded3d needs to be protected if torch
-    # isn't installed.
-    TORCH_LONG = torch.long
-    __TORCH_AVAILABLE = True
-except ImportError:
-    TORCH_LONG = None
-    __TORCH_AVAILABLE = False
+# some of the utility methods are helpful for Torch, which is slow to import, so
+# they import it when first called
 
 
 """Near infinity, useful as a large penalty for scoring when inf is bad."""
@@ -55,6 +46,8 @@ DISPLAY_MESSAGE_DEFAULT_FIELDS = {
 
 def neginf(dtype):
     """Return a representable finite number near -inf for a dtype."""
+    import torch
+
     if dtype is torch.float16:
         return -NEAR_INF_FP16
     else:
@@ -182,12 +175,39 @@ def load_opt_file(optfile):
     return Opt(opt)
 
 
+def _caller_location(depth=1):
+    """
+    Return the location of a caller, without formatting a stack trace.
+
+    :param depth: how many frames above the caller of this function to look.
+
+    :return: (filename, line number, function name)
+    """
+    frame = sys._getframe(depth + 1)
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def _format_location(loc):
+    if isinstance(loc, str):
+        # opts saved by older versions kept formatted stack entries
+        return loc
+    return '  File "{}", line {}, in {}\n'.format(*loc)
+
+
+# option values that deepcopy would return unchanged anyway
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+
 class Opt(dict):
     """
     Class for tracking options.
 
     Functions like a dict, but allows us to track the history of arguments
     as they are set.
+
+    Histories record the file, line and function of each change, which is
+    cheap enough to do on every assignment. Copies share the histories of the
+    original, and only copy a history when a key is next set.
     """
 
     def __init__(self, *args, **kwargs):
@@ -196,8 +216,9 @@ class Opt(dict):
         self.deepcopies = []
 
     def __setitem__(self, key, val):
-        loc = traceback.format_stack()[-2]
-        self.history.setdefault(key, []).append((loc, val))
+        loc = _caller_location()
+        # histories may be shared with copies, so replace rather than append
+        self.history[key] = self.history.get(key, []) + [(loc, val)]
         super().__setitem__(key, val)
 
     def __getstate__(self):
@@ -212,18 +233,17 @@ class Opt(dict):
 
     def __deepcopy__(self, memo):
         """Override deepcopy so that history is copied over to new object."""
-        # track location of deepcopy
-        loc = traceback.format_stack()[-3]
-        self.deepcopies.append(loc)
-        # deepcopy the dict
-        memo = deepcopy(dict(self))
-        # make into Opt object
-        memo = Opt(memo)
-        # deepcopy the history
-        memo.history = deepcopy(self.history)
-        # deepcopy the deepcopy history
-        memo.deepcopies = deepcopy(self.deepcopies)
-        return memo
+        # track location of deepcopy, skipping copy.deepcopy itself
+        self.deepcopies = self.deepcopies + [_caller_location(2)]
+        # deepcopy the dict, only visiting values which may be mutable
+        opt = Opt(
+            (k, v if type(v) in _IMMUTABLE_TYPES else deepcopy(v, memo))
+            for k, v in self.items()
+        )
+        # share the history until either opt changes it
+        opt.history = dict(self.history)
+        opt.deepcopies = self.deepcopies
+        return opt
 
     def display_deepcopies(self):
         """Display all deepcopies."""
@@ -232,7 +252,7 @@ class Opt(dict):
             return
         print('Deepcopies were performed at the following locations:\n')
         for i, loc in enumerate(self.deepcopies):
-            print('{}. {}'.format(i + 1, loc))
+            print('{}. {}'.format(i + 1, _format_location(loc)))
 
     def display_history(self, key):
         """Display the history for an item in the dict."""
@@ -243,7 +263,7 @@ class Opt(dict):
         for i, change in enumerate(item_hist):
             print(
                 '{}. {} was set to {} at:\n{}\n'.format(
-                    i + 1, key, change[1], change[0]
+                    i + 1, key, change[1], _format_location(change[0])
                 )
             )
 
@@ -897,7 +917,9 @@ def padded_tensor(
     :rtype: (Tensor[int64], list[int])
     """
     # hard fail if we don't have torch
-    if not __TORCH_AVAILABLE:
+    try:
+        import torch
+    except ImportError:
         raise ImportError(
             "Cannot use padded_tensor without torch; go to http://pytorch.org"
         )
@@ -942,7 +964,7 @@ def padded_tensor(
     return output, lens
 
 
-def padded_3d(tensors, pad_idx=0, use_cuda=0, dtype=TORCH_LONG, fp16friendly=False):
+def padded_3d(tensors, pad_idx=0, use_cuda=0, dtype=None, fp16friendly=False):
     """
     Make 3D padded tensor for list of lists of 1D tensors or lists.
 
@@ -952,12 +974,18 @@ def padded_3d(tensors, pad_idx=0, use_cuda=0, dtype=TORCH_LONG, fp16friendly=Fal
         padding to fill tensor with
     :param use_cuda:
         whether to call cuda() before returning
+    :param dtype:
+        type of the tensor, defaults to torch.long
     :param bool fp16friendly:
         if True, pads the final dimension to be a multiple of 8.
 
     :returns:
         3D tensor with the maximum dimensions of the inputs
     """
+    import torch
+
+    if dtype is None:
+        dtype = torch.long
     a = len(tensors)
     b = max(len(row) for row in tensors)
     c = max(len(item) for row in tensors for item in row)
@@ -1003,8 +1031,9 @@ def argsort(keys, *lists, descending=False):
         ind_sorted = list(reversed(ind_sorted))
     output = []
     for lst in lists:
-        # watch out in case we don't have torch installed
-        if __TORCH_AVAILABLE and isinstance(lst, torch.Tensor):
+        # watch out in case we don't have torch installed, or haven't imported it
+        torch = sys.modules.get('torch')
+        if torch is not None and isinstance(lst, torch.Tensor):
             output.append(lst[ind_sorted])
         else:
             output.append([lst[i] for i in ind_sorted])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Test setting up the bot of the chat services, without connecting to them."""
+
+import os
+import unittest
+from unittest import mock
+
+import parlai.utils.testing as testing_utils
+from parlai.core.params import ParlaiParser
+from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
+
+# the chat services start logging to a new file in the working directory when
+# they are imported, so import them from a temporary one
+with testing_utils.tempdir() as _logdir:
+    _cwd = os.getcwd()
+    os.chdir(_logdir)
+    try:
+        from parlai.chat_service.core.batching import (
+            BatchedBotAgent,
+            create_bot,
+            setup_shared_bot,
+            shutdown_shared_bot,
+        )
+        from parlai.chat_service.services.messenger.messenger_manager import (
+            MessengerManager,
+        )
+        from parlai.chat_service.services.messenger.shared_utils import WorldConfig
+    finally:
+        os.chdir(_cwd)
+
+
+def _messenger_opt(*args):
+    parser = ParlaiParser(True, True)
+    parser.add_messenger_args()
+    opt = parser.parse_args(['-m', 'repeat_label'] + list(args), print_args=False)
+    opt['bypass_server_setup'] = True
+    opt['config'] = {
+        'overworld': 'MessengerOverworld',
+        'world_path': 'parlai.chat_service.tasks.chatbot.worlds',
+        'page_id': 2,
+        'max_workers': 1,
+        'task_name': 'chatbot',
+        'configs': {
+            'default': WorldConfig(
+                world_name='default',
+                onboarding_name='MessengerBotChatOnboardWorld',
+                task_name='MessengerBotChatTaskWorld',
+                max_time_in_pool=300,
+                agents_required=1,
+                backup_task=None,
+            )
+        },
+    }
+    return opt
+
+
+class BatchRepeatLabelAgent(RepeatLabelAgent):
+    def batch_act(self, observations):
+        replies = []
+        for observation in observations:
+            self.observe(observation)
+            replies.append(self.act())
+        return replies
+
+
+def _reply(bot):
+    bot.observe({'text': 'hi', 'labels': ['hello'], 'episode_done': False})
+    return bot.act()['text']
+
+
+def _messenger_manager(opt):
+    # the access token would otherwise be read from ~/.parlai or asked for
+    with mock.patch.object(MessengerManager, 'get_app_token', return_value='token'):
+        return MessengerManager(opt)
+
+
+class TestMessengerManager(unittest.TestCase):
+    def test_shared_bot(self):
+        opt = _messenger_opt()
+        manager = _messenger_manager(opt)
+        self.assertIn('shared_bot_params', opt)
+        self.assertIsNone(opt.get('bot_batcher'))
+        bot = create_bot(opt)
+        self.assertNotIsInstance(bot, BatchedBotAgent)
+        self.assertEqual(_reply(bot), 'hello')
+        manager.shutdown()
+
+    def test_batching_unsupported(self):
+        # repeat_label has no batch_act, so each conversation gets its own copy
+        opt = _messenger_opt('--bot-batch-size', '4')
+        with self.assertWarns(UserWarning):
+            manager = _messenger_manager(opt)
+        self.assertIsNone(opt.get('bot_batcher'))
+        self.assertEqual(_reply(create_bot(opt)), 'hello')
+        manager.shutdown()
+
+
+class TestBotBatcher(unittest.TestCase):
+    def test_batched_bot(self):
+        opt = _messenger_opt('--bot-batch-size', '4')
+        setup_shared_bot(opt, BatchRepeatLabelAgent(opt))
+        bots = [create_bot(opt) for _ in range(3)]
+        for bot in bots:
+            self.assertIsInstance(bot, BatchedBotAgent)
+            self.assertEqual(_reply(bot), 'hello')
+        self.assertEqual(opt['bot_batcher'].num_replies, 3)
+        shutdown_shared_bot(opt)
+        self.assertIsNone(opt['bot_batcher'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,11 @@
 
 import os
 import unittest
+import torch
 import torch.distributed as dist
 import parlai.utils.testing as testing_utils
 import parlai.scripts.build_dict as build_dict
+import parlai.utils.distributed as distributed_utils
 
 
 def _forced_parse(parser, opt):
@@ -23,6 +25,31 @@ def _forced_parse(parser, opt):
     return popt
 
 
+def _sync_objects(rank, port, world_size, rank_offset=0):
+    """Exchange large objects between workers, checking what arrives."""
+    rank = rank + rank_offset
+    dist.init_process_group(
+        backend='gloo',
+        init_method='tcp://localhost:{}'.format(port),
+        world_size=world_size,
+        rank=rank,
+    )
+    # well over the old 64KB limit, and a different size on each worker
+    payload = {'rank': rank, 'data': list(range(50000 * (rank + 1)))}
+    gathered = distributed_utils.all_gather_list(payload)
+    assert [g['rank'] for g in gathered] == list(range(world_size))
+    assert all(
+        g['data'] == list(range(50000 * (r + 1))) for r, g in enumerate(gathered)
+    )
+    synced = distributed_utils.sync_object(payload)
+    assert synced['rank'] == 0 and synced['data'] == list(range(50000))
+    # don't let any worker tear down the group while others still use it
+    dist.barrier()
+    if rank_offset:
+        dist.destroy_process_group()
+    return gathered, synced
+
+
 @unittest.skip("Test disabled until #1974 is resolved.")
 class TestDistributed(unittest.TestCase):
     def _distributed_train_model(self, opt):
@@ -90,5 +117,123 @@ class TestDistributed(unittest.TestCase):
         )
 
 
+class TestDistributedCPU(unittest.TestCase):
+    """Distributed training on CPU, over the gloo backend."""
+
+    def tearDown(self):
+        if dist.is_initialized():
+            dist.destroy_process_group()
+
+    def test_sync_large_objects(self):
+        port = 31339
+        spawncontext = torch.multiprocessing.spawn(
+            _sync_objects, (port, 2, 1), nprocs=1, join=False
+        )
+        # the main process acts as rank 0
+        gathered, synced = _sync_objects(0, port, 2)
+        spawncontext.join()
+        self.assertEqual(len(gathered), 2)
+        self.assertEqual(len(gathered[1]['data']), 100000)
+        self.assertEqual(synced['rank'], 0)
+
+    def test_generator_distributed_cpu(self):
+        import parlai.scripts.multiprocessing_train as mp_train
+
+        with testing_utils.capture_output() as output:
+            with testing_utils.tempdir() as tmpdir:
+                opt = dict(
+                    task='integration_tests:nocandidate',
+                    model='transformer/generator',
+                    model_file=os.path.join(tmpdir, 'model'),
+                    dict_file=os.path.join(tmpdir, 'model.dict'),
+                    no_cuda=True,
+                    distributed_world_size=2,
+                    distributed_cores_per_worker=1,
+                    optimizer='adamax',
+                    learningrate=7e-3,
+                    batchsize=16,
+                    validation_every_n_epochs=5,
+                    num_epochs=20,
+                    n_layers=1,
+                    n_heads=1,
+                    ffn_size=32,
+                    embedding_size=32,
+                    beam_size=1,
+                )
+                popt = _forced_parse(mp_train.setup_args(), opt)
+                build_dict.build_dict(popt)
+                valid, test = mp_train.launch_and_train(popt, 31338)
+        stdout = output.getvalue()
+
+        self.assertLessEqual(
+            valid['ppl'], 1.20, "valid ppl = {}\nLOG:\n{}".format(valid['ppl'], stdout)
+        )
+        self.assertLessEqual(
+            test['ppl'], 1.20, "test ppl = {}\nLOG:\n{}".format(test['ppl'], stdout)
+        )
+
+    def _train_sharded(self, **kwargs):
+        """
+        Train on 2 CPU workers, then evaluate the saved model on its own.
+
+        :return: (stdout, valid, test, baseline_valid)
+        """
+        import parlai.scripts.multiprocessing_train as mp_train
+
+        with testing_utils.capture_output() as output:
+            with testing_utils.tempdir() as tmpdir:
+                opt = dict(
+                    task='integration_tests:nocandidate',
+                    model='seq2seq',
+                    model_file=os.path.join(tmpdir, 'model'),
+                    dict_file=os.path.join(tmpdir, 'model.dict'),
+                    no_cuda=True,
+                    distributed_world_size=2,
+                    distributed_cores_per_worker=1,
+                    batchsize=8,
+                    num_epochs=0.5,
+                    hiddensize=16,
+                    embeddingsize=16,
+                )
+                opt.update(kwargs)
+                popt = _forced_parse(mp_train.setup_args(), opt)
+                build_dict.build_dict(popt)
+                valid, test = mp_train.launch_and_train(popt, 31340)
+                dist.destroy_process_group()
+                _, baseline, _ = testing_utils.eval_model(
+                    dict(
+                        task=opt['task'],
+                        model_file=opt['model_file'],
+                        batchsize=8,
+                        no_cuda=True,
+                    ),
+                    skip_test=True,
+                )
+        return output.getvalue(), valid, test, baseline
+
+    def test_sharded_validation_cpu(self):
+        """Each worker validates its own shard, and the metrics are merged."""
+        stdout, valid, test, baseline = self._train_sharded()
+
+        # every example is evaluated exactly once
+        self.assertEqual(valid['exs'], 100, stdout)
+        self.assertEqual(test['exs'], 100, stdout)
+        self.assertAlmostEqual(valid['ppl'], baseline['ppl'], places=3, msg=stdout)
+
+    def test_sharded_validation_best_cpu(self):
+        """Every worker evaluates the best model, not the last one, at the end."""
+        # no later validation beats the first, so training carries on past the
+        # saved model
+        stdout, valid, _, baseline = self._train_sharded(
+            num_epochs=1.5,
+            validation_every_n_epochs=0.5,
+            validation_metric='exs',
+            validation_metric_mode='min',
+        )
+        self.assertIn('did not beat best exs', stdout)
+        self.assertEqual(valid['exs'], 100, stdout)
+        self.assertAlmostEqual(valid['ppl'], baseline['ppl'], places=3, msg=stdout)
+
+
 if __name__ == '__main__':
     unittest.main()
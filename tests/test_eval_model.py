@@ -6,6 +6,7 @@
 from examples.eval_model import setup_args
 
 import ast
+import os
 import unittest
 import parlai.utils.testing as testing_utils
 
@@ -152,6 +153,73 @@ class TestEvalModel(unittest.TestCase):
             'Task accuracy is averaged incorrectly',
         )
 
+    def test_max_tokens_per_batch(self):
+        """Test every example is evaluated once when batching by tokens."""
+        for task in ['integration_tests:multiturnCandidate', 'integration_tests']:
+            stdout, valid, test = testing_utils.eval_model(
+                {
+                    'task': task,
+                    'model': 'repeat_label',
+                    'batchsize': 8,
+                    'max_tokens_per_batch': 50,
+                }
+            )
+            _, baseline, _ = testing_utils.eval_model(
+                {'task': task, 'model': 'repeat_label', 'batchsize': 8}
+            )
+            self.assertEqual(valid['exs'], baseline['exs'], stdout)
+            self.assertEqual(test['exs'], baseline['exs'], stdout)
+            self.assertEqual(valid['accuracy'], 1, stdout)
+
+    def test_eval_workers(self):
+        """Test sharded evaluation sees every example exactly once."""
+        task = 'integration_tests:multiturnCandidate,integration_tests:candidate'
+        stdout, valid, test = testing_utils.eval_model(
+            {'task': task, 'model': 'repeat_label', 'batchsize': 4, 'eval_workers': 3}
+        )
+        _, baseline, _ = testing_utils.eval_model(
+            {'task': task, 'model': 'repeat_label', 'batchsize': 4}
+        )
+        self.assertEqual(valid, baseline, stdout)
+        self.assertEqual(test['exs'], baseline['exs'], stdout)
+
+    def test_eval_workers_num_examples(self):
+        """Test sharded evaluation splits --num-examples between the shards."""
+        for num_workers in [3, 6]:
+            _, valid, _ = testing_utils.eval_model(
+                {
+                    'task': 'integration_tests',
+                    'model': 'repeat_label',
+                    'num_examples': 4,
+                    'eval_workers': num_workers,
+                },
+                skip_test=True,
+            )
+            self.assertEqual(valid['exs'], 4)
+
+    def test_eval_workers_model_metrics(self):
+        """Test the model's own metrics are merged exactly across shards."""
+        with testing_utils.tempdir() as tmpdir:
+            opt = {
+                'task': 'integration_tests:multiturn_nocandidate',
+                'model': 'seq2seq',
+                'model_file': os.path.join(tmpdir, 'model'),
+                'dict_file': os.path.join(tmpdir, 'model.dict'),
+                'batchsize': 4,
+                'hiddensize': 16,
+                'embeddingsize': 16,
+                'no_cuda': True,
+            }
+            testing_utils.train_model(dict(opt, num_epochs=0.1))
+            stdout, valid, _ = testing_utils.eval_model(
+                dict(opt, eval_workers=2), skip_test=True
+            )
+            _, baseline, _ = testing_utils.eval_model(opt, skip_test=True)
+
+        self.assertEqual(valid['exs'], baseline['exs'], stdout)
+        for k in ['ppl', 'token_acc', 'f1']:
+            self.assertAlmostEqual(valid[k], baseline[k], places=3, msg=stdout)
+
 
 if __name__ == '__main__':
     unittest.main()
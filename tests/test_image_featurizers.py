@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Test the image feature store and loader, without a CNN."""
+
+import os
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image
+
+import parlai.utils.testing as testing_utils
+import parlai.core.image_featurizers as image_featurizers
+from parlai.core.image_featurizers import ImageFeatureStore, ImageLoader
+
+
+def _to_tensor(image):
+    # stands in for the torchvision transform, and must be picklable
+    return torch.from_numpy(np.asarray(image, dtype=np.float32))
+
+
+class TestImageFeatureStore(unittest.TestCase):
+    def test_round_trip(self):
+        features = {str(i): torch.randn(4, 2) for i in range(5)}
+        with testing_utils.tempdir() as tmpdir:
+            store = ImageFeatureStore(tmpdir, chunk_size=2)
+            for image_id, feature in features.items():
+                store.add(image_id, feature)
+            # two full chunks were written, and one feature is pending
+            self.assertEqual(store.num_chunks, 2)
+            self.assertIn('4', store)
+            self.assertTrue(torch.equal(store.get('4'), features['4']))
+            store.flush()
+            self.assertEqual(store.num_chunks, 3)
+
+            reopened = ImageFeatureStore(tmpdir, chunk_size=2)
+            self.assertEqual(reopened.num_chunks, 3)
+            for image_id, feature in features.items():
+                self.assertIn(image_id, reopened)
+                self.assertTrue(torch.equal(reopened.get(image_id), feature))
+            self.assertIsNone(reopened.get('missing'))
+            # features already stored are not written again
+            reopened.add('0', torch.zeros(4, 2))
+            reopened.flush()
+            self.assertEqual(reopened.num_chunks, 3)
+
+
+def _identity_loader():
+    loader = ImageLoader(
+        {'image_mode': 'raw', 'image_decode_workers': 1, 'image_extract_batchsize': 2}
+    )
+    # set up what the CNN image modes would, with an identity CNN
+    loader.torch = torch
+    loader.transform = _to_tensor
+    loader._run_cnn = lambda images: images
+    return loader
+
+
+class TestImageLoader(unittest.TestCase):
+    def test_batched_features(self):
+        loader = _identity_loader()
+        features = {}
+
+        def extract(path):
+            features[path] = loader._extract_path(path)
+
+        with testing_utils.tempdir() as tmpdir:
+            paths = [os.path.join(tmpdir, '{}.png'.format(i)) for i in range(2)]
+            for i, path in enumerate(paths):
+                Image.new('RGB', (3, 2), (i, i, i)).save(path)
+            # wait long enough for both images to be extracted in one batch
+            with mock.patch.object(image_featurizers, '_batch_timeout', 5):
+                threads = [threading.Thread(target=extract, args=(p,)) for p in paths]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        loader.shutdown()
+        for i, path in enumerate(paths):
+            feature = features[path]
+            self.assertEqual(feature.tolist(), [[[[i] * 3] * 3] * 2])
+            # each feature holds only its own values, not the whole batch
+            self.assertEqual(feature.storage().size(), feature.numel())
+
+    def test_shutdown(self):
+        loader = _identity_loader()
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'image.png')
+            Image.new('RGB', (3, 2), (1, 2, 3)).save(path)
+            feature = loader._extract_path(path)
+        self.assertEqual(feature.tolist(), [[[[1, 2, 3]] * 3] * 2])
+        self.assertIsNotNone(loader._decode_pool)
+
+        loader.shutdown()
+        self.assertIsNone(loader._decode_pool)
+        self.assertIsNone(loader._batch_requests)
+        # shutting down twice is fine
+        loader.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
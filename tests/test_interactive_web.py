@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Test the web server of interactive_web."""
+
+import json
+import threading
+import unittest
+from http.client import HTTPConnection
+
+import parlai.scripts.interactive_web as interactive_web
+import parlai.utils.testing as testing_utils
+
+
+class TestInteractiveWeb(unittest.TestCase):
+    def setUp(self):
+        interactive_web.SHARED.clear()
+        with testing_utils.capture_output():
+            interactive_web.setup_interactive(
+                interactive_web.SHARED,
+                ['-m', 'repeat_query', '--workers', '1', '--max-pending', '1'],
+            )
+        self.httpd = interactive_web.ThreadedHTTPServer(
+            ('localhost', 0), interactive_web.MyHandler
+        )
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def _post(self, path, body='', session_id=None):
+        conn = HTTPConnection('localhost', self.port, timeout=10)
+        headers = {'Content-Type': 'application/json'}
+        if session_id is not None:
+            headers['X-Session-Id'] = session_id
+        conn.request('POST', path, body.encode('utf-8'), headers)
+        response = conn.getresponse()
+        status, data = response.status, json.loads(response.read())
+        cookie = response.getheader('Set-Cookie')
+        conn.close()
+        return status, data, cookie
+
+    def test_sessions(self):
+        status, data, cookie = self._post('/interact', 'hello')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['text'], 'hello')
+        # a new session is given an id
+        self.assertTrue(cookie.startswith('session_id='))
+
+        self._post('/interact', 'from a', session_id='a')
+        self._post('/interact', 'from b', session_id='b')
+        sessions = interactive_web.SHARED['sessions']
+        self.assertIsNot(sessions['a'].bot, sessions['b'].bot)
+        self.assertEqual(sessions['a'].bot.observation['text'], 'from a')
+        self.assertEqual(sessions['b'].bot.observation['text'], 'from b')
+
+        # resetting a session forgets only its own conversation
+        self._post('/reset', session_id='a')
+        self.assertNotIn('a', sessions)
+        self.assertEqual(sessions['b'].bot.observation['text'], 'from b')
+
+    def test_max_pending(self):
+        workers = interactive_web.SHARED['workers']
+        # hold the only worker, so the first request stays in flight
+        workers.acquire()
+        first = {}
+        thread = threading.Thread(
+            target=lambda: first.update(response=self._post('/interact', 'first'))
+        )
+        thread.start()
+        while interactive_web.SHARED['in_flight'] == 0 and thread.is_alive():
+            thread.join(0.01)
+
+        status, data, _ = self._post('/interact', 'second')
+        self.assertEqual(status, 503)
+        self.assertIn('error', data)
+
+        workers.release()
+        thread.join()
+        self.assertEqual(first['response'][0], 200)
+        self.assertEqual(first['response'][1]['text'], 'first')
+        metrics = interactive_web.get_metrics()
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['requests'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Test the batched metric computation in parlai.core.metrics."""
+
+import random
+import unittest
+
+from parlai.core import metrics
+
+WORDS = 'the a an cat dog sat on mat , . hello world yes no it is'.split()
+
+
+def _random_examples(num_examples):
+    rng = random.Random(42)
+
+    def sentence():
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 12)))
+
+    predictions, labels, candidates = [], [], []
+    for i in range(num_examples):
+        predictions.append(None if i % 37 == 0 else sentence())
+        labels.append([sentence() for _ in range(rng.randint(1, 3))])
+        cands = [sentence() for _ in range(9)] + labels[-1][:1]
+        rng.shuffle(cands)
+        candidates.append(None if i % 3 else cands)
+    return predictions, labels, candidates
+
+
+class TestMetrics(unittest.TestCase):
+    def test_score_batch(self):
+        """Batched scores match those of each example on its own."""
+        predictions, labels, candidates = _random_examples(500)
+        scores = metrics.score_batch(
+            predictions, labels, candidates, metrics.DEFAULT_METRICS | {'bleu-1'}
+        )
+        expected = {'correct': 0, 'f1': 0, 'bleu-1': 0, 'bleu-2': 0, 'bleu-4': 0}
+        num_hits = 0
+        for prediction, answers, cands in zip(predictions, labels, candidates):
+            if cands is not None:
+                normalized = {metrics.normalize_answer(a) for a in answers}
+                num_hits += metrics.normalize_answer(cands[0]) in normalized
+            if prediction is None:
+                continue
+            expected['correct'] += metrics._exact_match(prediction, answers)
+            expected['f1'] += metrics._f1_score(prediction, answers)
+            expected['bleu-1'] += metrics._bleu(prediction, answers, [1])
+            expected['bleu-2'] += metrics._bleu(prediction, answers, [0.5, 0.5])
+            expected['bleu-4'] += metrics._bleu(prediction, answers)
+        for k, v in expected.items():
+            self.assertAlmostEqual(scores[k], v, places=6, msg=k)
+        num_predictions = sum(p is not None for p in predictions)
+        self.assertEqual(scores['cnt'], len(predictions))
+        self.assertEqual(scores['f1_cnt'], num_predictions)
+        self.assertEqual(scores['bleu-3_cnt'], num_predictions)
+        self.assertEqual(scores['hits@1'], num_hits)
+        self.assertEqual(scores['hits@10'], scores['hits@_cnt'])
+
+    def test_metrics_workers(self):
+        """Scoring in background processes gives the same report."""
+        predictions, labels, _ = _random_examples(300)
+        reports = []
+        for num_workers in [0, 2]:
+            m = metrics.Metrics({'metrics': 'all', 'metrics_workers': num_workers})
+            m.batchsize = 64
+            for prediction, answers in zip(predictions, labels):
+                m.update({'text': prediction, 'metrics': {'loss': 1.0}}, answers)
+            reports.append(m.report())
+            m.clear()
+            self.assertEqual(m.report(), {'exs': 0})
+        self.assertEqual(reports[0], reports[1])
+        self.assertEqual(reports[0]['exs'], len(predictions))
+        self.assertIn('bleu-4', reports[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@
 import os
 import json
 import unittest
+from unittest import mock
 from parlai.core.params import ParlaiParser
 import parlai.core.agents as agents
 import parlai.utils.testing as testing_utils
@@ -51,6 +52,39 @@ class TestParlaiParser(unittest.TestCase):
                 opt = pp.parse_args(['--model-file', modfn])
                 agents.create_agent(opt)
 
+    def test_arg_registry(self):
+        """Test model and task args are replayed from the registry."""
+        args = [
+            '--model',
+            'seq2seq',
+            '--task',
+            'integration_tests',
+            '--hiddensize',
+            '16',
+        ]
+
+        def parse():
+            pp = ParlaiParser(True, True)
+            opt = pp.parse_args(args, print_args=False)
+            del opt['starttime']
+            return opt
+
+        with testing_utils.tempdir() as tmp:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp}):
+                opt = parse()
+                self.assertTrue(
+                    os.path.isfile(os.path.join(tmp, 'parlai', 'arg_registry.pkl'))
+                )
+                with mock.patch.object(
+                    agents, 'get_agent_module', side_effect=AssertionError
+                ), mock.patch.object(
+                    agents, 'get_task_module', side_effect=AssertionError
+                ):
+                    cached_opt = parse()
+                self.assertEqual(opt, cached_opt)
+                self.assertEqual(cached_opt['hiddensize'], 16)
+                self.assertEqual(cached_opt['rnn_class'], 'lstm')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,9 +8,11 @@ from parlai.scripts.display_data import setup_args as display_setup_args, displa
 from parlai.scripts.train_model import setup_args as train_setup_args
 from parlai.core.agents import create_task_agent_from_taskname, create_agent
 from parlai.core.worlds import create_task
-from parlai.core.pytorch_data_teacher import ep_length
+from parlai.core.pytorch_data_teacher import BinaryDataset, ep_length
+from parlai.scripts.build_pytorch_data import get_vectorization_hash
 
 import unittest
+from unittest import mock
 import parlai.utils.testing as testing_utils
 import os
 import torch
@@ -283,6 +285,13 @@ class TestPytorchDataTeacher(unittest.TestCase):
 
     """Integration Tests"""
 
+    def _train_model(self, defaults):
+        # build the pytorch data in a temporary data path, which the parser
+        # also records in the environment
+        with testing_utils.tempdir() as tmpdir, mock.patch.dict(os.environ):
+            defaults['datapath'] = tmpdir
+            return testing_utils.train_model(defaults)
+
     def _pyt_train(self, datatype):
         """
         Integration test: ensure that pytorch data teacher can successfully
@@ -294,7 +303,7 @@ class TestPytorchDataTeacher(unittest.TestCase):
         defaults = integration_test_parser_defaults.copy()
         defaults['datatype'] = datatype
         defaults['shuffle'] = True  # for train:stream
-        str_output, valid, test = testing_utils.train_model(defaults)
+        str_output, valid, test = self._train_model(defaults)
         self.assertTrue(
             solved_task(str_output, valid, test),
             'Teacher could not teach seq2seq with args: {}; here is str_output: {}'.format(
@@ -326,7 +335,7 @@ class TestPytorchDataTeacher(unittest.TestCase):
         defaults = integration_test_parser_defaults.copy()
         defaults['datatype'] = 'train'
         defaults['pytorch_preprocess'] = True
-        str_output, valid, test = testing_utils.train_model(defaults)
+        str_output, valid, test = self._train_model(defaults)
         self.assertTrue(
             solved_task(str_output, valid, test),
             'Teacher could not teach seq2seq with preprocessed obs, output: {}'.format(
@@ -334,6 +343,66 @@ class TestPytorchDataTeacher(unittest.TestCase):
             ),
         )
 
+    @testing_utils.retry()
+    def test_pyt_binary_train(self):
+        """
+        Test that an agent can train to completion with examples read from
+        binary, pre-tokenized data.
+        """
+        defaults = integration_test_parser_defaults.copy()
+        defaults['datatype'] = 'train'
+        defaults['pytorch_data_format'] = 'binary'
+        str_output, valid, test = self._train_model(defaults)
+        self.assertTrue(
+            solved_task(str_output, valid, test),
+            'Teacher could not teach seq2seq with binary data, output: {}'.format(
+                str_output
+            ),
+        )
+
+    def test_pyt_binary(self):
+        """
+        Test that binary data holds the vectors the agent would compute itself.
+        """
+        with testing_utils.capture_output(), testing_utils.tempdir() as tmpdir, mock.patch.dict(
+            os.environ
+        ):
+            defaults = integration_test_parser_defaults.copy()
+            defaults['pytorch_teacher_task'] = 'integration_tests:multiturn_nocandidate'
+            defaults['datapath'] = tmpdir
+            defaults['datatype'] = 'valid'
+            defaults['batchsize'] = 1
+            defaults['model_file'] = os.path.join(tmpdir, 'model')
+            defaults['dict_file'] = os.path.join(tmpdir, 'model.dict')
+            parser = train_setup_args()
+            parser.set_defaults(**defaults)
+            opt = parser.parse_args()
+            build_dict(opt)
+            json_teacher = create_task_agent_from_taskname(opt)[0]
+            agent = create_agent(opt)
+
+            opt['pytorch_data_format'] = 'binary'
+            binary_teacher = create_task_agent_from_taskname(opt)[0]
+            self.assertIsInstance(binary_teacher.dataset, BinaryDataset)
+            # only the binary store is written
+            datafiles = os.listdir(binary_teacher.dataset.datapath)
+            self.assertNotIn('data', datafiles)
+            self.assertNotIn('char_index', datafiles)
+            # a new dictionary means new data
+            hash_ = get_vectorization_hash(agent)
+            agent.dict.add_token('unseen')
+            self.assertNotEqual(hash_, get_vectorization_hash(agent))
+
+            for _ in range(binary_teacher.num_examples()):
+                observation = agent.observe(json_teacher.act())
+                act = binary_teacher.act()
+                self.assertEqual(act['text'], observation['text'])
+                self.assertEqual(act['eval_labels'], observation['eval_labels'])
+                self.assertIs(act['episode_done'], True)
+                self.assertEqual(act['text_vec'].dtype, torch.int32)
+                for key in ['text_vec', 'eval_labels_vec']:
+                    self.assertEqual(act[key].tolist(), observation[key].tolist())
+
     def _pyt_batchsort_train(self, datatype, preprocess):
         """
         Tests the functionality of training with batchsort
@@ -349,7 +418,7 @@ class TestPytorchDataTeacher(unittest.TestCase):
         defaults['pytorch_teacher_batch_sort'] = True
         if preprocess:
             defaults['batch_sort_field'] = 'text_vec'
-        str_output, valid, test = testing_utils.train_model(defaults)
+        str_output, valid, test = self._train_model(defaults)
         self.assertTrue(
             solved_task(str_output, valid, test),
             'Teacher could not teach seq2seq with batch sort '
@@ -4,7 +4,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import unittest
+from unittest import mock
+
+from parlai.core.agents import create_agent, create_agent_from_shared
+from parlai.core.dict import DictionaryAgent
+from parlai.core.params import ParlaiParser
 import parlai.utils.testing as testing_utils
 
 BATCH_SIZE = 16
@@ -109,6 +115,64 @@ class TestSeq2Seq(unittest.TestCase):
             test['ppl'] < 1.2, "test ppl = {}\nLOG:\n{}".format(test['ppl'], stdout)
         )
 
+    @testing_utils.retry(ntries=3)
+    def test_max_tokens_per_batch(self):
+        """Multi-turn generation, with batches of similar length examples."""
+        stdout, valid, test = testing_utils.train_model(
+            dict(
+                task='integration_tests:multiturn_nocandidate',
+                model='seq2seq',
+                learningrate=LR,
+                batchsize=BATCH_SIZE,
+                max_tokens_per_batch=160,
+                num_epochs=NUM_EPOCHS * 2,
+                no_cuda=True,
+                embeddingsize=16,
+                hiddensize=16,
+                rnn_class='gru',
+                attention='general',
+                gradient_clip=1.0,
+                dropout=0.0,
+                lookuptable='all',
+            )
+        )
+
+        self.assertTrue(
+            valid['ppl'] < 1.2, "valid ppl = {}\nLOG:\n{}".format(valid['ppl'], stdout)
+        )
+        self.assertTrue(
+            test['ppl'] < 1.2, "test ppl = {}\nLOG:\n{}".format(test['ppl'], stdout)
+        )
+
+    @testing_utils.retry(ntries=3)
+    def test_preprocess_workers(self):
+        """Multi-turn generation, with batches built in background processes."""
+        stdout, valid, test = testing_utils.train_model(
+            dict(
+                task='integration_tests:multiturn_nocandidate',
+                model='seq2seq',
+                learningrate=LR,
+                batchsize=BATCH_SIZE,
+                preprocess_workers=2,
+                num_epochs=NUM_EPOCHS * 2,
+                no_cuda=True,
+                embeddingsize=16,
+                hiddensize=16,
+                rnn_class='gru',
+                attention='general',
+                gradient_clip=1.0,
+                dropout=0.0,
+                lookuptable='all',
+            )
+        )
+
+        self.assertTrue(
+            valid['ppl'] < 1.2, "valid ppl = {}\nLOG:\n{}".format(valid['ppl'], stdout)
+        )
+        self.assertTrue(
+            test['ppl'] < 1.2, "test ppl = {}\nLOG:\n{}".format(test['ppl'], stdout)
+        )
+
     def test_badinput(self):
         """Ensures model doesn't crash on malformed inputs."""
         stdout, _, _ = testing_utils.train_model(
@@ -161,6 +225,66 @@ class TestHogwildSeq2seq(unittest.TestCase):
         )
 
 
+class TestEncoderCache(unittest.TestCase):
+    """Checks that cached encoder states in interactive mode are exact."""
+
+    def _chat(self, agent, turns):
+        replies = []
+        for turn in turns:
+            agent.observe({'text': turn, 'episode_done': False})
+            replies.append(agent.act()['text'])
+        return replies
+
+    def test_cache_encoder_states(self):
+        turns = ['hello there', 'how are you', 'i like cats and dogs']
+        with testing_utils.tempdir() as tmpdir:
+            dict_file = os.path.join(tmpdir, 'model.dict')
+            pp = ParlaiParser(True, True)
+            opt = pp.parse_args(
+                ['--model', 'seq2seq', '--dict-file', dict_file], print_args=False
+            )
+            with testing_utils.capture_output():
+                dictionary = DictionaryAgent(opt)
+                for turn in turns:
+                    dictionary.add_to_dict(dictionary.tokenize(turn))
+                dictionary.save(dict_file)
+
+            pp = ParlaiParser(True, True)
+            opt = pp.parse_args(
+                [
+                    '--model',
+                    'seq2seq',
+                    '--dict-file',
+                    dict_file,
+                    '--no-cuda',
+                    '--interactive-mode',
+                    'true',
+                    '--cache-encoder-states',
+                    'true',
+                    '--hiddensize',
+                    '16',
+                    '--embeddingsize',
+                    '16',
+                    '--attention',
+                    'general',
+                ],
+                print_args=False,
+            )
+            with testing_utils.capture_output():
+                agent = create_agent(opt)
+                uncached = create_agent_from_shared(agent.share())
+                uncached.cache_encoder_states = False
+
+            model = agent.model
+            with mock.patch.object(
+                model, 'extend_encoder_states', wraps=model.extend_encoder_states
+            ) as extend:
+                cached_replies = self._chat(agent, turns)
+            # every turn after the first extends the cached history
+            self.assertEqual(extend.call_count, len(turns) - 1)
+            self.assertEqual(cached_replies, self._chat(uncached, turns))
+
+
 class TestBackwardsCompatibility(unittest.TestCase):
     """
     Tests that a binary file continues to work over time.
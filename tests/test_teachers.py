@@ -10,9 +10,32 @@ A module for testing various teacher types in ParlAI
 
 import os
 import unittest
+from parlai.core.agents import create_task_agent_from_taskname
+from parlai.core.params import ParlaiParser
+from parlai.core.teachers import PackedEpisodes
 from parlai.utils import testing as testing_utils
 import regex as re
 
+FB_DATA = """1 Sam went to the kitchen.
+2 Pat gave Sam the milk.
+3 Where is the milk?\tkitchen\t1\thallway|kitchen|bathroom
+4 Sam went to the hallway.
+5 Where is the milk?\thallway\t1\thallway|kitchen|bathroom
+
+1 Hi how's it going?\tIt's going great. What's new?
+2 Well I'm working on a new project at work.\tOh me too!
+3 That is all.
+1 Oh cool!\tTell me about yours.
+"""
+
+PARLAI_DATA = """text:Sam went to the kitchen.\tlabels:kitchen
+text:Where is the milk?\tlabels:kitchen\tepisode_done:True
+
+text:Hi how's it going?\tlabels:It's going great.\tepisode_done:True
+text:Well I'm working on a new project at work.\tlabels:Oh me too!
+text:Oh cool!\tlabels:Tell me about yours.
+"""
+
 
 class TestAbstractImageTeacher(unittest.TestCase):
     """Test AbstractImageTeacher."""
@@ -40,5 +63,142 @@ class TestAbstractImageTeacher(unittest.TestCase):
                 _test_display_output(opt)
 
 
+class TestLazyLoad(unittest.TestCase):
+    """Test reading data files from disk on demand."""
+
+    def _get_all(self, task, datafile, lazy_load):
+        parser = ParlaiParser(True, False)
+        opt = parser.parse_args(
+            [
+                '--task',
+                task,
+                '--fromfile-datapath',
+                datafile,
+                '--datatype',
+                'valid',
+                '--lazy-load',
+                str(lazy_load),
+                '--lazy-load-cache-size',
+                '2',
+            ],
+            print_args=False,
+        )
+        with testing_utils.capture_output() as output:
+            teacher = create_task_agent_from_taskname(opt)[0]
+        examples = []
+        for i in range(teacher.num_episodes()):
+            j = 0
+            while True:
+                ex = teacher.get(i, j)
+                examples.append(dict(ex))
+                if ex['episode_done']:
+                    break
+                j += 1
+        self.assertEqual(len(examples), teacher.num_examples())
+        return examples, output.getvalue()
+
+    def _test_lazy_load(self, task, data):
+        with testing_utils.tempdir() as tmpdir:
+            datafile = os.path.join(tmpdir, 'data.txt')
+            with open(datafile, 'w') as f:
+                f.write(data)
+            examples, _ = self._get_all(task, datafile, False)
+            self.assertGreater(len(examples), 0)
+            lazy_examples, output = self._get_all(task, datafile, True)
+            self.assertEqual(examples, lazy_examples)
+            self.assertIn('building episode index', output)
+            # the index is reused, until the data changes
+            lazy_examples, output = self._get_all(task, datafile, True)
+            self.assertEqual(examples, lazy_examples)
+            self.assertNotIn('building episode index', output)
+            with open(datafile, 'a') as f:
+                f.write(data)
+            lazy_examples, output = self._get_all(task, datafile, True)
+            self.assertIn('building episode index', output)
+            self.assertEqual(lazy_examples, self._get_all(task, datafile, False)[0])
+
+    def test_fbdialog(self):
+        self._test_lazy_load('fromfile:fbformat', FB_DATA)
+
+    def test_parlai(self):
+        self._test_lazy_load('fromfile:parlaiformat', PARLAI_DATA)
+
+    def test_parlai_field_values(self):
+        # only the episode_done field ends an episode, and lines are parsed the
+        # same way whether or not they hold an example
+        data = (
+            'text:What does episode_done:True mean?\tlabels:The end.\n'
+            '   \n'
+            'text:Got it.\tlabels:Good.\tepisode_done:True\n'
+        ) + PARLAI_DATA
+        self._test_lazy_load('fromfile:parlaiformat', data)
+
+
+class TestPackedEpisodes(unittest.TestCase):
+    """Test storing dialog data in shared memory."""
+
+    def test_roundtrip(self):
+        episodes = [
+            (
+                ('a', ('b', 'c'), 1.5, ('x', 'b', 'c'), 'image.jpg'),
+                ('t', None),
+                ('u',),
+            ),
+            (
+                ('z', ('y',), None, 'same as last time'),
+                (None, ('q',), 3, None),
+                ('w', (), True, ()),
+                ('s', ('k',), 'r', ('k',)),
+            ),
+        ]
+        packed = PackedEpisodes(episodes)
+        self.assertEqual(len(packed), len(episodes))
+        for episode, packed_episode in zip(episodes, packed):
+            self.assertEqual(list(episode), list(packed_episode))
+            for entry, packed_entry in zip(episode, packed_episode):
+                self.assertEqual(
+                    [type(v) for v in entry], [type(v) for v in packed_entry]
+                )
+        self.assertEqual(packed[-1][-1], episodes[-1][-1])
+        with self.assertRaises(IndexError):
+            packed[1][4]
+
+    def test_hogwild_teacher(self):
+        """Teachers of hogwild training should pack their data."""
+        with testing_utils.tempdir() as tmpdir:
+            datafile = os.path.join(tmpdir, 'data.txt')
+            with open(datafile, 'w') as f:
+                f.write(FB_DATA)
+            examples = []
+            for numthreads in [1, 2]:
+                parser = ParlaiParser(True, False)
+                opt = parser.parse_args(
+                    [
+                        '--task',
+                        'fromfile:fbformat',
+                        '--fromfile-datapath',
+                        datafile,
+                        '--datatype',
+                        'valid',
+                        '--numthreads',
+                        str(numthreads),
+                    ],
+                    print_args=False,
+                )
+                with testing_utils.capture_output():
+                    teacher = create_task_agent_from_taskname(opt)[0]
+                self.assertEqual(
+                    isinstance(teacher.data.data, PackedEpisodes), numthreads > 1
+                )
+                examples.append(
+                    [
+                        dict(teacher.get(i, j))
+                        for i in range(teacher.num_episodes())
+                        for j in range(len(teacher.data.data[i]))
+                    ]
+                )
+            self.assertEqual(examples[0], examples[1])
+
+
 if __name__ == '__main__':
     unittest.main()
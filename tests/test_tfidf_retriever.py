@@ -8,6 +8,7 @@ from parlai.core.params import ParlaiParser
 from parlai.core.agents import create_agent
 from parlai.core.worlds import create_task
 from parlai.utils.logging import logger, ERROR
+import parlai.utils.testing as testing_utils
 
 import os
 import unittest
@@ -86,6 +87,85 @@ class TestTfidfRetriever(unittest.TestCase):
             if os.path.exists(TFIDF_PATH + '.npz'):
                 os.remove(TFIDF_PATH + '.npz')
 
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_batch_act(self):
+        """Batched retrieval should match retrieving one query at a time."""
+        with testing_utils.tempdir() as tmpdir:
+            parser = ParlaiParser(True, True)
+            parser.set_defaults(
+                model='tfidf_retriever',
+                task='integration_tests:nocandidate',
+                model_file=os.path.join(tmpdir, 'model'),
+                retriever_hashsize=2 ** 8,
+                datatype='train:ordered',
+                num_epochs=1,
+            )
+            opt = parser.parse_args(print_args=False)
+            with testing_utils.capture_output():
+                agent = create_agent(opt)
+                train_world = create_task(opt, agent)
+                while not train_world.epoch_done():
+                    train_world.parley()
+                agent.rebuild()
+
+            queries = [
+                {'text': '1 2 3 4', 'episode_done': True},
+                {'text': '5 6 7 8 9 0', 'episode_done': True},
+                {'text': '!', 'episode_done': True},
+                {'text': '3 3 3', 'episode_done': True},
+            ]
+            batch_reply = agent.batch_act(queries)
+            for query, reply in zip(queries, batch_reply):
+                agent.observe(query)
+                single_reply = agent.act()
+                if 'text_candidates' not in single_reply:
+                    # nothing found, the reply is a random generic response
+                    self.assertNotIn('text_candidates', reply)
+                    continue
+                self.assertEqual(reply['text'], single_reply['text'])
+                self.assertEqual(
+                    reply['text_candidates'], single_reply['text_candidates']
+                )
+                self.assertEqual(
+                    list(reply['candidate_scores']),
+                    list(single_reply['candidate_scores']),
+                )
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_sharded_build(self):
+        """Building the index in many shards should match building it at once."""
+        from parlai.agents.tfidf_retriever import build_tfidf, utils
+
+        with testing_utils.tempdir() as tmpdir:
+            parser = ParlaiParser(True, True)
+            parser.set_defaults(
+                model='tfidf_retriever',
+                task='integration_tests:nocandidate',
+                model_file=os.path.join(tmpdir, 'model'),
+                retriever_hashsize=2 ** 8,
+                retriever_shard_size=16,
+                datatype='train:ordered',
+                num_epochs=1,
+            )
+            opt = parser.parse_args(print_args=False)
+            with testing_utils.capture_output():
+                agent = create_agent(opt)
+                train_world = create_task(opt, agent)
+                while not train_world.epoch_done():
+                    train_world.parley()
+                agent.rebuild()
+
+                tfidf, metadata = utils.load_sparse_csr(opt['retriever_tfidfpath'])
+                counts = build_tfidf.get_count_matrix(
+                    agent.tfidf_args, {'db_path': opt['retriever_dbpath']}
+                )
+            expected = build_tfidf.get_tfidf_matrix(counts)
+            self.assertEqual(tfidf.shape, expected.shape)
+            self.assertEqual((tfidf != expected).nnz, 0)
+            self.assertEqual(
+                list(metadata['doc_freqs']), list(build_tfidf.get_doc_freqs(counts))
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,10 +6,15 @@
 """Test TorchGeneratorAgent."""
 
 import unittest
+import torch
 from parlai.core.agents import create_agent
 import parlai.utils.testing as testing_utils
 from parlai.core.params import ParlaiParser
-from parlai.core.torch_generator_agent import TorchGeneratorAgent
+from parlai.core.torch_generator_agent import (
+    TorchGeneratorAgent,
+    BeamSearch,
+    GreedySearch,
+)
 
 
 class TestUpgradeOpt(unittest.TestCase):
@@ -50,5 +55,58 @@ class TestUpgradeOpt(unittest.TestCase):
             self.assertEqual(agent.opt['inference'], 'beam')
 
 
+class TestTreeSearch(unittest.TestCase):
+    """Test the batched tree search."""
+
+    def _search(self, cls, logprobs, bsz, **kwargs):
+        search = cls(logprobs.size(2), bsz=bsz, **kwargs)
+        for step in logprobs:
+            if search.is_done():
+                break
+            search.advance(step.clone())
+        return search.get_rescored_finished()
+
+    def _check_batched(self, cls, beam_size, **kwargs):
+        """Searching a batch must match searching each example on its own."""
+        torch.manual_seed(42)
+        bsz, vocab, steps = 4, 12, 15
+        logprobs = torch.log_softmax(
+            torch.randn(steps, bsz, beam_size, vocab) * 2, dim=-1
+        )
+        batched = self._search(cls, logprobs, bsz, **kwargs)
+        self.assertEqual(len(batched), bsz)
+        for i in range(bsz):
+            single = self._search(cls, logprobs[:, i : i + 1], 1, **kwargs)[0]
+            self.assertEqual(len(batched[i]), len(single))
+            for (pred1, score1), (pred2, score2) in zip(batched[i], single):
+                self.assertEqual(pred1.tolist(), pred2.tolist())
+                self.assertAlmostEqual(score1.item(), score2.item(), places=4)
+                self.assertEqual(pred1[0].item(), 1)
+                self.assertEqual(pred1[-1].item(), 2)
+
+    def test_beam(self):
+        self._check_batched(BeamSearch, 5, min_length=2)
+
+    def test_beam_blocking(self):
+        self._check_batched(BeamSearch, 5, min_length=2, block_ngram=2)
+
+    def test_greedy(self):
+        self._check_batched(GreedySearch, 1, min_length=0, block_ngram=3)
+
+    def test_block_ngram(self):
+        """The model wants to repeat "5 6" forever, blocking must prevent it."""
+        vocab, steps = 10, 12
+        logprobs = torch.full((steps, 2, 1, vocab), -10.0)
+        logprobs[0::2, :, :, 5] = -0.1
+        logprobs[1::2, :, :, 6] = -0.1
+        logprobs[:, :, :, 2] = -5.0
+        for n in (1, 2, 3):
+            preds = self._search(GreedySearch, logprobs, 2, block_ngram=n)
+            for n_best in preds:
+                tokens = n_best[0][0].tolist()[:-1]
+                ngrams = list(zip(*[tokens[i:] for i in range(n)]))
+                self.assertEqual(len(ngrams), len(set(ngrams)), tokens)
+
+
 if __name__ == '__main__':
     unittest.main()
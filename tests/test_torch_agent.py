@@ -7,17 +7,16 @@
 """Unit tests for TorchAgent."""
 
 import os
+import random
 import unittest
 from parlai.core.agents import create_agent_from_shared
 from parlai.utils.testing import capture_output, tempdir
 from parlai.utils.misc import Message
 import parlai.utils.testing as testing_utils
 
-from collections import deque
-
 SKIP_TESTS = False
 try:
-    from parlai.core.torch_agent import Output
+    from parlai.core.torch_agent import History, Output
     from parlai.agents.test_agents.dummy_torch_agent import MockTorchAgent, MockDict
     import torch
 except ImportError:
@@ -705,7 +704,7 @@ class TestTorchAgent(unittest.TestCase):
         agent.history.reset()
         agent.history.update_history(obs)
         vec = agent.history.get_history_vec()
-        self.assertEqual(vec, deque([2001, 1, 2, 3]))
+        self.assertEqual(vec.tolist(), [2001, 1, 2, 3])
 
         # test history vec list
         agent.history.update_history(obs)
@@ -726,6 +725,52 @@ class TestTorchAgent(unittest.TestCase):
         text = agent.history.get_history_str()
         self.assertEqual(text, 'I am Groot. Groot! I am Groot.')
 
+    def test_history_vec_buffer(self):
+        """Make sure the history ring buffer matches joining the history vecs."""
+
+        class NumberDict:
+            def txt2vec(self, text):
+                return [int(w) for w in text.split()]
+
+        def joined(history):
+            vec = []
+            for i, utt in enumerate(history.history_vecs):
+                if i > 0:
+                    vec += history.delimiter_tok
+                vec += utt
+            return vec
+
+        rng = random.Random(42)
+        for vec_type, maxlen, size in [
+            ('deque', 7, -1),
+            ('deque', 20, 3),
+            ('deque', 0, 2),
+            ('list', 7, -1),
+            ('list', None, 2),
+        ]:
+            history = History(
+                {'delimiter': ' 0 '},
+                vec_type=vec_type,
+                maxlen=maxlen,
+                size=size,
+                dict_agent=NumberDict(),
+            )
+            for turn in range(300):
+                text = ' '.join(
+                    str(rng.randint(1, 100)) for _ in range(rng.randint(0, 12))
+                )
+                history.update_history(
+                    {'text': text, 'episode_done': rng.random() < 0.05}
+                )
+                expected = joined(history)
+                if vec_type == 'deque':
+                    expected = expected[-maxlen:] if maxlen else []
+                self.assertEqual(
+                    history.get_history_vec().tolist(),
+                    expected,
+                    '{} {} {} turn {}'.format(vec_type, maxlen, size, turn),
+                )
+
     def test_last_reply(self):
         """Make sure last reply returns expected values."""
         agent = get_agent()
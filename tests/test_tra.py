@@ -7,9 +7,12 @@
 
 import os
 import unittest
+from unittest import mock
 
+from parlai.agents.memnn.memnn import MemnnAgent
 from parlai.core.agents import create_agent
 import parlai.utils.testing as testing_utils
+import torch
 from parlai.core.params import ParlaiParser
 from parlai.tasks.integration_tests.agents import CandidateTeacher
 
@@ -194,6 +197,120 @@ class TestTransformerRanker(_AbstractTRATest):
             args[k] = v
         return args
 
+    def _write_all_cands(self, tmpdir):
+        teacher = CandidateTeacher({'datatype': 'train'})
+        all_cands = teacher.train + teacher.val + teacher.test
+        all_cands_str = '\n'.join([' '.join(x) for x in all_cands])
+        tmp_cands_file = os.path.join(tmpdir, 'all_cands.text')
+        with open(tmp_cands_file, 'w') as f:
+            f.write(all_cands_str)
+        return tmp_cands_file
+
+    def test_eval_fixed_index(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+        args['encode_candidate_vecs'] = True
+
+        with testing_utils.tempdir() as tmpdir:
+            args['fixed_candidates_path'] = self._write_all_cands(tmpdir)
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['num_epochs'] = 1
+            testing_utils.train_model(args)
+            # candidates were encoded before training; encode them again
+            args['fixed_candidate_vecs'] = 'replace'
+            _, valid, _ = testing_utils.eval_model(args, skip_test=True)
+
+            # exact search over the cached encodings ranks like full scoring
+            args['fixed_candidate_vecs'] = 'reuse'
+            args['fixed_candidate_index'] = 'flat'
+            stdout, index_valid, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertTrue(
+                os.path.isfile(os.path.join(tmpdir, 'model.all_cands.flat.index')),
+                "index not saved\nLOG:\n{}".format(stdout),
+            )
+            self.assertEqual(
+                valid['hits@1'],
+                index_valid['hits@1'],
+                "valid hits@1 = {}\nLOG:\n{}".format(index_valid['hits@1'], stdout),
+            )
+
+    def test_fixed_index_reuse(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+        args['encode_candidate_vecs'] = True
+        args['fixed_candidate_index'] = 'ivf'
+        with testing_utils.tempdir() as tmpdir:
+            args['fixed_candidates_path'] = self._write_all_cands(tmpdir)
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['num_epochs'] = 1
+            testing_utils.train_model(args)
+
+            def load(*extra_args):
+                pp = ParlaiParser(True, True)
+                opt = pp.parse_args(
+                    [
+                        '--model-file',
+                        args['model_file'],
+                        '--eval-candidates',
+                        'fixed',
+                        '--encode-candidate-vecs',
+                        'true',
+                        '--fixed-candidates-path',
+                        args['fixed_candidates_path'],
+                        '--fixed-candidate-index',
+                        'ivf',
+                    ]
+                    + list(extra_args),
+                    print_args=False,
+                )
+                with testing_utils.capture_output() as output:
+                    agent = create_agent(opt)
+                return agent, output.getvalue()
+
+            # the number of clusters searched is not fixed by the saved index
+            agent, stdout = load('--candidate-index-nprobe', '3')
+            self.assertIn('Loading fixed candidate index', stdout)
+            self.assertEqual(agent.fixed_candidate_index.nprobe, 3)
+
+            # new encodings get a new index
+            os.remove(os.path.join(tmpdir, 'model.all_cands.encs'))
+            _, stdout = load()
+            self.assertIn('Building ivf fixed candidate index', stdout)
+            _, stdout = load('--fixed-candidate-vecs', 'replace')
+            self.assertIn('Building ivf fixed candidate index', stdout)
+
+    def test_eval_fixed_memmap(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+        args['encode_candidate_vecs'] = True
+        with testing_utils.tempdir() as tmpdir:
+            args['fixed_candidates_path'] = self._write_all_cands(tmpdir)
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['num_epochs'] = 1
+            testing_utils.train_model(args)
+            # candidates were encoded before training; encode them again
+            args['fixed_candidate_vecs'] = 'replace'
+            _, valid, _ = testing_utils.eval_model(args, skip_test=True)
+
+            args['memmap_fixed_candidates'] = True
+            args['fixed_candidate_vecs'] = 'replace'
+            stdout, memmap_valid, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertEqual(
+                valid['hits@1'],
+                memmap_valid['hits@1'],
+                "valid hits@1 = {}\nLOG:\n{}".format(memmap_valid['hits@1'], stdout),
+            )
+
+            # the saved files are memory-mapped when reused
+            args['fixed_candidate_vecs'] = 'reuse'
+            stdout, memmap_valid, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertNotIn("can't be memory-mapped", stdout)
+            self.assertEqual(
+                valid['hits@1'],
+                memmap_valid['hits@1'],
+                "valid hits@1 = {}\nLOG:\n{}".format(memmap_valid['hits@1'], stdout),
+            )
+
 
 class TestMemNN(_AbstractTRATest):
     def _get_args(self):
@@ -205,6 +322,82 @@ class TestMemNN(_AbstractTRATest):
         # this is a slightly worse model, so we expect it to perform worse
         return 0.5
 
+    def test_fixed_index_unsupported(self):
+        """Models without encode_context() can't use an index, say so upfront."""
+        pp = ParlaiParser(True, True)
+        opt = pp.parse_args(
+            ['--model', 'memnn', '--fixed-candidate-index', 'flat'], print_args=False
+        )
+        with testing_utils.capture_output():
+            with self.assertRaises(RuntimeError):
+                create_agent(opt)
+
+    def test_resume_candidate_encoding(self):
+        args = self._get_args()
+        with testing_utils.tempdir() as tmpdir:
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['num_epochs'] = 1
+            testing_utils.train_model(args)
+
+            teacher = CandidateTeacher({'datatype': 'train'})
+            cands_file = os.path.join(tmpdir, 'cands.txt')
+            with open(cands_file, 'w') as f:
+                f.write('\n'.join(' '.join(x) for x in teacher.train))
+
+            pp = ParlaiParser(True, True)
+            opt = pp.parse_args(
+                [
+                    '--model-file',
+                    args['model_file'],
+                    '--eval-candidates',
+                    'fixed',
+                    '--fixed-candidates-path',
+                    cands_file,
+                    '--candidate-vectorize-workers',
+                    '2',
+                    '--candidate-encode-batch-tokens',
+                    '100',
+                    '--candidate-encode-shard-size',
+                    '100',
+                ],
+                print_args=False,
+            )
+            encode = MemnnAgent.encode_candidates
+            calls = []
+            crash_after = [250]
+
+            def crash(agent, cands):
+                calls.append(len(cands))
+                if sum(calls) > crash_after[0]:
+                    raise RuntimeError('crash')
+                return encode(agent, cands)
+
+            with testing_utils.capture_output():
+                with mock.patch.object(MemnnAgent, 'encode_candidates', crash):
+                    with self.assertRaises(RuntimeError):
+                        create_agent(opt)
+                    self.assertTrue(
+                        os.path.isdir(os.path.join(tmpdir, 'model.cands.encs.shards'))
+                    )
+                    # resumes from the two completed shards
+                    calls.clear()
+                    crash_after[0] = len(teacher.train)
+                    opt['fixed_candidate_vecs'] = 'replace'
+                    resumed = create_agent(opt)
+                    self.assertEqual(sum(calls), len(teacher.train) - 200)
+                    self.assertFalse(
+                        os.path.isdir(os.path.join(tmpdir, 'model.cands.encs.shards'))
+                    )
+
+                # a complete run encodes the same
+                opt['candidate_encode_shard_size'] = 0
+                agent = create_agent(opt)
+            self.assertTrue(
+                torch.allclose(
+                    agent.fixed_candidate_encs, resumed.fixed_candidate_encs, atol=1e-6,
+                )
+            )
+
 
 class TestPolyRanker(_AbstractTRATest):
     def _get_args(self):
@@ -68,6 +68,19 @@ class TestTrainModel(unittest.TestCase):
             'Task accuracy is averaged incorrectly',
         )
 
+    def test_multitask_max_tokens_per_batch(self):
+        """Multitask worlds fall back to batching by --batchsize."""
+        stdout, valid, test = testing_utils.train_model(
+            {
+                'task': 'integration_tests:multiturnCandidate,integration_tests',
+                'model': 'repeat_label',
+                'batchsize': 8,
+                'max_tokens_per_batch': 50,
+                'num_epochs': 0.1,
+            }
+        )
+        self.assertEqual(valid['accuracy'], 1, stdout)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,6 +8,11 @@
 
 import os
 import unittest
+import torch
+from parlai.agents.transformer.modules import (
+    TransformerDecoder,
+    TransformerGeneratorModel,
+)
 import parlai.utils.testing as testing_utils
 
 
@@ -600,6 +605,60 @@ class TestTransformerGenerator(unittest.TestCase):
         )
 
 
+class TestIncrementalDecoding(unittest.TestCase):
+    """Checks that incremental decoding matches decoding the whole sequence."""
+
+    def _decoder(self, variant):
+        torch.manual_seed(0)
+        embeddings = torch.nn.Embedding(20, 16)
+        decoder = TransformerDecoder(
+            n_heads=2,
+            n_layers=2,
+            embedding_size=16,
+            ffn_size=32,
+            vocabulary_size=20,
+            embedding=embeddings,
+            padding_idx=0,
+            n_positions=32,
+            variant=variant,
+        )
+        return decoder.eval()
+
+    def test_incremental(self):
+        for variant in ['aiayn', 'xlm']:
+            decoder = self._decoder(variant)
+            encoder_output = torch.randn(3, 5, 16)
+            encoder_mask = torch.ByteTensor([[1] * 5, [1] * 3 + [0] * 2, [1] * 5])
+            encoder_state = (encoder_output, encoder_mask)
+            tokens = torch.randint(1, 20, (3, 6))
+            with torch.no_grad():
+                full, _ = decoder(tokens, encoder_state)
+                incr_state = None
+                for step in range(tokens.size(1)):
+                    out, incr_state = decoder(
+                        tokens[:, : step + 1], encoder_state, incr_state
+                    )
+                    # only the new position is computed
+                    self.assertEqual(out.size(1), 1)
+                    self.assertTrue(
+                        torch.allclose(out[:, 0], full[:, step], atol=1e-5), variant
+                    )
+
+    def test_reorder(self):
+        decoder = self._decoder('aiayn')
+        model = TransformerGeneratorModel.__new__(TransformerGeneratorModel)
+        encoder_state = (torch.randn(3, 5, 16), torch.ones(3, 5).byte())
+        tokens = torch.randint(1, 20, (3, 4))
+        inds = torch.LongTensor([2, 2, 0])
+        with torch.no_grad():
+            _, incr_state = decoder(tokens[:, :3], encoder_state)
+            incr_state = model.reorder_decoder_incremental_state(incr_state, inds)
+            reordered_state = model.reorder_encoder_states(encoder_state, inds)
+            out, _ = decoder(tokens[inds], reordered_state, incr_state)
+            full, _ = decoder(tokens[inds], reordered_state)
+        self.assertTrue(torch.allclose(out[:, -1], full[:, -1], atol=1e-5))
+
+
 def test_learning_rate_resuming(self, args):
     """Test learning rate resumes correctly."""
     mdl = args['model']
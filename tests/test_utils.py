@@ -12,7 +12,20 @@ from parlai.utils.misc import (
     argsort,
     Opt,
 )
+from parlai.utils.candidate_index import build_candidate_index, load_candidate_index
+from parlai.utils.memmap import (
+    MemmapStrings,
+    MemmapTexts,
+    MemmapTextsWriter,
+    MemmapVectors,
+    MemmapVectorsWriter,
+    load_memmap_tensor,
+    save_memmap_tensor,
+)
+import parlai.utils.testing as testing_utils
 from copy import deepcopy
+import os
+import pickle
 import time
 import unittest
 import torch
@@ -138,6 +151,130 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(history[0][1], 1, 'Deepcopy history not set properly')
         self.assertEqual(history[1][1], 10, 'Deepcopy history not set properly')
 
+    def test_opt_copy(self):
+        opt = Opt({'x': 0, 'y': [1, 2]})
+        opt['x'] = 1
+        opt_copy = deepcopy(opt)
+        # mutable values are copied
+        opt_copy['y'].append(3)
+        self.assertEqual(opt['y'], [1, 2])
+        # histories are shared until changed
+        opt_copy['x'] = 2
+        self.assertEqual([v for _, v in opt.history['x']], [1])
+        self.assertEqual([v for _, v in opt_copy.history['x']], [1, 2])
+        # changes record where they were made
+        filename, _, function = opt_copy.history['x'][-1][0]
+        self.assertEqual(filename, __file__)
+        self.assertEqual(function, 'test_opt_copy')
+        self.assertEqual(opt.deepcopies[-1][2], 'test_opt_copy')
+        with testing_utils.capture_output() as output:
+            opt_copy.display_history('x')
+        self.assertIn('in test_opt_copy', output.getvalue())
+
+
+class TestCandidateIndex(unittest.TestCase):
+    """Test the fixed candidate search indexes."""
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.encs = torch.randn(500, 16)
+        self.queries = torch.randn(4, 16)
+        _, self.exact = self.queries.mm(self.encs.t()).topk(10, dim=1)
+
+    def test_flat_exact(self):
+        index = build_candidate_index('flat', self.encs, chunksize=64)
+        _, inds = index.search(self.queries, 10)
+        self.assertTrue(torch.equal(inds, self.exact))
+
+    def test_ivf_all_probes_exact(self):
+        # probing every cluster scores every candidate
+        index = build_candidate_index('ivf', self.encs, nlist=8, nprobe=8)
+        _, inds = index.search(self.queries, 10)
+        self.assertTrue(torch.equal(inds, self.exact))
+
+    def test_save_load(self):
+        for index_type in ['flat', 'ivf', 'pq']:
+            index = build_candidate_index(
+                index_type, self.encs, nlist=8, nprobe=2, num_subvectors=4
+            )
+            scores, inds = index.search(self.queries, 10)
+            with testing_utils.tempdir() as tmpdir:
+                path = os.path.join(tmpdir, 'cands.index')
+                index.save(path)
+                loaded = load_candidate_index(path, self.encs)
+            loaded_scores, loaded_inds = loaded.search(self.queries, 10)
+            self.assertTrue(torch.equal(inds, loaded_inds), index_type)
+            self.assertTrue(torch.allclose(scores, loaded_scores), index_type)
+
+    def test_load_mismatch(self):
+        index = build_candidate_index('ivf', self.encs, nlist=8)
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'cands.index')
+            index.save(path)
+            with self.assertRaises(ValueError):
+                load_candidate_index(path, self.encs, index_type='pq')
+            with self.assertRaises(ValueError):
+                load_candidate_index(path, self.encs[:400], index_type='ivf')
+
+
+class TestMemmap(unittest.TestCase):
+    """Test memory-mapped strings and tensors."""
+
+    def test_strings(self):
+        lines = ['hello world ', '', 'café', ' last line']
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'cands.txt')
+            offsets_path = os.path.join(tmpdir, 'cands.offsets')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines))
+            strings = MemmapStrings(path, offsets_path)
+            self.assertEqual(list(strings), [l.strip() for l in lines])
+            self.assertEqual(strings[-1], 'last line')
+            self.assertEqual(strings[torch.tensor(2)], 'café')
+            self.assertEqual(strings[1:3], ['', 'café'])
+
+            # a stale index is rebuilt
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('\nnew line')
+            self.assertEqual(MemmapStrings(path, offsets_path)[-1], 'new line')
+
+    def test_tensor(self):
+        tensor = torch.randn(10, 3)
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'cands.encs')
+            save_memmap_tensor(tensor, path)
+            self.assertTrue(torch.equal(load_memmap_tensor(path), tensor))
+
+    def test_vectors(self):
+        vecs = [[1, 2, 3], None, [], torch.LongTensor([4, 5])]
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'text_vec')
+            writer = MemmapVectorsWriter(path, path + '.offsets')
+            for vec in vecs:
+                writer.add(vec)
+            writer.close()
+            loaded = MemmapVectors(path, path + '.offsets')
+            self.assertEqual(len(loaded), len(vecs))
+            self.assertEqual(loaded[0].tolist(), [1, 2, 3])
+            self.assertIsNone(loaded[1])
+            self.assertEqual(loaded[2].tolist(), [])
+            self.assertEqual(loaded[-1].tolist(), [4, 5])
+            self.assertEqual(loaded[-1].dtype, torch.int32)
+            # pickling reopens the mapping
+            self.assertEqual(pickle.loads(pickle.dumps(loaded))[0].tolist(), [1, 2, 3])
+
+    def test_texts(self):
+        texts = ['hello\nworld ', None, '', 'café']
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'text')
+            writer = MemmapTextsWriter(path, path + '.offsets')
+            for text in texts:
+                writer.add(text)
+            writer.close()
+            loaded = MemmapTexts(path, path + '.offsets')
+            self.assertEqual(list(loaded), texts)
+            self.assertEqual(loaded[2:], ['', 'café'])
+
 
 if __name__ == '__main__':
     unittest.main()